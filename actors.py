@@ -0,0 +1,85 @@
+import asyncio
+
+################################################################################
+## NARRATION ACTORS ############################################################
+################################################################################
+# Everything done to a narration (starting it, answering it) goes through its
+# actor, which runs one request at a time, in the order they were submitted.
+# Different narrations have different actors, so they still run concurrently.
+class NarrationActor:
+    def __init__ (self, narration):
+        self.narration = narration
+        # Created along with the task, as most actors of restored narrations
+        # are never used.
+        self.mailbox = None
+        self.task = None
+        self.is_closed = False
+
+    # Returns a future for the result of 'await function(*args)'. Requests
+    # reaching a finalized narration are dropped, their result being None, as
+    # are those submitted once the actor is closed.
+    def submit (self, function, *args):
+        result = asyncio.get_running_loop().create_future()
+
+        if (self.is_closed):
+            result.set_result(None)
+
+            return result
+
+        if (self.task is None):
+            self.mailbox = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+        self.mailbox.put_nowait((result, function, args))
+
+        return result
+
+    def get_pending_requests (self):
+        if (self.mailbox is None):
+            return 0
+
+        return self.mailbox.qsize()
+
+    async def run (self):
+        while True:
+            request = await self.mailbox.get()
+
+            if (request is None):
+                break
+
+            (result, function, args) = request
+
+            if (result.cancelled()):
+                continue
+
+            if (self.narration.has_been_finalized()):
+                result.set_result(None)
+
+                continue
+
+            try:
+                value = await function(*args)
+            except Exception as e:
+                if (not result.done()):
+                    result.set_exception(e)
+            else:
+                if (not result.done()):
+                    result.set_result(value)
+
+    # Requests already submitted are still handled (and dropped if the
+    # narration was finalized).
+    def close (self):
+        if (self.is_closed):
+            return
+
+        self.is_closed = True
+
+        if (self.task is not None):
+            self.mailbox.put_nowait(None)
+
+    # Closes the actor and waits for its requests to be handled.
+    async def join (self):
+        self.close()
+
+        if (self.task is not None):
+            await self.task
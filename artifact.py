@@ -0,0 +1,100 @@
+import hashlib
+import marshal
+import os
+
+################################################################################
+## FORMAT ######################################################################
+################################################################################
+# A precompiled story is MAGIC, a version byte, then a marshal'd tuple:
+# (
+#   story content hash,
+#   structure types,
+#   sequences,
+#   optimized code,
+#   optimization report (nodes before, nodes after, folded constants, removed
+#   casts, pruned branches)
+# )
+#
+# It only saves parsing and optimizing the story: closures cannot be stored,
+# so the code is still compiled when it is loaded. VERSION has to change
+# whenever the optimizer does, so that older artifacts get replaced.
+MAGIC = b"TKC"
+VERSION = 1
+EXTENSION = ".tkc"
+
+# Where artifacts are written. None puts them next to their story file.
+directory = None
+
+def get_filename (json_file):
+    if (directory is None):
+        return json_file + EXTENSION
+
+    # Story files from different folders can have the same name: their path
+    # tells them apart, their name only helps finding them in the directory.
+    path = os.path.abspath(json_file)
+
+    return os.path.join(
+        directory,
+        (
+            os.path.basename(path)
+            + "."
+            + hashlib.sha1(os.fsencode(path)).hexdigest()
+            + EXTENSION
+        )
+    )
+
+# Returns None if there is no valid artifact for this version of the story.
+def load (json_file, content_hash):
+    try:
+        with open(get_filename(json_file), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    if (
+        (data[:len(MAGIC)] != MAGIC)
+        or (len(data) <= len(MAGIC))
+        or (data[len(MAGIC)] != VERSION)
+    ):
+        return None
+
+    try:
+        content = marshal.loads(data[(len(MAGIC) + 1):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+    # Truncated or foreign files can still unmarshal to something else.
+    if (
+        (type(content) is not tuple)
+        or (len(content) != 5)
+        or (content[0] != content_hash)
+    ):
+        return None
+
+    return content[1:]
+
+# Failing to write the artifact is not an error: the story is just parsed again
+# next time.
+def save (json_file, content_hash, structure_types, sequences, code, report):
+    filename = get_filename(json_file)
+    temporary_filename = filename + "." + str(os.getpid())
+
+    try:
+        with open(temporary_filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(bytes([VERSION]))
+            f.write(
+                marshal.dumps(
+                    (content_hash, structure_types, sequences, code, report)
+                )
+            )
+
+        # Other processes never see a partially written artifact.
+        os.replace(temporary_filename, filename)
+    except OSError as e:
+        print("[W] Could not write " + filename + ": " + str(e))
+
+        try:
+            os.remove(temporary_filename)
+        except OSError:
+            pass
@@ -0,0 +1,520 @@
+import asyncio
+import marshal
+import multiprocessing
+import os
+import traceback
+
+import narration
+import profiler
+
+################################################################################
+## PROFILING ###################################################################
+################################################################################
+# 'action' is "start", "stop" or "show". Returns the profiler of the narration
+# (or story), or the one that was just detached for "stop", or None.
+def profile_narration (target, action):
+    state = target.state
+
+    if (action == "start"):
+        if (state.profiler is None):
+            state.enable_profiling()
+    elif (action == "stop"):
+        return state.disable_profiling()
+
+    return state.profiler
+
+# Narrations of other story files in 'narrations' are ignored, as are
+# hibernated ones: they get the story's profiler when they are rehydrated.
+def profile_story (filename, narrations, action):
+    path = os.path.abspath(filename)
+
+    if (action == "start"):
+        result = profiler.enable_story_profiler(path)
+
+        for n in narrations:
+            if ((n.state is not None) and (n.state.program.filename == path)):
+                n.state.enable_profiling(result)
+    elif (action == "stop"):
+        result = profiler.disable_story_profiler(path)
+
+        for n in narrations:
+            if (
+                (result is not None)
+                and (n.state is not None)
+                and (n.state.program.filename == path)
+                and (n.state.profiler is result)
+            ):
+                n.state.disable_profiling()
+    else:
+        result = profiler.get_story_profiler(path)
+
+    return result
+
+################################################################################
+## LOCAL BACKEND ###############################################################
+################################################################################
+# Runs the narrations in the bot's own process, giving control back to the
+# event loop every Narration.instruction_budget instructions.
+class LocalBackend:
+    def create_narration (self, story_file, initiator_name, initiator_id):
+        return narration.Narration(story_file, initiator_name, initiator_id)
+
+    async def wait_for (self, narration):
+        while (narration.is_running() and not narration.has_been_finalized()):
+            await asyncio.sleep(0)
+
+            if (not narration.has_been_finalized()):
+                narration.resume()
+
+    async def start (self, narration):
+        narration.run(
+            narration.get_initiator_name(),
+            narration.get_initiator_id()
+        )
+
+        await self.wait_for(narration)
+
+        return narration.pop_output_string()
+
+    async def answer (self, narration, text, actor_name, actor_id):
+        narration.handle_answer(text, actor_name, actor_id)
+
+        await self.wait_for(narration)
+
+        return narration.pop_output_string()
+
+    async def profile_narration (self, narration, action):
+        return profile_narration(narration, action)
+
+    async def profile_story (self, filename, narrations, action):
+        return profile_story(filename, narrations, action)
+
+    async def get_allocation_stats (self, narration):
+        return narration.get_allocation_stats()
+
+    async def checkpoint (self, narration, is_full):
+        return narration.save_checkpoint(is_full)
+
+    # Returns False if the narration could not be hibernated.
+    async def hibernate (self, narration, filename):
+        return narration.hibernate(filename)
+
+    # Returns False if the narration was not hibernated.
+    async def rehydrate (self, narration):
+        return narration.restore_state()
+
+    # Called before the bot connects. 'requests' is a list of (narration ID,
+    # story file, initiator name, initiator ID, checkpoint). Returns, for each
+    # of them, the restored narration or the exception that prevented it.
+    def restore_narrations (self, requests):
+        result = []
+
+        for (narration_id, story_file, initiator_name, initiator_id, data) in (
+            requests
+        ):
+            try:
+                restored_narration = narration.Narration(
+                    story_file,
+                    initiator_name,
+                    initiator_id
+                )
+                restored_narration.restore_checkpoint(data)
+                restored_narration.id = narration_id
+                result.append(restored_narration)
+            except Exception as e:
+                result.append(e)
+
+        narration.Narration.restore_ids(
+            [n.get_id() for n in result if not isinstance(n, Exception)]
+        )
+
+        return result
+
+    # Narrations run in the bot's process, which cannot lose them.
+    def has_failed (self, narration):
+        return False
+
+    def release (self, narration):
+        narration.discard_hibernated_state()
+
+    async def wait_for_releases (self):
+        pass
+
+    def close (self):
+        pass
+
+################################################################################
+## PROCESS BACKEND #############################################################
+################################################################################
+# Story file as seen by a worker: only its filename is needed there.
+class WorkerStoryFile:
+    def __init__ (self, filename):
+        self.filename = filename
+
+def run_until_input_is_required (narration):
+    while (narration.is_running()):
+        narration.resume()
+
+    return (
+        narration.pop_output_string(),
+        narration.status,
+        narration.get_memory_usage()
+    )
+
+def worker_main (connection):
+    narrations = dict()
+
+    while True:
+        request = connection.recv()
+        command = request[0]
+
+        if (command == "stop"):
+            return
+
+        if (command == "release"):
+            released_narration = narrations.pop(request[1], None)
+
+            if (released_narration is not None):
+                released_narration.discard_hibernated_state()
+
+            connection.send(("ok", None))
+            continue
+
+        try:
+            if (command == "start"):
+                (_, narration_id, filename, initiator_name, initiator_id) = (
+                    request
+                )
+                new_narration = narration.Narration(
+                    WorkerStoryFile(filename),
+                    initiator_name,
+                    initiator_id
+                )
+                narrations[narration_id] = new_narration
+                new_narration.run(initiator_name, initiator_id)
+                reply = run_until_input_is_required(new_narration)
+
+            elif (command == "answer"):
+                (_, narration_id, text, actor_name, actor_id) = request
+                current_narration = narrations[narration_id]
+                current_narration.handle_answer(text, actor_name, actor_id)
+                reply = run_until_input_is_required(current_narration)
+
+            elif (command == "profile_narration"):
+                (_, narration_id, action) = request
+                reply = profile_narration(narrations[narration_id], action)
+
+            elif (command == "profile_story"):
+                (_, filename, action) = request
+                reply = profile_story(filename, narrations.values(), action)
+
+            elif (command == "allocation_stats"):
+                reply = narrations[request[1]].get_allocation_stats()
+
+            elif (command == "checkpoint"):
+                reply = narrations[request[1]].save_checkpoint(request[2])
+
+            elif (command == "hibernate"):
+                reply = narrations[request[1]].hibernate(request[2])
+
+            elif (command == "rehydrate"):
+                reply = narrations[request[1]].restore_state()
+
+            elif (command == "restore"):
+                reply = []
+
+                for (
+                    narration_id,
+                    filename,
+                    initiator_name,
+                    initiator_id,
+                    data
+                ) in request[1]:
+                    try:
+                        restored_narration = narration.Narration(
+                            WorkerStoryFile(filename),
+                            initiator_name,
+                            initiator_id
+                        )
+                        restored_narration.restore_checkpoint(data)
+                        narrations[narration_id] = restored_narration
+                        reply.append(None)
+                    except Exception as e:
+                        reply.append(str(e))
+
+            else:
+                raise ValueError("Unknown worker command " + str(command))
+
+            connection.send(("ok", reply))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+
+# Main process side of a narration running in a worker. It only keeps what the
+# bot needs to list and route narrations, the output of the last step, its
+# memory usage after that step, and its status, which is IS_RUNNING while the
+# worker is handling it.
+class RemoteNarration (narration.Narration):
+    def __init__ (self, story_file, initiator_name, initiator_id, worker):
+        self.status = narration.Narration.NOT_STARTED
+        self.is_paused = False
+        self.initiator_name = initiator_name
+        self.initiator_id = initiator_id
+        self.output = []
+        self.output_size = 0
+        self.previous_output = ""
+        self.story_file = story_file
+        self.last_post_id = None
+        self.is_finalized = False
+        self.id = narration.Narration.allocate_id()
+        self.worker = worker
+        self.memory_usage = None
+
+    def get_memory_usage (self):
+        return self.memory_usage
+
+    # The rest of the checkpoint is restored by the worker.
+    def restore_checkpoint (self, data):
+        values = marshal.loads(data)
+        self.status = values[0]
+        self.previous_output = values[5]
+
+class Worker:
+    def __init__ (self, context):
+        (self.connection, worker_connection) = context.Pipe()
+        self.process = context.Process(
+            target = worker_main,
+            args = (worker_connection,),
+            daemon = True
+        )
+        self.lock = None
+        self.narrations = 0
+        # Set once the worker's process is gone, along with its narrations.
+        self.has_failed = False
+        self.process.start()
+
+    # Workers handle one request at a time, so requests are serialized here.
+    async def request (self, *request):
+        if (self.lock is None):
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            if (self.has_failed):
+                raise RuntimeError("Narration worker stopped.")
+
+            try:
+                self.connection.send(request)
+
+                loop = asyncio.get_running_loop()
+                (result, content) = await loop.run_in_executor(
+                    None,
+                    self.connection.recv
+                )
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                self.has_failed = True
+
+                raise RuntimeError(
+                    "Narration worker "
+                    + str(self.process.pid)
+                    + " stopped."
+                )
+
+        if (result == "error"):
+            raise RuntimeError("Narration worker failure:\n" + content)
+
+        return content
+
+class ProcessBackend:
+    def __init__ (self, workers):
+        # Workers are forked before the bot connects, so they inherit the
+        # already configured Narration settings.
+        context = multiprocessing.get_context("fork")
+        self.workers = [Worker(context) for i in range(workers)]
+        # Release requests still being sent, kept so that they are not
+        # garbage collected before they are done.
+        self.releases = set()
+
+    def create_narration (self, story_file, initiator_name, initiator_id):
+        workers = [worker for worker in self.workers if not worker.has_failed]
+
+        if (len(workers) == 0):
+            raise RuntimeError("All narration workers stopped.")
+
+        worker = min(workers, key = lambda w: w.narrations)
+        worker.narrations += 1
+
+        return RemoteNarration(story_file, initiator_name, initiator_id, worker)
+
+    async def run_request (self, narration, *request):
+        previous_status = narration.status
+        narration.status = narration.IS_RUNNING
+
+        try:
+            (output, status, memory_usage) = await narration.worker.request(
+                *request
+            )
+        except Exception:
+            narration.status = previous_status
+            raise
+
+        narration.display_string(output)
+        narration.status = status
+        narration.memory_usage = memory_usage
+
+        return narration.pop_output_string()
+
+    async def start (self, narration):
+        return await self.run_request(
+            narration,
+            "start",
+            narration.get_id(),
+            narration.get_story_file().get_filename(),
+            narration.get_initiator_name(),
+            narration.get_initiator_id()
+        )
+
+    async def answer (self, narration, text, actor_name, actor_id):
+        return await self.run_request(
+            narration,
+            "answer",
+            narration.get_id(),
+            text,
+            actor_name,
+            actor_id
+        )
+
+    async def profile_narration (self, narration, action):
+        return await narration.worker.request(
+            "profile_narration",
+            narration.get_id(),
+            action
+        )
+
+    # Each worker has its own profiler for the story: their measures are added.
+    async def profile_story (self, filename, narrations, action):
+        result = None
+
+        for worker in self.workers:
+            worker_profiler = await worker.request(
+                "profile_story",
+                filename,
+                action
+            )
+
+            if (worker_profiler is None):
+                continue
+
+            if (result is None):
+                result = profiler.Profiler()
+
+            result.merge(worker_profiler)
+
+        return result
+
+    async def get_allocation_stats (self, narration):
+        return await narration.worker.request(
+            "allocation_stats",
+            narration.get_id()
+        )
+
+    async def checkpoint (self, narration, is_full):
+        return await narration.worker.request(
+            "checkpoint",
+            narration.get_id(),
+            is_full
+        )
+
+    async def hibernate (self, narration, filename):
+        return await narration.worker.request(
+            "hibernate",
+            narration.get_id(),
+            filename
+        )
+
+    async def rehydrate (self, narration):
+        return await narration.worker.request("rehydrate", narration.get_id())
+
+    # Called before the bot connects, so the workers are used directly, each
+    # restoring its share of the narrations at the same time.
+    def restore_narrations (self, requests):
+        result = []
+        worker_requests = {worker: [] for worker in self.workers}
+
+        for (narration_id, story_file, initiator_name, initiator_id, data) in (
+            requests
+        ):
+            restored_narration = self.create_narration(
+                story_file,
+                initiator_name,
+                initiator_id
+            )
+            restored_narration.restore_checkpoint(data)
+            restored_narration.id = narration_id
+            result.append(restored_narration)
+            worker_requests[restored_narration.worker].append(
+                (
+                    len(result) - 1,
+                    (
+                        narration_id,
+                        story_file.get_filename(),
+                        initiator_name,
+                        initiator_id,
+                        data
+                    )
+                )
+            )
+
+        for (worker, entries) in worker_requests.items():
+            worker.connection.send(
+                ("restore", [entry[1] for entry in entries])
+            )
+
+        for (worker, entries) in worker_requests.items():
+            (status, content) = worker.connection.recv()
+
+            if (status == "error"):
+                raise RuntimeError("Narration worker failure:\n" + content)
+
+            for (entry, error) in zip(entries, content):
+                if (error is not None):
+                    result[entry[0]].worker.narrations -= 1
+                    result[entry[0]] = RuntimeError(error)
+
+        narration.Narration.restore_ids(
+            [n.get_id() for n in result if not isinstance(n, Exception)]
+        )
+
+        return result
+
+    def has_failed (self, narration):
+        return narration.worker.has_failed
+
+    def release (self, narration):
+        narration.worker.narrations -= 1
+
+        if (narration.worker.has_failed):
+            return
+
+        release = asyncio.get_running_loop().create_task(
+            narration.worker.request("release", narration.get_id())
+        )
+        self.releases.add(release)
+        release.add_done_callback(self.end_release)
+
+    def end_release (self, release):
+        self.releases.discard(release)
+
+        if ((not release.cancelled()) and (release.exception() is not None)):
+            print("Could not release narration: " + str(release.exception()))
+
+    async def wait_for_releases (self):
+        await asyncio.gather(*self.releases, return_exceptions = True)
+
+    def close (self):
+        for worker in self.workers:
+            if (not worker.has_failed):
+                try:
+                    worker.connection.send(("stop",))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            worker.process.join()
@@ -0,0 +1,115 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import narration
+
+from wyrd import *
+
+################################################################################
+## STORY #######################################################################
+################################################################################
+# A single scene of 'count' display instructions in a row, each showing a line
+# with a text effect and the value of a variable, then the end of the story.
+def generate_story (count):
+    code = []
+
+    code.append(set_value(address("name"), constant("Tonkadur")))
+
+    for i in range(count):
+        code.append(
+            display(
+                text(
+                    constant("Line " + str(i) + ": "),
+                    text_effect("emph", variable("name")),
+                    constant(" speaks."),
+                    newline()
+                )
+            )
+        )
+
+    code.append(end())
+
+    return story(code)
+
+################################################################################
+## BENCHMARK ###################################################################
+################################################################################
+class BenchmarkStoryFile:
+    def __init__ (self, filename):
+        self.filename = filename
+
+def narrate (story_file):
+    result = narration.Narration(story_file, "benchmark", 0)
+    result.run("benchmark", 0)
+
+    while (result.is_running()):
+        result.resume()
+
+    return result.pop_output_string()
+
+def benchmark (story_file, repeat):
+    # Loads the story into the program cache.
+    output = narrate(story_file)
+    best_time = None
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        narrate(story_file)
+        duration = time.perf_counter() - start
+
+        if ((best_time is None) or (duration < best_time)):
+            best_time = duration
+
+    tracemalloc.start()
+    narrate(story_file)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return (len(output), best_time, peak_memory)
+
+parser = argparse.ArgumentParser(
+    description = (
+        "Measures the time and peak memory needed to narrate long scenes."
+    )
+)
+
+parser.add_argument(
+    '-s',
+    '--sizes',
+    type = int,
+    nargs = '+',
+    default = [100, 1000, 10000, 50000],
+    help = 'Number of display instructions in the scene.',
+)
+
+parser.add_argument(
+    '-r',
+    '--repeat',
+    type = int,
+    default = 5,
+    help = 'Number of runs for each measure (the best one is kept).',
+)
+
+args = parser.parse_args()
+
+print("displays output_chars time_ms peak_kb")
+
+with tempfile.TemporaryDirectory() as directory:
+    for count in args.sizes:
+        story_file = BenchmarkStoryFile(
+            os.path.join(directory, str(count) + ".json")
+        )
+        write_story(story_file.filename, generate_story(count))
+
+        (output_size, duration, peak_memory) = benchmark(story_file, args.repeat)
+
+        print(
+            "%d %d %.2f %d"
+            % (count, output_size, (duration * 1000), (peak_memory / 1024))
+        )
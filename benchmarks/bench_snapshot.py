@@ -0,0 +1,155 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import snapshot
+import tonkadur
+
+from wyrd import *
+
+################################################################################
+## STORY #######################################################################
+################################################################################
+# Allocates 'count' structures, keeping pointers to them in a list, then keeps
+# asking for an integer, storing it in the last structure each time.
+def generate_story (count):
+    npc = type_of("structure", "npc")
+    code = []
+
+    code.append(initialize(address("npcs"), type_of("list")))
+    code.append(initialize(address("last"), type_of("pointer")))
+    add_loop(
+        code,
+        "i",
+        count,
+        [
+            set_value(address("last"), new(npc)),
+            set_value(
+                relative_address(variable("last"), constant("hp")),
+                variable("i")
+            ),
+            set_value(
+                relative_address(
+                    address("npcs"),
+                    cast(variable("i"), "int", "string")
+                ),
+                variable("last")
+            ),
+        ]
+    )
+    prompt_line = len(code)
+    code.append(prompt_integer(address("answer"), 0, 100, text(constant("?"))))
+    code.append(
+        set_value(
+            relative_address(variable("last"), constant("hp")),
+            variable("answer")
+        )
+    )
+    code.append(set_pc(constant(prompt_line)))
+
+    return story(
+        code,
+        [
+            structure_type(
+                "npc",
+                [
+                    ("name", type_of("string")),
+                    ("hp", type_of("int")),
+                    ("inventory", type_of("list")),
+                ]
+            )
+        ]
+    )
+
+################################################################################
+## BENCHMARK ###################################################################
+################################################################################
+def best_time_of (repeat, function):
+    result = None
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+
+        if ((result is None) or (duration < result)):
+            result = duration
+
+    return result
+
+def benchmark (story_file, repeat):
+    vm = tonkadur.Tonkadur(story_file, "benchmark", 0)
+    vm.run("benchmark", 0)
+
+    # First snapshot: everything has to be encoded.
+    vm.snapshot_cache = snapshot.SnapshotCache()
+    start = time.perf_counter()
+    data = vm.save_snapshot()
+    full_save = time.perf_counter() - start
+
+    # Checkpoint after a reply that modified a single structure.
+    def reply_and_save ():
+        vm.store_integer(42, "benchmark", 0)
+        vm.run("benchmark", 0)
+        vm.save_snapshot()
+
+    reply_save = best_time_of(repeat, reply_and_save)
+
+    def load ():
+        restored = tonkadur.Tonkadur(story_file, "benchmark", 0)
+        restored.restore_snapshot(data)
+
+    return (len(vm.memory), len(data), full_save, reply_save, best_time_of(repeat, load))
+
+parser = argparse.ArgumentParser(
+    description = "Measures the size and save/load time of Tonkadur snapshots."
+)
+
+parser.add_argument(
+    '-s',
+    '--sizes',
+    type = int,
+    nargs = '+',
+    default = [100, 1000, 10000, 100000],
+    help = 'Number of structures allocated by the story before the snapshot.',
+)
+
+parser.add_argument(
+    '-r',
+    '--repeat',
+    type = int,
+    default = 5,
+    help = 'Number of runs for each measure (the best one is kept).',
+)
+
+args = parser.parse_args()
+
+print(
+    "structures memory_entries snapshot_bytes full_save_ms reply_save_ms"
+    " load_ms"
+)
+
+with tempfile.TemporaryDirectory() as directory:
+    for count in args.sizes:
+        story_file = os.path.join(directory, str(count) + ".json")
+        write_story(story_file, generate_story(count))
+
+        (entries, size, full_save, reply_save, load) = (
+            benchmark(story_file, args.repeat)
+        )
+
+        print(
+            "%d %d %d %.2f %.2f %.2f"
+            % (
+                count,
+                entries,
+                size,
+                (full_save * 1000),
+                (reply_save * 1000),
+                (load * 1000)
+            )
+        )
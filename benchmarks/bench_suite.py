@@ -0,0 +1,415 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import narration
+
+from wyrd import *
+
+################################################################################
+## SYNTHETIC STORIES ###########################################################
+################################################################################
+# Each story keeps asking for something, so that the same script can be
+# replayed as many times as needed. They return (story, script).
+def ask_count (label):
+    return prompt_integer(address("n"), 0, 10000000, text(constant(label)))
+
+def as_string (computation):
+    return cast(computation, "int", "string")
+
+def generate_loops_story (count, replies):
+    code = []
+
+    code.append(ask_count("Iterations?"))
+    code.append(set_value(address("acc"), constant(0)))
+    add_loop(
+        code,
+        "i",
+        variable("n"),
+        [
+            set_value(
+                address("acc"),
+                operation(
+                    "modulo",
+                    operation(
+                        "plus",
+                        operation("times", variable("acc"), constant(3)),
+                        variable("i")
+                    ),
+                    constant(1000003)
+                )
+            )
+        ]
+    )
+    code.append(
+        display(text(constant("Result: "), as_string(variable("acc"))))
+    )
+    code.append(set_pc(constant(0)))
+
+    return (story(code), [str(count)] * replies)
+
+def generate_lists_story (count, replies):
+    code = []
+
+    code.append(ask_count("Items?"))
+    code.append(initialize(address("items"), type_of("list")))
+    code.append(set_value(address("sum"), constant(0)))
+    add_loop(
+        code,
+        "i",
+        variable("n"),
+        [
+            set_value(
+                relative_address(address("items"), as_string(variable("i"))),
+                operation("times", variable("i"), variable("i"))
+            )
+        ]
+    )
+    add_loop(
+        code,
+        "j",
+        variable("n"),
+        [
+            set_value(
+                address("sum"),
+                operation(
+                    "plus",
+                    variable("sum"),
+                    value_of(
+                        relative_address(
+                            address("items"),
+                            as_string(variable("j"))
+                        )
+                    )
+                )
+            )
+        ]
+    )
+    code.append(
+        display(
+            text(
+                as_string(size(address("items"))),
+                constant(" items, sum: "),
+                as_string(variable("sum"))
+            )
+        )
+    )
+    code.append(set_pc(constant(0)))
+
+    return (story(code), [str(count)] * replies)
+
+def generate_structures_story (count, replies):
+    npc = type_of("structure", "npc")
+    code = []
+
+    code.append(ask_count("Characters?"))
+    code.append(initialize(address("npcs"), type_of("list")))
+    add_loop(
+        code,
+        "i",
+        variable("n"),
+        [
+            set_value(address("last"), new(npc)),
+            set_value(
+                relative_address(variable("last"), constant("hp")),
+                variable("i")
+            ),
+            set_value(
+                relative_address(
+                    relative_address(variable("last"), constant("hand")),
+                    constant("count")
+                ),
+                constant(1)
+            ),
+            set_value(
+                relative_address(address("npcs"), as_string(variable("i"))),
+                variable("last")
+            ),
+        ]
+    )
+    code.append(
+        display(text(as_string(size(address("npcs"))), constant(" characters")))
+    )
+    code.append(set_pc(constant(0)))
+
+    structure_types = [
+        structure_type(
+            "item",
+            [("name", type_of("string")), ("count", type_of("int"))]
+        ),
+        structure_type(
+            "npc",
+            [
+                ("name", type_of("string")),
+                ("hp", type_of("int")),
+                ("inventory", type_of("list")),
+                ("hand", type_of("structure", "item")),
+            ]
+        ),
+    ]
+
+    return (story(code, structure_types), [str(count)] * replies)
+
+def generate_text_story (count, replies):
+    code = []
+
+    code.append(set_value(address("name"), constant("Tonkadur")))
+    code.append(ask_count("Lines?"))
+    add_loop(
+        code,
+        "i",
+        variable("n"),
+        [
+            display(
+                text(
+                    constant("Line "),
+                    as_string(variable("i")),
+                    constant(": "),
+                    text_effect("bold", variable("name")),
+                    constant(" speaks."),
+                    newline()
+                )
+            )
+        ]
+    )
+    code.append(set_pc(constant(1)))
+
+    return (story(code), [str(count)] * replies)
+
+def generate_choices_story (count, replies):
+    code = []
+
+    code.append(set_value(address("total"), constant(0)))
+    code.append(add_text_option(text(constant("Left"))))
+    code.append(add_text_option(text(constant("Right"))))
+    code.append(add_text_option(text(constant("Stay"))))
+    code.append(resolve_choice())
+    code.append(
+        set_value(
+            address("total"),
+            operation("plus", variable("total"), last_choice_index())
+        )
+    )
+    code.append(
+        display(text(constant("Total: "), as_string(variable("total"))))
+    )
+    code.append(set_pc(constant(1)))
+
+    return (story(code), [str(i % 3) for i in range(replies * count)])
+
+# Name -> (story generator, its count parameter)
+SYNTHETIC_STORIES = {
+    "loops": (generate_loops_story, 20000),
+    "lists": (generate_lists_story, 2000),
+    "structures": (generate_structures_story, 2000),
+    "text": (generate_text_story, 500),
+    "choices": (generate_choices_story, 5),
+}
+
+################################################################################
+## BENCHMARK ###################################################################
+################################################################################
+class BenchmarkStoryFile:
+    def __init__ (self, filename):
+        self.filename = filename
+
+def run_until_input_is_required (current_narration):
+    while (current_narration.is_running()):
+        current_narration.resume()
+
+    return current_narration.pop_output_string()
+
+# Starts the story, then gives it each answer of 'script' in turn, returning
+# how long each step took.
+def narrate (story_file, script, on_narration_created = None):
+    current_narration = narration.Narration(story_file, "benchmark", 0)
+    latencies = []
+
+    if (on_narration_created is not None):
+        on_narration_created(current_narration)
+
+    start = time.perf_counter()
+    current_narration.run("benchmark", 0)
+    run_until_input_is_required(current_narration)
+    latencies.append(time.perf_counter() - start)
+
+    for answer in script:
+        if (current_narration.has_ended()):
+            break
+
+        start = time.perf_counter()
+        current_narration.handle_answer(answer, "benchmark", 0)
+        run_until_input_is_required(current_narration)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+def count_instructions (story_file, script):
+    profilers = []
+
+    narrate(
+        story_file,
+        script,
+        lambda n: profilers.append(n.state.enable_profiling())
+    )
+
+    return profilers[0].get_instruction_count()
+
+def get_percentile (sorted_values, percentile):
+    index = int(round((percentile / 100) * (len(sorted_values) - 1)))
+
+    return sorted_values[index]
+
+def benchmark (name, story_file, script, repeat):
+    # Loads the story into the program cache.
+    narrate(story_file, script)
+
+    instructions = count_instructions(story_file, script)
+    latencies = []
+    best_time = None
+
+    for i in range(repeat):
+        run_latencies = narrate(story_file, script)
+        latencies.extend(run_latencies)
+        run_time = sum(run_latencies)
+
+        if ((best_time is None) or (run_time < best_time)):
+            best_time = run_time
+
+    tracemalloc.start()
+    narrate(story_file, script)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+
+    result = dict()
+    result['story'] = name
+    result['steps'] = len(script) + 1
+    result['instructions'] = instructions
+    result['time_ms'] = best_time * 1000
+    result['instructions_per_second'] = (
+        (instructions / best_time) if (best_time > 0) else 0
+    )
+    result['latency_p50_ms'] = get_percentile(latencies, 50) * 1000
+    result['latency_p90_ms'] = get_percentile(latencies, 90) * 1000
+    result['latency_p99_ms'] = get_percentile(latencies, 99) * 1000
+    result['latency_max_ms'] = latencies[-1] * 1000
+    result['peak_memory_kb'] = peak_memory / 1024
+
+    return result
+
+def read_script (filename):
+    with open(filename, 'r') as f:
+        return [line.rstrip("\n") for line in f]
+
+parser = argparse.ArgumentParser(
+    description = (
+        "Narrates synthetic and recorded stories with scripted answers,"
+        " measuring instructions per second, reply latency and peak memory."
+    )
+)
+
+parser.add_argument(
+    '-s',
+    '--synthetic',
+    type = str,
+    nargs = '*',
+    default = list(SYNTHETIC_STORIES.keys()),
+    help = (
+        'Synthetic stories to run (default: all of '
+        + ", ".join(SYNTHETIC_STORIES.keys())
+        + ').'
+    ),
+)
+
+parser.add_argument(
+    '-x',
+    '--story',
+    type = str,
+    nargs = 2,
+    action = 'append',
+    default = [],
+    metavar = ('STORY_FILE', 'SCRIPT_FILE'),
+    help = (
+        'Compiled story to run, with its script (one answer per line). Can be'
+        ' used multiple times.'
+    ),
+)
+
+parser.add_argument(
+    '-n',
+    '--replies',
+    type = int,
+    default = 10,
+    help = 'Number of answers given to each synthetic story.',
+)
+
+parser.add_argument(
+    '-r',
+    '--repeat',
+    type = int,
+    default = 3,
+    help = 'Number of runs of each story (the best one gives the throughput).',
+)
+
+parser.add_argument(
+    '-j',
+    '--json',
+    type = str,
+    help = 'Also writes the results to this file, as JSON.',
+)
+
+args = parser.parse_args()
+
+results = []
+
+with tempfile.TemporaryDirectory() as directory:
+    for name in args.synthetic:
+        (generator, count) = SYNTHETIC_STORIES[name]
+        (content, script) = generator(count, args.replies)
+        story_file = BenchmarkStoryFile(os.path.join(directory, name + ".json"))
+        write_story(story_file.filename, content)
+        results.append(benchmark(name, story_file, script, args.repeat))
+
+    for (filename, script_filename) in args.story:
+        results.append(
+            benchmark(
+                os.path.basename(filename),
+                BenchmarkStoryFile(filename),
+                read_script(script_filename),
+                args.repeat
+            )
+        )
+
+print(
+    "story steps instructions time_ms instr_per_s p50_ms p90_ms p99_ms max_ms"
+    " peak_kb"
+)
+
+for result in results:
+    print(
+        "%s %d %d %.2f %d %.3f %.3f %.3f %.3f %d"
+        % (
+            result['story'],
+            result['steps'],
+            result['instructions'],
+            result['time_ms'],
+            result['instructions_per_second'],
+            result['latency_p50_ms'],
+            result['latency_p90_ms'],
+            result['latency_p99_ms'],
+            result['latency_max_ms'],
+            result['peak_memory_kb']
+        )
+    )
+
+if (args.json is not None):
+    with open(args.json, 'w') as f:
+        json.dump(results, f, indent = 1)
@@ -0,0 +1,185 @@
+import json
+
+################################################################################
+## WYRD JSON BUILDERS ##########################################################
+################################################################################
+# Helpers to write compiled stories by hand, as the Fate compiler would produce
+# them.
+
+def type_of (category, name = None):
+    result = dict()
+    result['category'] = category
+
+    if (name is not None):
+        result['name'] = name
+
+    return result
+
+def constant (value):
+    result = dict()
+    result['category'] = "constant"
+
+    if (type(value) is bool):
+        result['type'] = type_of("bool")
+        result['value'] = "true" if value else "false"
+    elif (type(value) is int):
+        result['type'] = type_of("int")
+        result['value'] = str(value)
+    elif (type(value) is float):
+        result['type'] = type_of("float")
+        result['value'] = repr(value)
+    else:
+        result['type'] = type_of("string")
+        result['value'] = value
+
+    return result
+
+def address (name):
+    return {'category': "address", 'address': constant(name)}
+
+def relative_address (base, extra):
+    return {'category': "relative_address", 'base': base, 'extra': extra}
+
+def value_of (reference):
+    return {'category': "value_of", 'reference': reference}
+
+def variable (name):
+    return value_of(address(name))
+
+def operation (operator, x, y = None):
+    result = {'category': "operation", 'operator': operator, 'x': x}
+
+    if (y is not None):
+        result['y'] = y
+
+    return result
+
+def cast (content, origin_type, target_type):
+    return {
+        'category': "cast",
+        'from': type_of(origin_type),
+        'to': type_of(target_type),
+        'content': content
+    }
+
+def if_else (condition, if_true, if_false):
+    return {
+        'category': "if_else",
+        'condition': condition,
+        'if_true': if_true,
+        'if_false': if_false
+    }
+
+def text (*content):
+    return {'category': "text", 'content': list(content)}
+
+def text_effect (effect, *content):
+    return {
+        'category': "add_text_effect",
+        'effect': effect,
+        'parameters': [],
+        'content': list(content)
+    }
+
+def newline ():
+    return {'category': "newline"}
+
+def new (typedef):
+    return {'category': "new", 'target': typedef}
+
+def size (reference):
+    return {'category': "size", 'reference': reference}
+
+def last_choice_index ():
+    return {'category': "last_choice_index"}
+
+#### INSTRUCTIONS ##############################################################
+def set_value (reference, value):
+    return {'category': "set_value", 'reference': reference, 'value': value}
+
+def initialize (reference, typedef):
+    return {'category': "initialize", 'reference': reference, 'type': typedef}
+
+def remove (reference):
+    return {'category': "remove", 'reference': reference}
+
+def set_pc (value):
+    return {'category': "set_pc", 'value': value}
+
+def display (content):
+    return {'category': "display", 'content': content}
+
+def add_text_option (label):
+    return {'category': "add_text_option", 'label': label}
+
+def resolve_choice ():
+    return {'category': "resolve_choice"}
+
+def prompt_integer (target, min_value, max_value, label):
+    return {
+        'category': "prompt_integer",
+        'target': target,
+        'min': constant(min_value),
+        'max': constant(max_value),
+        'label': label
+    }
+
+def prompt_string (target, min_value, max_value, label):
+    return {
+        'category': "prompt_string",
+        'target': target,
+        'min': constant(min_value),
+        'max': constant(max_value),
+        'label': label
+    }
+
+def end ():
+    return {'category': "end"}
+
+#### STORIES ###################################################################
+def structure_type (name, fields):
+    return {
+        'name': name,
+        'fields': [
+            {'name': field_name, 'type': field_type}
+            for (field_name, field_type) in fields
+        ]
+    }
+
+def story (code, structure_types = None):
+    return {
+        'structure_types': structure_types or [],
+        'sequences': [{'name': "main", 'line': 0}],
+        'code': code
+    }
+
+def write_story (filename, content):
+    with open(filename, 'w') as f:
+        json.dump(content, f)
+
+# Adds 'body' to 'code' as the body of a loop incrementing 'counter' from 0 to
+# 'count' (which can be a computation).
+def add_loop (code, counter, count, body):
+    if (type(count) is int):
+        count = constant(count)
+
+    code.append(set_value(address(counter), constant(0)))
+    start = len(code)
+    end_line = start + len(body) + 3
+    code.append(
+        set_pc(
+            if_else(
+                operation("less_than", variable(counter), count),
+                constant(start + 1),
+                constant(end_line)
+            )
+        )
+    )
+    code.extend(body)
+    code.append(
+        set_value(
+            address(counter),
+            operation("plus", variable(counter), constant(1))
+        )
+    )
+    code.append(set_pc(constant(start)))
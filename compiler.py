@@ -0,0 +1,712 @@
+import math
+import random
+import sys
+import time
+
+import memory
+import text_renderer
+
+################################################################################
+## TYPES #######################################################################
+################################################################################
+# Types are turned into functions without parameters returning a new instance.
+# Structures are looked up by name in 'constructors' when instantiated, so they
+# do not need to be compiled in any particular order.
+
+def new_text ():
+    result = dict()
+    result['content'] = []
+    result['effect'] = None
+
+    return result
+
+def compile_structure_reference (name, constructors):
+    return lambda: constructors[name]()
+
+def compile_type (typedef, constructors):
+    category = typedef['category']
+
+    if (category == "bool"):
+        return bool
+    elif (category == "float"):
+        return float
+    elif (category == "int"):
+        return int
+    elif (category == "text"):
+        return new_text
+    elif (category == "string"):
+        return str
+    elif (category == "list"):
+        return memory.CowDict
+    elif (category == "pointer"):
+        return list
+    elif (category == "structure"):
+        if (typedef['name'] == "wild dict"):
+            return memory.CowDict
+        else:
+            return compile_structure_reference(typedef['name'], constructors)
+
+    return lambda: None
+
+def compile_structure (typedef, constructors):
+    # Default values are created once and kept in the template. Containers in
+    # there are shared, so each instance only gets its own copy if it writes in
+    # it. Only the fields holding other structures have to be constructed.
+    template = dict()
+    structure_fields = []
+
+    for field in typedef['fields']:
+        field_type = field['type']
+
+        if (
+            (field_type['category'] == "structure")
+            and (field_type['name'] != "wild dict")
+        ):
+            # Placeholder, so that copying the template keeps the fields in the
+            # order they were declared.
+            template[field['name']] = None
+            structure_fields.append(
+                (field['name'], compile_type(field_type, constructors))
+            )
+        else:
+            template[field['name']] = memory.share(
+                compile_type(field_type, constructors)()
+            )
+
+    def construct ():
+        result = memory.CowDict(template)
+
+        for (name, factory) in structure_fields:
+            result[name] = factory()
+
+        return result
+
+    return construct
+
+################################################################################
+## COMPUTATIONS ################################################################
+################################################################################
+# Every computation is turned into a function taking the Tonkadur instance as
+# its only parameter. Nothing specific to a given instance is captured, so the
+# resulting functions can be shared by all instances running the same code.
+# Anything the compiler does not know about is left to the JSON interpreter.
+
+def fallback_computation (computation):
+    def compute (vm):
+        return vm.compute(computation)
+
+    return compute
+
+def static_address_of (computation):
+    computation_category = computation['category']
+
+    if (computation_category == "address"):
+        address = computation['address']
+
+        if (
+            (address['category'] == "constant")
+            and (address['type']['category'] == "string")
+        ):
+            return (sys.intern(address['value']),)
+
+    elif (computation_category == "relative_address"):
+        base = static_address_of(computation['base'])
+        extra = computation['extra']
+
+        if (
+            (base is not None)
+            and (extra['category'] == "constant")
+            and (extra['type']['category'] == "string")
+        ):
+            return base + (sys.intern(extra['value']),)
+
+    return None
+
+def convert_constant (target_type, content):
+    if (target_type == "string"):
+        return content
+    elif (target_type == "float"):
+        return float(content)
+    elif (target_type == "bool"):
+        return (content == "true")
+    elif (target_type == "int"):
+        return int(content)
+
+    raise ValueError("Unknown Constant type '" + str(target_type) + "'")
+
+# Texts only made of constants are built once, at compile time, and always
+# return the same object (see text_renderer).
+def is_constant_text (computation):
+    category = computation['category']
+
+    if (category == "constant"):
+        return True
+    elif (category == "newline"):
+        return True
+    elif (category == "text"):
+        return all(is_constant_text(c) for c in computation['content'])
+    elif (category == "add_text_effect"):
+        return (
+            all(is_constant_text(c) for c in computation['parameters'])
+            and all(is_constant_text(c) for c in computation['content'])
+        )
+
+    return False
+
+def compile_constant_text (text):
+    value = text_renderer.register_constant(constant_texts, text(None))
+
+    return lambda vm: value
+
+def compile_add_text_effect (computation):
+    name = computation['effect']
+    parameters = [compile_computation(c) for c in computation['parameters']]
+    content = [compile_computation(c) for c in computation['content']]
+
+    def add_text_effect (vm):
+        effect = dict()
+        effect['name'] = name
+        effect['parameters'] = [p(vm) for p in parameters]
+
+        result = dict()
+        result['content'] = [c(vm) for c in content]
+        result['effect'] = effect
+
+        return result
+
+    if (is_constant_text(computation)):
+        return compile_constant_text(add_text_effect)
+
+    return add_text_effect
+
+def compile_cast (computation):
+    origin_type = computation['from']['category']
+    target_type = computation['to']['category']
+    content = compile_computation(computation['content'])
+
+    if (target_type == "string"):
+        if (origin_type == "bool"):
+            # Python would return True and False by default.
+            return lambda vm: "true" if content(vm) else "false"
+        else:
+            return lambda vm: str(content(vm))
+    elif (target_type == "float"):
+        return lambda vm: float(content(vm))
+    elif (target_type == "bool"):
+        if (origin_type == "string"):
+            return lambda vm: (content(vm) == "true")
+        elif (origin_type == "int"):
+            return lambda vm: (content(vm) != 0)
+    elif (target_type == "int"):
+        if (origin_type == "float"):
+            return lambda vm: math.floor(content(vm))
+        else:
+            return lambda vm: int(content(vm))
+
+    return fallback_computation(computation)
+
+def compile_constant (computation):
+    try:
+        value = convert_constant(
+            computation['type']['category'],
+            computation['value']
+        )
+    except ValueError:
+        return fallback_computation(computation)
+
+    return lambda vm: value
+
+def compile_if_else (computation):
+    condition = compile_computation(computation['condition'])
+    if_true = compile_computation(computation['if_true'])
+    if_false = compile_computation(computation['if_false'])
+
+    def if_else (vm):
+        if (condition(vm)):
+            return if_true(vm)
+        else:
+            return if_false(vm)
+
+    return if_else
+
+def compile_instance_of (typedef):
+    if (
+        (typedef['category'] == "structure")
+        and (typedef['name'] != "wild dict")
+    ):
+        name = typedef['name']
+
+        return lambda vm: vm.constructors[name]()
+
+    factory = compile_type(typedef, None)
+
+    return lambda vm: factory()
+
+def compile_new (computation):
+    instance_of = compile_instance_of(computation['target'])
+
+    return lambda vm: vm.allocate(instance_of(vm))
+
+def compile_divide (x, y):
+    def divide (vm):
+        a = x(vm)
+        b = y(vm)
+
+        if (isinstance(a, int)):
+            return a // b
+        else:
+            return a / b
+
+    return divide
+
+def compile_and (x, y):
+    def and_operation (vm):
+        a = x(vm)
+        b = y(vm)
+
+        return a and b
+
+    return and_operation
+
+BINARY_OPERATORS = {
+    "minus": lambda a, b: a - b,
+    "modulo": lambda a, b: a % b,
+    "plus": lambda a, b: a + b,
+    "power": lambda a, b: a ** b,
+    "rand": random.randint,
+    "times": lambda a, b: a * b,
+    "less_than": lambda a, b: a < b,
+    "equals": lambda a, b: a == b,
+}
+
+def compile_operation (computation):
+    operator = computation['operator']
+    x = compile_computation(computation['x'])
+
+    if (operator == "not"):
+        if ('y' in computation):
+            y = compile_computation(computation['y'])
+
+            def not_operation (vm):
+                a = x(vm)
+                y(vm)
+
+                return not a
+
+            return not_operation
+
+        return lambda vm: not x(vm)
+
+    if not ('y' in computation):
+        return fallback_computation(computation)
+
+    y = compile_computation(computation['y'])
+
+    if (operator == "divide"):
+        return compile_divide(x, y)
+    elif (operator == "and"):
+        return compile_and(x, y)
+    elif (operator in BINARY_OPERATORS):
+        function = BINARY_OPERATORS[operator]
+
+        return lambda vm: function(x(vm), y(vm))
+
+    return fallback_computation(computation)
+
+def compile_address (computation):
+    static_address = static_address_of(computation)
+
+    if (static_address is not None):
+        return lambda vm: static_address
+
+    address = compile_computation(computation['address'])
+
+    return lambda vm: memory.to_address(address(vm))
+
+def compile_relative_address (computation):
+    static_address = static_address_of(computation)
+
+    if (static_address is not None):
+        return lambda vm: static_address
+
+    base = compile_computation(computation['base'])
+    extra = compile_computation(computation['extra'])
+
+    return lambda vm: memory.to_address(base(vm)) + (extra(vm),)
+
+def compile_text (computation):
+    content = [compile_computation(c) for c in computation['content']]
+
+    def text (vm):
+        result = dict()
+        result['effect'] = None
+        result['content'] = []
+
+        for c in content:
+            cc = c(vm)
+
+            if (
+                (type(cc) is dict)
+                and ('effect' in cc)
+                and cc['effect'] == None
+            ):
+                result['content'].extend(cc['content'])
+            else:
+                result['content'].append(cc)
+
+        return result
+
+    if (is_constant_text(computation)):
+        return compile_constant_text(text)
+
+    return text
+
+def compile_newline (computation):
+    def newline (vm):
+        result = dict()
+        result['effect'] = None
+        result['content'] = ['\n']
+
+        return result
+
+    return compile_constant_text(newline)
+
+def compile_size (computation):
+    reference = compile_computation(computation['reference'])
+
+    def size (vm):
+        target = vm.memory
+
+        for addr in reference(vm):
+            if (not (addr in target)):
+                return 0
+            else:
+                target = target[addr]
+
+        return len(target)
+
+    return size
+
+def compile_value_of (computation):
+    static_address = static_address_of(computation['reference'])
+
+    if (static_address is not None):
+        if (len(static_address) == 1):
+            name = static_address[0]
+
+            return lambda vm: vm.memory[name]
+
+        def static_value_of (vm):
+            target = vm.memory
+
+            for addr in static_address:
+                target = target[addr]
+
+            return target
+
+        return static_value_of
+
+    reference = compile_computation(computation['reference'])
+
+    def value_of (vm):
+        target = vm.memory
+
+        for addr in reference(vm):
+            target = target[addr]
+
+        return target
+
+    return value_of
+
+def compile_last_choice_index (computation):
+    return lambda vm: vm.last_choice_index
+
+COMPUTATION_COMPILERS = {
+    "add_text_effect": compile_add_text_effect,
+    "cast": compile_cast,
+    "constant": compile_constant,
+    "if_else": compile_if_else,
+    "new": compile_new,
+    "operation": compile_operation,
+    "address": compile_address,
+    "relative_address": compile_relative_address,
+    "text": compile_text,
+    "newline": compile_newline,
+    "size": compile_size,
+    "value_of": compile_value_of,
+    "last_choice_index": compile_last_choice_index,
+}
+
+def compile_computation (computation):
+    compiler = COMPUTATION_COMPILERS.get(computation['category'])
+
+    if (compiler is None):
+        result = fallback_computation(computation)
+    else:
+        result = compiler(computation)
+
+    # Constants are computed at compile time, there is nothing to measure.
+    if (profiling and not is_constant_text(computation)):
+        return profile_computation(computation['category'], result)
+
+    return result
+
+################################################################################
+## INSTRUCTIONS ################################################################
+################################################################################
+# Instructions take the Tonkadur instance and return None to keep running, or
+# the dict that Tonkadur.run has to return.
+
+def fallback_instruction (instruction):
+    def execute (vm):
+        return vm.execute(instruction)
+
+    return execute
+
+def compile_add_text_option (instruction):
+    label = compile_computation(instruction['label'])
+
+    def add_text_option (vm):
+        result = dict()
+        result["category"] = "text_option"
+        result["label"] = label(vm)
+        vm.available_options.append(result)
+        vm.program_counter += 1
+
+    return add_text_option
+
+def compile_add_event_option (instruction):
+    name = instruction["event"]
+    parameters = [compile_computation(p) for p in instruction['parameters']]
+
+    def add_event_option (vm):
+        result = dict()
+        result["category"] = "event_option"
+        result["name"] = name
+        result["parameters"] = [p(vm) for p in parameters]
+        vm.available_options.append(result)
+        vm.program_counter += 1
+
+    return add_event_option
+
+def compile_assert (instruction):
+    condition = compile_computation(instruction['condition'])
+    message = compile_computation(instruction['message'])
+
+    def assert_instruction (vm):
+        if (not condition(vm)):
+            result = dict()
+            result["category"] = "assert"
+            result["line"] = vm.program_counter
+            result["message"] = message(vm)
+            vm.program_counter += 1
+
+            return result
+
+        vm.program_counter += 1
+
+    return assert_instruction
+
+def compile_display (instruction):
+    content = compile_computation(instruction['content'])
+
+    def display (vm):
+        result = dict()
+        result["category"] = "display"
+        result["content"] = content(vm)
+        vm.program_counter += 1
+
+        return result
+
+    return display
+
+def compile_end (instruction):
+    def end (vm):
+        result = dict()
+        result["category"] = "end"
+
+        return result
+
+    return end
+
+def compile_remove (instruction):
+    reference = compile_computation(instruction["reference"])
+
+    def remove (vm):
+        access_full = reference(vm)
+        pre_val = memory.get_writable_parent(vm.memory, access_full)
+
+        del pre_val[access_full[-1]]
+
+        vm.program_counter += 1
+
+    return remove
+
+def compile_resolve_choice (instruction):
+    def resolve_choice (vm):
+        result = dict()
+        result["category"] = "resolve_choice"
+        result["options"] = vm.available_options
+        vm.program_counter += 1
+
+        return result
+
+    return resolve_choice
+
+def compile_set_pc (instruction):
+    value = compile_computation(instruction["value"])
+
+    def set_pc (vm):
+        vm.program_counter = value(vm)
+
+    return set_pc
+
+def compile_set_value (instruction):
+    value = compile_computation(instruction["value"])
+    static_address = static_address_of(instruction["reference"])
+
+    # The value is computed before walking the path, so that assigning a
+    # container within itself stores what it was before the assignment.
+    if (static_address is not None):
+        path = static_address[:-1]
+        last_access = static_address[-1]
+
+        def static_set_value (vm):
+            result = memory.share(value(vm))
+            current_val = vm.memory
+
+            for access in path:
+                current_val = memory.get_writable(current_val, access)
+
+            current_val[last_access] = result
+            vm.program_counter += 1
+
+        return static_set_value
+
+    reference = compile_computation(instruction["reference"])
+
+    def set_value (vm):
+        access_full = reference(vm)
+        result = memory.share(value(vm))
+        current_val = memory.get_writable_parent(vm.memory, access_full)
+
+        current_val[access_full[-1]] = result
+        vm.program_counter += 1
+
+    return set_value
+
+def compile_initialize (instruction):
+    reference = compile_computation(instruction["reference"])
+    instance_of = compile_instance_of(instruction["type"])
+
+    def initialize (vm):
+        access_full = reference(vm)
+        current_val = memory.get_writable_parent(vm.memory, access_full)
+
+        current_val[access_full[-1]] = instance_of(vm)
+        vm.program_counter += 1
+
+    return initialize
+
+def compile_prompt (instruction):
+    category = instruction['category']
+    min_value = compile_computation(instruction['min'])
+    max_value = compile_computation(instruction['max'])
+    label = compile_computation(instruction['label'])
+    target = compile_computation(instruction['target'])
+
+    def prompt (vm):
+        result = dict()
+        result["category"] = category
+        result["min"] = min_value(vm)
+        result["max"] = max_value(vm)
+        result["label"] = label(vm)
+
+        vm.memorized_target = target(vm)
+        vm.program_counter += 1
+
+        return result
+
+    return prompt
+
+INSTRUCTION_COMPILERS = {
+    "add_text_option": compile_add_text_option,
+    "add_event_option": compile_add_event_option,
+    "assert": compile_assert,
+    "display": compile_display,
+    "end": compile_end,
+    "remove": compile_remove,
+    "resolve_choice": compile_resolve_choice,
+    "set_pc": compile_set_pc,
+    "set_value": compile_set_value,
+    "initialize": compile_initialize,
+    "prompt_integer": compile_prompt,
+    "prompt_string": compile_prompt,
+}
+
+def compile_instruction (instruction):
+    compiler = INSTRUCTION_COMPILERS.get(instruction['category'])
+
+    if (compiler is None):
+        return fallback_instruction(instruction)
+
+    return compiler(instruction)
+
+################################################################################
+## PROFILING ###################################################################
+################################################################################
+# When set, compile_code produces code that reports to vm.profiler (see
+# profiler.py), which must then be set.
+profiling = False
+# Where compile_code registers constant texts (see text_renderer).
+constant_texts = None
+
+def profile_computation (category, computation):
+    perf_counter = time.perf_counter
+
+    def profiled_computation (vm):
+        start = perf_counter()
+        result = computation(vm)
+        vm.profiler.add_computation(category, (perf_counter() - start))
+
+        return result
+
+    return profiled_computation
+
+def profile_instruction (line, category, instruction):
+    perf_counter = time.perf_counter
+
+    def profiled_instruction (vm):
+        start = perf_counter()
+        result = instruction(vm)
+        vm.profiler.add_instruction(line, category, (perf_counter() - start))
+
+        return result
+
+    return profiled_instruction
+
+# 'program_constant_texts' has to live as long as the code: it is where the
+# code's constant texts are rendered once.
+def compile_code (code, program_constant_texts, profiled = False):
+    global profiling
+    global constant_texts
+
+    constant_texts = program_constant_texts
+
+    try:
+        if (not profiled):
+            return [compile_instruction(instruction) for instruction in code]
+
+        profiling = True
+
+        return [
+            profile_instruction(
+                line,
+                instruction['category'],
+                compile_instruction(instruction)
+            )
+            for (line, instruction) in enumerate(code)
+        ]
+    finally:
+        profiling = False
+        constant_texts = None
@@ -0,0 +1,127 @@
+import asyncio
+
+################################################################################
+## FAKE DISCORD OBJECTS ########################################################
+################################################################################
+# The few parts of discord.py that main.on_message relies on, so that the bot
+# can be driven locally (see loadtest.py). Messages sent by the bot are handed
+# to whoever waits for a reply to the message they reference.
+class FakeUser:
+    def __init__ (self, user_id, name, bot = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.discriminator = "0000"
+        self.bot = bot
+
+class FakeReference:
+    def __init__ (self, message_id):
+        self.message_id = message_id
+
+class FakeMessage:
+    def __init__ (
+        self,
+        message_id,
+        channel,
+        author,
+        content,
+        reference = None,
+        mentions = None
+    ):
+        self.id = message_id
+        self.channel = channel
+        self.guild = None
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.reference = reference
+        self.mentions = mentions or []
+
+class FakeChannel:
+    def __init__ (self, client, name):
+        self.client = client
+        self.id = client.generate_message_id()
+        self.name = name
+
+    async def send (self, content, reference = None):
+        if (self.client.send_delay > 0):
+            await asyncio.sleep(self.client.send_delay)
+
+        result = FakeMessage(
+            self.client.generate_message_id(),
+            self,
+            self.client.user,
+            content,
+            (None if (reference is None) else FakeReference(reference.id))
+        )
+        self.client.sent_messages += 1
+
+        if (reference is not None):
+            waiter = self.client.reply_waiters.pop(reference.id, None)
+
+            if ((waiter is not None) and not waiter.done()):
+                waiter.set_result(result)
+
+        return result
+
+class FakeClient:
+    # 'on_message' is the bot's handler, 'send_delay' (in seconds) simulates
+    # the time Discord takes to accept a message.
+    def __init__ (self, on_message, send_delay = 0):
+        self.on_message = on_message
+        self.send_delay = send_delay
+        self.user = FakeUser(0, "Storyteller", True)
+        self.next_message_id = 1
+        self.sent_messages = 0
+        self.reply_waiters = dict()
+
+    def generate_message_id (self):
+        result = self.next_message_id
+        self.next_message_id += 1
+
+        return result
+
+    def create_channel (self, name):
+        return FakeChannel(self, name)
+
+    # Delivers a message to the bot, as Discord would: in its own task.
+    def post (self, channel, author, content, reply_to = None):
+        mentions = []
+
+        if (content.startswith("@" + self.user.name)):
+            mentions.append(self.user)
+
+        message = FakeMessage(
+            self.generate_message_id(),
+            channel,
+            author,
+            content,
+            (None if (reply_to is None) else FakeReference(reply_to.id)),
+            mentions
+        )
+
+        asyncio.get_running_loop().create_task(self.on_message(message))
+
+        return message
+
+    # Posts a message, then waits for the bot to reply to it. Returns None if
+    # it did not reply within 'timeout' seconds.
+    async def post_and_wait (
+        self,
+        channel,
+        author,
+        content,
+        reply_to = None,
+        timeout = None
+    ):
+        # The bot only gets the message once this task awaits.
+        message = self.post(channel, author, content, reply_to)
+        waiter = asyncio.get_running_loop().create_future()
+        self.reply_waiters[message.id] = waiter
+
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self.reply_waiters.pop(message.id, None)
+
+            return None
@@ -0,0 +1,238 @@
+import asyncio
+import argparse
+import sys
+import time
+
+import backends
+import narration
+import tonkadur
+
+################################################################################
+## MAIN ########################################################################
+################################################################################
+parser = argparse.ArgumentParser(
+    description = (
+        "Runs Tonkadur narrations without Discord, answering them from a script"
+    )
+)
+
+parser.add_argument(
+    'story_file',
+    type = str,
+    help = 'Compiled story (Wyrd JSON) to narrate.',
+)
+
+parser.add_argument(
+    '-s',
+    '--script',
+    type = str,
+    default = '-',
+    help = (
+        'File with one answer per line (integers, strings or choice indices).'
+        ' Defaults to the standard input.'
+    ),
+)
+
+parser.add_argument(
+    '-c',
+    '--narrations',
+    type = int,
+    default = 1,
+    help = 'Number of narrations running the same script concurrently.',
+)
+
+parser.add_argument(
+    '-q',
+    '--quiet',
+    action = 'store_true',
+    help = 'Only prints the summary, not the output of each step.',
+)
+
+parser.add_argument(
+    '-b',
+    '--instruction-budget',
+    type = int,
+    default = narration.Narration.instruction_budget,
+    help = (
+        'Instructions a narration runs before letting the others run.'
+    ),
+)
+
+parser.add_argument(
+    '-m',
+    '--max-instructions',
+    type = int,
+    default = narration.Narration.max_instructions_per_input,
+    help = (
+        'Instructions a narration can run without requiring any input before'
+        ' being aborted.'
+    ),
+)
+
+parser.add_argument(
+    '-g',
+    '--gc-threshold',
+    type = int,
+    default = tonkadur.Tonkadur.collection_threshold,
+    help = (
+        'Allocations after which a narration frees its unreachable objects.'
+    ),
+)
+
+parser.add_argument(
+    '--no-optimize',
+    action = 'store_true',
+    help = 'Runs the story as it is written, without optimizing it first.',
+)
+
+parser.add_argument(
+    '-w',
+    '--workers',
+    type = int,
+    default = 0,
+    help = (
+        'Number of worker processes running the narrations (0: run them in'
+        ' this process).'
+    ),
+)
+
+class StoryFile:
+    def __init__ (self, filename):
+        self.name = filename
+        self.filename = filename
+
+    def get_name (self):
+        return self.name
+
+    def get_filename (self):
+        return self.filename
+
+class Statistics:
+    def __init__ (self):
+        self.steps = 0
+        self.ended = 0
+        self.failed = 0
+
+def print_step (prefix, answer, output):
+    if (answer is not None):
+        print(prefix + "> " + answer)
+
+    for line in output.split("\n"):
+        print(prefix + line)
+
+async def narrate (backend, story_file, script, index, quiet, statistics):
+    prefix = "" if (index is None) else ("[" + str(index) + "] ")
+    current_narration = backend.create_narration(story_file, "headless", index)
+
+    try:
+        output = await backend.start(current_narration)
+        statistics.steps += 1
+
+        if (not quiet):
+            print_step(prefix, None, output)
+
+        for answer in script:
+            if (current_narration.has_ended()):
+                break
+
+            output = await backend.answer(
+                current_narration,
+                answer,
+                "headless",
+                index
+            )
+            statistics.steps += 1
+
+            if (not quiet):
+                print_step(prefix, answer, output)
+
+        if (current_narration.has_ended()):
+            statistics.ended += 1
+    except Exception as e:
+        statistics.failed += 1
+        print(prefix + "[E] " + str(e), file = sys.stderr)
+    finally:
+        backend.release(current_narration)
+        current_narration.finalize()
+
+def read_answers (source):
+    for line in source:
+        yield line.rstrip("\n")
+
+async def run (args, backend):
+    story_file = StoryFile(args.story_file)
+    statistics = Statistics()
+
+    if (args.script == '-'):
+        source = sys.stdin
+    else:
+        source = open(args.script, 'r')
+
+    start = time.perf_counter()
+
+    with source:
+        if (args.narrations == 1):
+            # Answers are read as they are needed, so that the standard input
+            # can be used interactively.
+            await narrate(
+                backend,
+                story_file,
+                read_answers(source),
+                None,
+                args.quiet,
+                statistics
+            )
+        else:
+            script = list(read_answers(source))
+
+            await asyncio.gather(
+                *[
+                    narrate(
+                        backend,
+                        story_file,
+                        script,
+                        i,
+                        args.quiet,
+                        statistics
+                    )
+                    for i in range(args.narrations)
+                ]
+            )
+
+    await backend.wait_for_releases()
+
+    duration = time.perf_counter() - start
+
+    print(
+        "[I] "
+        + str(args.narrations)
+        + " narrations ("
+        + str(statistics.ended)
+        + " ended, "
+        + str(statistics.failed)
+        + " failed), "
+        + str(statistics.steps)
+        + " steps in "
+        + ("%.3f" % duration)
+        + "s ("
+        + ("%.1f" % (statistics.steps / duration))
+        + " steps/s).",
+        file = sys.stderr
+    )
+
+args = parser.parse_args()
+
+narration.Narration.instruction_budget = args.instruction_budget
+narration.Narration.max_instructions_per_input = args.max_instructions
+narration.Narration.optimize = not args.no_optimize
+tonkadur.Tonkadur.collection_threshold = args.gc_threshold
+
+if (args.workers > 0):
+    backend = backends.ProcessBackend(args.workers)
+else:
+    backend = backends.LocalBackend()
+
+try:
+    asyncio.run(run(args, backend))
+finally:
+    backend.close()
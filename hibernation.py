@@ -0,0 +1,135 @@
+import collections
+import os
+import tempfile
+import time
+
+################################################################################
+## HIBERNATION #################################################################
+################################################################################
+# Keeps at most 'max_resident' narrations in memory. Past that, the least
+# recently used ones are hibernated: their VM state is written to a file in
+# 'directory' and dropped, the narration itself staying registered as a stub
+# (see Narration.hibernate). They are rehydrated when they are next used.
+#
+# This only decides which narrations to hibernate. Hibernating and rehydrating
+# is done by the backend, through each narration's actor, so that it never
+# happens while the narration is handling a request.
+EXTENSION = ".tks"
+
+class Hibernation:
+    def __init__ (self, max_resident, directory = None):
+        self.max_resident = max_resident
+
+        self.is_temporary = (directory is None)
+
+        if (self.is_temporary):
+            directory = tempfile.mkdtemp(prefix = "tonkadur-hibernation-")
+        else:
+            os.makedirs(directory, exist_ok = True)
+
+        self.directory = directory
+        # Left by a previous run: narrations are restored from the journal.
+        self.remove_files()
+        # Narration ID -> narration, least recently used first.
+        self.resident_narrations = collections.OrderedDict()
+        # Narration ID -> narration, hibernated or about to be.
+        self.hibernated_narrations = dict()
+        self.hibernations = 0
+        self.rehydrations = 0
+        # Time taken by the last rehydrations, in seconds.
+        self.rehydration_latencies = collections.deque(maxlen = 1000)
+
+    def get_filename (self, narration):
+        return os.path.join(
+            self.directory,
+            "narration-" + str(narration.get_id()) + EXTENSION
+        )
+
+    def is_hibernated (self, narration):
+        return (narration.get_id() in self.hibernated_narrations)
+
+    # Unlike 'use', does not hibernate anything (see main.restore_state).
+    def add_resident (self, narration):
+        self.resident_narrations[narration.get_id()] = narration
+
+    # Returns the narrations to hibernate so that at most 'max_resident'
+    # remain.
+    def use (self, narration):
+        narration_id = narration.get_id()
+
+        self.hibernated_narrations.pop(narration_id, None)
+        self.resident_narrations[narration_id] = narration
+        self.resident_narrations.move_to_end(narration_id)
+
+        result = []
+
+        while (len(self.resident_narrations) > self.max_resident):
+            (victim_id, victim) = self.resident_narrations.popitem(last = False)
+            self.hibernated_narrations[victim_id] = victim
+            result.append(victim)
+
+        return result
+
+    # For narrations that could not be hibernated (see Narration.hibernate).
+    # They only count as resident again, without anything being hibernated in
+    # their place until the next use.
+    def cancel_hibernation (self, narration):
+        narration_id = narration.get_id()
+
+        if (self.hibernated_narrations.pop(narration_id, None) is not None):
+            self.resident_narrations[narration_id] = narration
+
+    def add_hibernation (self):
+        self.hibernations += 1
+
+    def forget (self, narration):
+        self.resident_narrations.pop(narration.get_id(), None)
+        self.hibernated_narrations.pop(narration.get_id(), None)
+
+    # 'start' is when rehydrating began (time.perf_counter()).
+    def add_rehydration (self, start):
+        self.rehydrations += 1
+        self.rehydration_latencies.append(time.perf_counter() - start)
+
+    def remove_files (self):
+        for filename in os.listdir(self.directory):
+            if (filename.endswith(EXTENSION)):
+                os.remove(os.path.join(self.directory, filename))
+
+    # Hibernated narrations are lost: this is only for when the bot stops.
+    def close (self):
+        self.remove_files()
+
+        if (self.is_temporary):
+            os.rmdir(self.directory)
+
+    def to_string (self):
+        latencies = sorted(self.rehydration_latencies)
+        result = (
+            "Hibernation: "
+            + str(len(self.resident_narrations))
+            + " resident narrations (at most "
+            + str(self.max_resident)
+            + "), "
+            + str(len(self.hibernated_narrations))
+            + " hibernated, "
+            + str(self.hibernations)
+            + " hibernations and "
+            + str(self.rehydrations)
+            + " rehydrations so far."
+        )
+
+        if (len(latencies) > 0):
+            result += (
+                "\nRehydration latency: p50 "
+                + ("%.2f" % (latencies[len(latencies) // 2] * 1000))
+                + "ms, p99 "
+                + ("%.2f" % (latencies[(len(latencies) * 99) // 100] * 1000))
+                + "ms, max "
+                + ("%.2f" % (latencies[-1] * 1000))
+                + "ms (last "
+                + str(len(latencies))
+                + ")."
+            )
+
+        return result
@@ -0,0 +1,312 @@
+import asyncio
+import argparse
+import contextlib
+import json
+import os
+import random
+import time
+
+import fake_discord
+import main
+
+################################################################################
+## MAIN ########################################################################
+################################################################################
+parser = argparse.ArgumentParser(
+    description = (
+        "Load tests the bot's message handling against a local stand-in for"
+        " Discord"
+    )
+)
+
+parser.add_argument(
+    'story_files',
+    type = str,
+    nargs = '+',
+    help = 'Compiled stories (Wyrd JSON), spread among the simulated users.',
+)
+
+parser.add_argument(
+    '-s',
+    '--script',
+    type = str,
+    help = (
+        'File with the answers each user gives, one per line (default: "0"'
+        ' for each answer).'
+    ),
+)
+
+parser.add_argument(
+    '-u',
+    '--users',
+    type = int,
+    default = 100,
+    help = 'Number of simulated users, each starting its own narration.',
+)
+
+parser.add_argument(
+    '-n',
+    '--answers',
+    type = int,
+    default = 10,
+    help = 'Number of answers given by each user, when there is no script.',
+)
+
+parser.add_argument(
+    '-t',
+    '--think-time',
+    type = float,
+    default = 0.1,
+    help = 'Mean time, in seconds, a user waits before answering.',
+)
+
+parser.add_argument(
+    '-r',
+    '--ramp-up',
+    type = float,
+    default = 1.0,
+    help = 'Time, in seconds, over which the users start their narrations.',
+)
+
+parser.add_argument(
+    '-d',
+    '--send-delay',
+    type = float,
+    default = 0.0,
+    help = 'Time, in seconds, the fake Discord takes to accept a message.',
+)
+
+parser.add_argument(
+    '--timeout',
+    type = float,
+    default = 30.0,
+    help = 'Time, in seconds, after which a user gives up on a reply.',
+)
+
+main.add_bot_arguments(parser)
+
+parser.add_argument(
+    '-j',
+    '--json',
+    type = str,
+    help = 'Also writes the results to this file, as JSON.',
+)
+
+parser.add_argument(
+    '-v',
+    '--verbose',
+    action = 'store_true',
+    help = 'Keeps what the bot prints (hidden by default).',
+)
+
+class Measures:
+    def __init__ (self):
+        self.command_latencies = []
+        self.answer_latencies = []
+        self.loop_lags = []
+        self.timeouts = 0
+        self.ended_narrations = 0
+        self.max_active_narrations = 0
+        self.is_running = True
+
+def get_percentiles (values):
+    result = dict()
+
+    if (len(values) == 0):
+        return result
+
+    values = sorted(values)
+
+    for percentile in (50, 90, 99):
+        index = int(round((percentile / 100) * (len(values) - 1)))
+        result["p" + str(percentile) + "_ms"] = values[index] * 1000
+
+    result["max_ms"] = values[-1] * 1000
+
+    return result
+
+# Measures how late the event loop wakes up a task sleeping for 'interval'.
+async def monitor_loop (measures, interval):
+    loop = asyncio.get_running_loop()
+
+    while (measures.is_running):
+        start = loop.time()
+        await asyncio.sleep(interval)
+        measures.loop_lags.append(max(0, loop.time() - start - interval))
+        measures.max_active_narrations = max(
+            measures.max_active_narrations,
+            main.stories_and_narrations.get_narration_count()
+        )
+
+def has_ended (reply):
+    return ("This narration has now ended." in reply.content)
+
+async def simulate_user (client, index, story_index, script, args, measures):
+    channel = client.create_channel("user-" + str(index))
+    author = fake_discord.FakeUser(1000 + index, "player" + str(index))
+
+    await asyncio.sleep(random.uniform(0, args.ramp_up))
+
+    start = time.perf_counter()
+    reply = await client.post_and_wait(
+        channel,
+        author,
+        ("@Storyteller start " + str(story_index)),
+        timeout = args.timeout
+    )
+
+    if (reply is None):
+        measures.timeouts += 1
+
+        return
+
+    measures.command_latencies.append(time.perf_counter() - start)
+
+    for answer in script:
+        if (has_ended(reply)):
+            break
+
+        if (args.think_time > 0):
+            await asyncio.sleep(random.expovariate(1 / args.think_time))
+
+        start = time.perf_counter()
+        reply = await client.post_and_wait(
+            channel,
+            author,
+            answer,
+            reply_to = reply,
+            timeout = args.timeout
+        )
+
+        if (reply is None):
+            measures.timeouts += 1
+
+            return
+
+        measures.answer_latencies.append(time.perf_counter() - start)
+
+    if (has_ended(reply)):
+        measures.ended_narrations += 1
+
+async def run (args, script):
+    client = fake_discord.FakeClient(main.on_message, args.send_delay)
+    measures = Measures()
+    monitor = asyncio.get_running_loop().create_task(
+        monitor_loop(measures, 0.01)
+    )
+
+    start = time.perf_counter()
+
+    await asyncio.gather(
+        *[
+            simulate_user(
+                client,
+                i,
+                (i % len(args.story_files)),
+                script,
+                args,
+                measures
+            )
+            for i in range(args.users)
+        ]
+    )
+
+    duration = time.perf_counter() - start
+    measures.is_running = False
+    await monitor
+    await main.close_narration_actors()
+    await main.backend.wait_for_releases()
+    await main.wait_for_journal_compaction()
+
+    result = dict()
+    result['users'] = args.users
+    result['duration_s'] = duration
+    result['bot_messages'] = client.sent_messages
+    result['bot_messages_per_second'] = client.sent_messages / duration
+    result['timeouts'] = measures.timeouts
+    result['ended_narrations'] = measures.ended_narrations
+    result['max_active_narrations'] = measures.max_active_narrations
+    result['command_latency'] = get_percentiles(measures.command_latencies)
+    result['answer_latency'] = get_percentiles(measures.answer_latencies)
+    result['loop_lag'] = get_percentiles(measures.loop_lags)
+
+    return result
+
+def format_percentiles (name, percentiles):
+    if (len(percentiles) == 0):
+        return name + ": none"
+
+    return (
+        name
+        + ": p50 "
+        + ("%.2f" % percentiles['p50_ms'])
+        + "ms, p90 "
+        + ("%.2f" % percentiles['p90_ms'])
+        + "ms, p99 "
+        + ("%.2f" % percentiles['p99_ms'])
+        + "ms, max "
+        + ("%.2f" % percentiles['max_ms'])
+        + "ms"
+    )
+
+args = parser.parse_args()
+
+if (args.script is None):
+    script = ["0"] * args.answers
+else:
+    with open(args.script, 'r') as f:
+        script = [line.rstrip("\n") for line in f]
+
+main.configure(args)
+
+for story_filename in args.story_files:
+    story = main.StoryFile(story_filename)
+    main.stories_and_narrations.add_story(story)
+    main.journal_story(story)
+
+try:
+    if (args.verbose):
+        result = asyncio.run(run(args, script))
+    else:
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                result = asyncio.run(run(args, script))
+finally:
+    main.backend.close()
+
+    if (main.state_journal is not None):
+        main.state_journal.close()
+
+    if (main.narration_hibernation is not None):
+        main.narration_hibernation.close()
+
+print(
+    str(result['users'])
+    + " users, "
+    + str(result['bot_messages'])
+    + " bot messages in "
+    + ("%.2f" % result['duration_s'])
+    + "s ("
+    + ("%.1f" % result['bot_messages_per_second'])
+    + "/s), "
+    + str(result['timeouts'])
+    + " timeouts, "
+    + str(result['ended_narrations'])
+    + " ended narrations, at most "
+    + str(result['max_active_narrations'])
+    + " active narrations."
+)
+print(format_percentiles("Command latency", result['command_latency']))
+print(format_percentiles("Answer latency", result['answer_latency']))
+print(format_percentiles("Event loop lag", result['loop_lag']))
+print(main.outbox.to_string())
+
+if (main.state_journal is not None):
+    print(main.state_journal.to_string())
+
+if (main.narration_hibernation is not None):
+    print(main.narration_hibernation.to_string())
+
+if (args.json is not None):
+    with open(args.json, 'w') as f:
+        json.dump(result, f, indent = 1)
@@ -1,13 +1,20 @@
 import discord
 import asyncio
 import argparse
+import heapq
 import socket
-import threading
-from threading import Lock
 import sys
 import time
 
+import actors
+import artifact
+import backends
+import hibernation
 import narration
+import outbound
+import persistence
+import registry
+import tonkadur
 
 ################################################################################
 ## MAIN ########################################################################
@@ -40,26 +47,242 @@ parser.add_argument(
     help = 'Administrator tags, space separated.',
 )
 
-args = parser.parse_args()
+# Options changing how the bot behaves, shared with the load test (see
+# loadtest.py).
+def add_bot_arguments (target_parser):
+    target_parser.add_argument(
+        '-b',
+        '--instruction-budget',
+        type = int,
+        default = narration.Narration.instruction_budget,
+        help = (
+            'Instructions a narration runs before letting the bot handle other'
+            ' messages.'
+        ),
+    )
+
+    target_parser.add_argument(
+        '-m',
+        '--max-instructions',
+        type = int,
+        default = narration.Narration.max_instructions_per_input,
+        help = (
+            'Instructions a narration can run without requiring any input'
+            ' before being aborted.'
+        ),
+    )
+
+    target_parser.add_argument(
+        '-g',
+        '--gc-threshold',
+        type = int,
+        default = tonkadur.Tonkadur.collection_threshold,
+        help = (
+            'Allocations after which a narration frees its unreachable objects.'
+        ),
+    )
+
+    target_parser.add_argument(
+        '--max-narration-memory',
+        type = int,
+        help = (
+            'Bytes of memory a narration can use before being aborted (default:'
+            ' no limit).'
+        ),
+    )
+
+    target_parser.add_argument(
+        '--max-user-memory',
+        type = int,
+        help = (
+            'Bytes of memory the narrations started by a user can use'
+            ' altogether. The narration going past it is aborted (default: no'
+            ' limit).'
+        ),
+    )
+
+    target_parser.add_argument(
+        '--no-optimize',
+        action = 'store_true',
+        help = (
+            'Runs stories as they are written, without optimizing them first'
+            ' (nor using or writing precompiled stories).'
+        ),
+    )
+
+    target_parser.add_argument(
+        '-p',
+        '--artifact-directory',
+        type = str,
+        help = (
+            'Directory where precompiled stories are written (default: next to'
+            ' their story file).'
+        ),
+    )
+
+    target_parser.add_argument(
+        '-S',
+        '--state-directory',
+        type = str,
+        help = (
+            'Directory where the bot keeps its state (administrators, stories'
+            ' and narrations) across restarts (default: nothing is kept).'
+        ),
+    )
+
+    target_parser.add_argument(
+        '--compaction-threshold',
+        type = int,
+        default = (8 * 1024 * 1024),
+        help = (
+            'Size, in bytes, the log of state changes has to reach before being'
+            ' compacted.'
+        ),
+    )
+
+    target_parser.add_argument(
+        '--max-resident-narrations',
+        type = int,
+        help = (
+            'Narrations kept in memory. The least recently used ones past that'
+            ' are hibernated to disk until they are next used (default: all are'
+            ' kept in memory).'
+        ),
+    )
 
-intents = discord.Intents.default()
-intents.members = True
+    target_parser.add_argument(
+        '--hibernation-directory',
+        type = str,
+        help = (
+            'Directory where hibernated narrations are written (default: a'
+            ' temporary directory).'
+        ),
+    )
+
+    target_parser.add_argument(
+        '--send-limit',
+        type = int,
+        default = 5,
+        help = 'Messages the bot sends to a channel per send window.',
+    )
 
-client = discord.Client(intents = intents)
+    target_parser.add_argument(
+        '--send-window',
+        type = float,
+        default = 5.0,
+        help = 'Duration, in seconds, of the send window.',
+    )
+
+    target_parser.add_argument(
+        '-w',
+        '--workers',
+        type = int,
+        default = 0,
+        help = (
+            'Number of worker processes running the narrations (0: run them in'
+            ' the bot\'s process).'
+        ),
+    )
+
+add_bot_arguments(parser)
+
+# Set up by configure, so that importing this module does not start anything
+# (see fake_discord.py).
+args = None
+backend = None
+client = None
+outbox = None
+state_journal = None
+narration_hibernation = None
+# Task writing the journal's compaction, see compact_journal.
+journal_compaction = None
+
+def configure (new_args):
+    global args
+    global backend
+    global outbox
+    global state_journal
+    global narration_hibernation
+
+    args = new_args
+
+    # Before the workers are forked and narrations restored, as both load
+    # programs.
+    artifact.directory = args.artifact_directory
+    narration.Narration.instruction_budget = args.instruction_budget
+    narration.Narration.max_instructions_per_input = args.max_instructions
+    narration.Narration.max_memory = args.max_narration_memory
+    narration.Narration.optimize = not args.no_optimize
+    tonkadur.Tonkadur.collection_threshold = args.gc_threshold
+
+    if (args.workers > 0):
+        backend = backends.ProcessBackend(args.workers)
+    else:
+        backend = backends.LocalBackend()
+
+    outbox = outbound.Outbox(
+        args.send_limit,
+        args.send_window,
+        lambda narration, message: replace_narration_post_id(
+            narration,
+            message.id
+        )
+    )
+
+    if (args.max_resident_narrations is not None):
+        narration_hibernation = hibernation.Hibernation(
+            args.max_resident_narrations,
+            args.hibernation_directory
+        )
+
+    if (args.state_directory is not None):
+        state_journal = persistence.Journal(
+            args.state_directory,
+            narration.Narration.apply_checkpoint_changes,
+            args.compaction_threshold
+        )
+        restore_state()
+
+# Lets every actor handle what was submitted to it, so that none of their tasks
+# is still pending when the event loop closes.
+async def close_narration_actors ():
+    closing = list(narration_actors.values()) + list(closing_narration_actors)
+
+    await asyncio.gather(*[actor.join() for actor in closing])
+
+class StorytellerClient (discord.Client):
+    async def close (self):
+        await close_narration_actors()
+        await backend.wait_for_releases()
+        await wait_for_journal_compaction()
+        await super().close()
+
+def create_client ():
+    intents = discord.Intents.default()
+    intents.members = True
+
+    result = StorytellerClient(intents = intents)
+    result.event(on_message)
+    result.event(on_ready)
+
+    return result
 
 administrators = dict()
-active_narrations_by_post = dict()
-active_narrations_by_id = dict()
-available_stories = []
-orphaned_narrations = []
-paused_narrations = []
+stories_and_narrations = registry.Registry()
+# Narration ID -> actors.NarrationActor
+narration_actors = dict()
+# Actors of deleted narrations that still have requests to handle.
+closing_narration_actors = set()
 
 class StoryFile:
     def __init__ (self, filename):
         self.name = "Unnamed Story"
         self.description = "No description."
         self.filename = filename
-        self.narrations = []
+        # Set by the registry.
+        self.id = None
+        # Narration ID -> narration, kept by the registry.
+        self.narrations = dict()
 
     def get_name (self):
         return self.name
@@ -73,16 +296,19 @@ def get_command_help ():
 https://github.com/nsensfel/tonkadir-discord-bot
 
 The '+' symbol indicates that the command can be applied to multiple values at
-once. This feature is not yet implemented.
+once (e.g. "end 3 5 8"), with a single reply for all of them.
+
+Narrations are listed 15 per page. PAGE is optional and starts at 1.
 
 Available commands (global):
-- available             Provides a list of available stories.
-- active                Provides a list of active narrations.
-- paused                Provides a list of paused narrations.
-- start INDEX           Starts the story of index INDEX.
-- administrators           Lists all administrators.
-- orphaned              Lists active narrations from deleted/disabled stories.
-- narrations_of INDEX   Lists active narrations for story INDEX.
+- available                     Provides a list of available stories.
+- active [PAGE]                 Provides a list of active narrations.
+- paused [PAGE]                 Provides a list of paused narrations.
+- start INDEX                   Starts the story of index INDEX.
+- administrators                Lists all administrators.
+- orphaned [PAGE]               Lists active narrations from deleted/disabled stories.
+- narrations_of INDEX [PAGE]    Lists active narrations for story INDEX.
+- narrations_by USER_ID [PAGE]  Lists active narrations started by USER_ID.
 
 Available commands (narration initiator or admin):
 - end INDEX+    Ends the narration of index INDEX
@@ -98,139 +324,485 @@ Available commands (admin):
 - disable_story_file STORY_FILE Removes stories that use this STORY_FILE (does not remove narrations).
 - set_story_name INDEX NAME     Sets name of story at INDEX to NAME.
 - set_story_desc INDEX DESC     Sets description of story at INDEX to DESC.
+- profile narration ID [ACTION] Profiles narration ID. ACTION is start, stop or
+                                show (default: show the top entries).
+- profile story INDEX [ACTION]  Same for all narrations of story INDEX.
+- outbox                        Shows the queue of messages waiting to be sent.
+- journal                       Shows how much of the bot's state is kept.
+- hibernation                   Shows how many narrations are kept in memory.
+- memory [ID]                   Shows the memory used by narrations, or by narration ID.
 """
 
 ################################################################################
-### ADMIN COMMANDS #############################################################
+### PERSISTENCE ################################################################
 ################################################################################
-def handle_add_admin_command (server, user_tag, requester_name, requester_id):
+# Every change to the state below is also written to the journal, if there is
+# one, so that restore_state can bring it back after a restart.
+def set_administrator (user_id, user_tag):
     global administrators
 
-    if not (requester_id in administrators):
-        return ("Denied. You are not registered as an administrator.", None)
+    if (user_tag is None):
+        administrators.pop(user_id, None)
+    else:
+        administrators[user_id] = user_tag
+
+    if (state_journal is not None):
+        state_journal.set_administrator(user_id, user_tag)
+
+def journal_story (story, is_listed = True):
+    if (state_journal is not None):
+        state_journal.set_story(
+            story.id,
+            story.filename,
+            story.name,
+            story.description,
+            is_listed
+        )
 
-    user_data = user_tag.split('#')
+def journal_narration (narration):
+    global stories_and_narrations
 
-    if (len(user_data) != 2):
-        return ("Invalid user tag. Use something like nsensfel#0001.", None)
+    if ((state_journal is None) or narration.has_been_finalized()):
+        return
 
-    user = discord.utils.get(
-        server.members,
-        name = user_data[0],
-        discriminator = user_data[1]
+    state_journal.set_narration(
+        narration.get_id(),
+        narration.get_story_file().id,
+        narration.get_initiator_name(),
+        narration.get_initiator_id(),
+        narration.get_is_paused(),
+        stories_and_narrations.is_orphaned(narration),
+        narration.get_last_post_id()
     )
 
-    if (user is None):
-        return ("Unknown user '" + user_tag + "'.", None)
+# Its narrations are orphaned.
+def remove_story (story):
+    global stories_and_narrations
 
-    if (user.id in administrators):
-        return ("This user was already an administrator.", None)
+    stories_and_narrations.remove_story(story)
+    journal_story(story, False)
 
-    administrators[user.id] = user_tag
+    for narration in story.narrations.values():
+        journal_narration(narration)
 
-    return (user_tag + " is now an administrator.", None)
+def remove_stories_of_file (filename):
+    global stories_and_narrations
 
-def handle_rm_admin_command (server, user_tag, requester_name, requester_id):
-    global administrators
+    result = list(stories_and_narrations.get_stories_of_file(filename))
 
-    if not (requester_id in administrators):
-        return ("Denied. You are not registered as an administrator.", None)
+    for story in result:
+        remove_story(story)
+
+    return result
+
+# Runs 'function(narration, *args)', which returns what the narration says,
+# then saves the narration's checkpoint. Submitted to the narration's actor, so
+# that nothing else runs on the narration in between.
+async def run_and_checkpoint (function, narration, *args):
+    result = await run_resident(function, narration, *args)
+    result += enforce_initiator_memory_limit(narration)
+
+    if (
+        (state_journal is not None)
+        and not (narration.has_been_finalized() or narration.has_ended())
+    ):
+        # Once the journal has a checkpoint, only the changes to it are saved.
+        is_full = not state_journal.has_checkpoint(narration.get_id())
+        data = await backend.checkpoint(narration, is_full)
+
+        # It may have been ended meanwhile.
+        if (not narration.has_been_finalized()):
+            if (is_full):
+                state_journal.set_checkpoint(narration.get_id(), data)
+            else:
+                state_journal.update_checkpoint(narration.get_id(), data)
+
+            start_journal_compaction()
+
+    return result
+
+# Compacting reads and writes every checkpoint, so it is done in another
+# thread, changes still being logged meanwhile.
+def start_journal_compaction ():
+    global journal_compaction
+
+    if (state_journal.needs_compaction()):
+        journal_compaction = asyncio.get_running_loop().create_task(
+            compact_journal(state_journal.start_compaction())
+        )
+
+async def compact_journal (compaction):
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            None,
+            state_journal.write_compaction,
+            compaction
+        )
+    except Exception as e:
+        print("[W] Could not compact the journal: " + str(e))
+        state_journal.cancel_compaction(compaction)
+
+        return
+
+    state_journal.end_compaction(compaction, result)
+
+async def wait_for_journal_compaction ():
+    if (journal_compaction is not None):
+        await journal_compaction
+
+# Narrations that cannot be restored (missing checkpoint, story file removed
+# or modified) are dropped. They all count as resident, the ones past the
+# limit being hibernated once narrations start being used.
+def restore_state ():
+    global stories_and_narrations
+
+    start = time.perf_counter()
+
+    (
+        saved_administrators,
+        saved_stories,
+        saved_narrations
+    ) = state_journal.get_state()
+
+    administrators.update(saved_administrators)
+
+    story_files = dict()
+
+    for story_id in sorted(saved_stories):
+        (filename, name, description, is_listed) = saved_stories[story_id]
+        story_file = StoryFile(filename)
+        story_file.id = story_id
+        story_file.name = name
+        story_file.description = description
+        story_files[story_id] = story_file
+
+        if (is_listed):
+            stories_and_narrations.add_story(story_file)
+
+        stories_and_narrations.next_story_id = max(
+            stories_and_narrations.next_story_id,
+            (story_id + 1)
+        )
+
+    requests = []
+
+    for (narration_id, values) in list(saved_narrations.items()):
+        if (
+            state_journal.has_checkpoint(narration_id)
+            and (values[0] in story_files)
+        ):
+            requests.append(
+                (
+                    narration_id,
+                    story_files[values[0]],
+                    values[1],
+                    values[2],
+                    state_journal.get_checkpoint(narration_id)
+                )
+            )
+        else:
+            state_journal.remove_narration(narration_id)
+
+    restored_narrations = 0
+
+    for (request, result) in zip(
+        requests,
+        backend.restore_narrations(requests)
+    ):
+        if (isinstance(result, Exception)):
+            print(
+                "[W] Could not restore narration "
+                + str(request[0])
+                + ": "
+                + str(result)
+            )
+            state_journal.remove_narration(request[0])
+
+            continue
+
+        (_, _, _, is_paused, is_orphaned, last_post_id) = (
+            saved_narrations[request[0]]
+        )
+
+        if (is_paused):
+            result.toggle_is_paused()
+        else:
+            result.set_last_post_id(last_post_id)
+
+        register_narration(result)
+
+        if (is_orphaned):
+            stories_and_narrations.orphan_narration(result)
+
+        if (narration_hibernation is not None):
+            narration_hibernation.add_resident(result)
+
+        restored_narrations += 1
+
+    print(
+        "[I] Restored "
+        + str(len(saved_administrators))
+        + " administrators, "
+        + str(stories_and_narrations.get_story_count())
+        + " stories and "
+        + str(restored_narrations)
+        + " narrations from "
+        + args.state_directory
+        + " in "
+        + ("%.3f" % (time.perf_counter() - start))
+        + "s."
+    )
+
+################################################################################
+### HIBERNATION ################################################################
+################################################################################
+# Runs 'function(narration, *args)' on the narration, rehydrating it first if
+# it was hibernated. The narrations it pushes out of memory are hibernated by
+# their own actor. Submitted to the narration's actor.
+async def run_resident (function, narration, *args):
+    if (narration_hibernation is None):
+        return await function(narration, *args)
+
+    if (narration_hibernation.is_hibernated(narration)):
+        start = time.perf_counter()
+
+        try:
+            is_rehydrated = await backend.rehydrate(narration)
+        except Exception:
+            # Its hibernated state is gone.
+            delete_narration(narration)
 
+            raise
+
+        if (is_rehydrated):
+            narration_hibernation.add_rehydration(start)
+
+    result = await function(narration, *args)
+
+    if (not narration.has_been_finalized()):
+        for victim in narration_hibernation.use(narration):
+            narration_actors[victim.get_id()].submit(
+                hibernate_narration,
+                victim
+            )
+
+    return result
+
+async def hibernate_narration (narration):
+    # It may have been used again since.
+    if (not narration_hibernation.is_hibernated(narration)):
+        return
+
+    if (
+        await backend.hibernate(
+            narration,
+            narration_hibernation.get_filename(narration)
+        )
+    ):
+        narration_hibernation.add_hibernation()
+    else:
+        narration_hibernation.cancel_hibernation(narration)
+
+################################################################################
+### MEMORY #####################################################################
+################################################################################
+# Narrations are measured by their backend (see Narration.get_memory_usage).
+# Those not measured yet (restored ones, until their first answer) count as
+# using nothing.
+def get_memory_size (narration):
+    usage = narration.get_memory_usage()
+
+    if (usage is None):
+        return 0
+
+    return usage.size
+
+# Returns (total size, measured narrations, {initiator ID: size}).
+def get_memory_sizes ():
+    global stories_and_narrations
+
+    total = 0
+    measured = 0
+    sizes_by_initiator = dict()
+
+    for n in stories_and_narrations.get_narrations():
+        size = get_memory_size(n)
+
+        if (n.get_memory_usage() is not None):
+            measured += 1
+
+        total += size
+        sizes_by_initiator[n.get_initiator_id()] = (
+            sizes_by_initiator.get(n.get_initiator_id(), 0) + size
+        )
+
+    return (total, measured, sizes_by_initiator)
+
+# Aborts 'narration' if it pushed the narrations of its initiator past
+# --max-user-memory. Returns what it says when it does.
+def enforce_initiator_memory_limit (narration):
+    global stories_and_narrations
+
+    if (
+        (args.max_user_memory is None)
+        or narration.has_ended()
+        or narration.has_been_finalized()
+    ):
+        return ""
+
+    size = sum(
+        get_memory_size(n)
+        for n in stories_and_narrations.get_narrations_of_initiator(
+            narration.get_initiator_id()
+        )
+    )
+
+    if (size <= args.max_user_memory):
+        return ""
+
+    narration.abort(
+        "This narration was aborted: the narrations started by "
+        + narration.get_initiator_name()
+        + " use more than "
+        + str(args.max_user_memory)
+        + " bytes of memory."
+    )
+
+    return narration.pop_output_string()
+
+################################################################################
+### ADMIN COMMANDS #############################################################
+################################################################################
+# Returns None if the tag does not match any member of 'server'.
+def find_user (server, user_tag):
     user_data = user_tag.split('#')
 
     if (len(user_data) != 2):
-        return ("Invalid user tag. Use something like nsensfel#0001.", None)
+        return None
 
-    user = discord.utils.get(
+    return discord.utils.get(
         server.members,
         name = user_data[0],
         discriminator = user_data[1]
     )
 
+def add_admin (server, user_tag):
+    global administrators
+
+    if (len(user_tag.split('#')) != 2):
+        return (
+            "Invalid user tag '"
+            + user_tag
+            + "'. Use something like nsensfel#0001."
+        )
+
+    user = find_user(server, user_tag)
+
     if (user is None):
-        return ("Unknown user '" + user_tag + "'.", None)
+        return "Unknown user '" + user_tag + "'."
 
-    if not (user.id in administrators):
-        return ("This user is not an administrator.", None)
+    if (user.id in administrators):
+        return user_tag + " was already an administrator."
 
-    del administrators[user.id]
+    set_administrator(user.id, user_tag)
 
-    return (user_tag + " is no longer an administrator.", None)
+    return user_tag + " is now an administrator."
 
-def handle_add_story_file_command (story_filename, requester_name, requester_id):
+def handle_add_admin_command (user_tags, server, requester_name, requester_id):
+    return (
+        "\n".join([add_admin(server, user_tag) for user_tag in user_tags]),
+        None
+    )
+
+def rm_admin (server, user_tag):
     global administrators
-    global available_stories
 
-    if not (requester_id in administrators):
-        return ("Denied. You are not registered as an administrator.", None)
+    if (len(user_tag.split('#')) != 2):
+        return (
+            "Invalid user tag '"
+            + user_tag
+            + "'. Use something like nsensfel#0001."
+        )
 
-    story_file = StoryFile(story_filename)
+    user = find_user(server, user_tag)
 
-    available_stories.append(story_file)
+    if (user is None):
+        return "Unknown user '" + user_tag + "'."
+
+    if not (user.id in administrators):
+        return user_tag + " is not an administrator."
 
+    set_administrator(user.id, None)
+
+    return user_tag + " is no longer an administrator."
+
+def handle_rm_admin_command (user_tags, server, requester_name, requester_id):
     return (
-        ("Story added (index: " + str(len(available_stories) - 1) + ")."),
+        "\n".join([rm_admin(server, user_tag) for user_tag in user_tags]),
         None
     )
 
-def handle_rm_story_file_command (story_filename, requester_name, requester_id):
-    global administrators
-    global available_stories
-    global active_narrations_by_post
-    global active_narrations_by_id
-    global orphaned_narrations
 
-    if not (requester_id in administrators):
-        return ("Denied. You are not registered as an administrator.", None)
+def handle_add_story_file_command (story_filename, requester_name, requester_id):
+    global stories_and_narrations
 
-    affected_stories = 0
-    affected_narrations = 0
-    affected_orphaned_narrations = 0
+    # Also writes the precompiled story, so that narrations start faster.
+    try:
+        tonkadur.get_program(story_filename, narration.Narration.optimize)
+    except Exception as e:
+        return (
+            "Could not load story file '" + story_filename + "': " + str(e),
+            None
+        )
+
+    story = StoryFile(story_filename)
+    index = stories_and_narrations.add_story(story)
+    journal_story(story)
+
+    return (("Story added (index: " + str(index) + ")."), None)
 
-    i = 0
-    limit = list(available_stories)
+def handle_rm_story_file_command (story_filename, requester_name, requester_id):
+    global stories_and_narrations
+
+    affected_narrations = 0
 
     result = ""
 
-    while (i < limit):
-        story = available_stories[i]
+    removed_stories = remove_stories_of_file(story_filename)
 
-        if (story.filename == story_filename):
-            affected_stories += 1
-            del available_stories[i]
+    for story in removed_stories:
+        # Deleting them also stops them from being orphaned, so that they are
+        # not counted again below.
+        narrations = list(story.narrations.values())
 
-            for removed_narration in story.narrations:
-                affected_narrations += 1
-                delete_narration(removed_narration)
+        for removed_narration in narrations:
+            affected_narrations += 1
+            delete_narration(removed_narration)
 
-            result += "Removed story \""
-            result += story.name
-            result += "\" and its "
-            result += str(len(story.narrations))
-            result += " narrations.\n"
+        result += "Removed story \""
+        result += story.name
+        result += "\" and its "
+        result += str(len(narrations))
+        result += " narrations.\n"
 
-            limit -= 1
-        else:
-            i += 1
+    forgotten_narrations = (
+        stories_and_narrations.forget_orphaned_narrations_of_file(
+            story_filename
+        )
+    )
 
-    i = 0
-    limit = list(orphaned_narrations)
+    for narration in forgotten_narrations:
+        journal_narration(narration)
 
-    while (i < limit):
-        narration = orphaned_narrations[i]
+    affected_orphaned_narrations = len(forgotten_narrations)
 
-        if (narration.get_story_file().get_filename() == story_filename):
-            affected_orphaned_narrations += 1
-            del orphaned_narrations[i]
-            limit -= 1
-        else:
-            i += 1
+    tonkadur.invalidate_program(story_filename)
 
     return (
         (
             result
             + "Story file removed ("
-            + str(affected_stories)
+            + str(len(removed_stories))
             + " stories, "
             + str(affected_narrations)
             + " narrations, and "
@@ -240,205 +812,365 @@ def handle_rm_story_file_command (story_filename, requester_name, requester_id):
         None
     )
 
-def handle_disable_story_command (story_index, requester_name, requester_id):
-    global administrators
-    global available_stories
-    global orphaned_narrations
+def handle_disable_story_command (story_indices, requester_name, requester_id):
+    global stories_and_narrations
 
-    if not (requester_id in administrators):
-        return ("Denied. You are not registered as an administrator.", None)
+    result = []
+    deleted_stories = dict()
 
-    if ((story_index < 0) or (story_index >= len(available_stories))):
-        return ("Invalid story index.", None)
+    # Removing a story changes the index of the following ones: they are all
+    # looked up first.
+    for story_index in story_indices:
+        story = stories_and_narrations.get_story(story_index)
 
-    deleted_story = available_stories[story_index]
+        if (story is None):
+            result.append("Invalid story index " + str(story_index) + ".")
+        else:
+            deleted_stories[story_index] = story
 
-    result = "Disabled story "
-    result += deleted_story.name
-    result += " ("
-    result += deleted_story.filename
-    result += ") and orphaned "
-    result += str(len(deleted_story.narrations))
-    result += " narrations."
+    for deleted_story in dict.fromkeys(deleted_stories.values()):
+        line = "Disabled story "
+        line += deleted_story.name
+        line += " ("
+        line += deleted_story.filename
+        line += ") and orphaned "
+        line += str(len(deleted_story.narrations))
+        line += " narrations."
 
-    orphaned_narrations.extend(deleted_story.narrations)
+        remove_story(deleted_story)
 
-    del available_stories[story_index]
+        result.append(line)
 
-    return (result, None)
+    return ("\n".join(result), None)
 
 def handle_disable_story_file_command (story_filename, requester_name, requester_id):
-    global administrators
-    global available_stories
-    global orphaned_narrations
-
-    if not (requester_id in administrators):
-        return ("Denied. You are not registered as an administrator.", None)
-
-    affected_stories = 0
-
-    i = 0
-    limit = list(available_stories)
+    global stories_and_narrations
 
     result = ""
 
-    while (i < limit):
-        story = available_stories[i]
+    removed_stories = remove_stories_of_file(story_filename)
 
-        if (story.filename == story_filename):
-            affected_stories += 1
-            del available_stories[i]
+    for story in removed_stories:
+        result += "Removed story \""
+        result += story.name
+        result += "\" and orphaned its "
+        result += str(len(story.narrations))
+        result += " narrations.\n"
 
-            orphaned_narrations.extend(story.narrations)
-
-            result += "Removed story \""
-            result += story.name
-            result += "\" and orphaned its "
-            result += str(len(story.narrations))
-            result += " narrations.\n"
-
-            limit -= 1
-        else:
-            i += 1
+    tonkadur.invalidate_program(story_filename)
 
     return (
         (
             result
             + "Story file removed ("
-            + str(affected_stories)
+            + str(len(removed_stories))
             + " stories were affected)."
         ),
         None
     )
 
 def handle_set_story_name_command (story_index, name, requester_name, requester_id):
-    global administrators
-    global available_stories
+    global stories_and_narrations
 
-    if not (requester_id in administrators):
-        return ("Denied. You are not registered as an administrator.", None)
+    story = stories_and_narrations.get_story(story_index)
 
-    if ((story_index < 0) or (story_index >= len(available_stories))):
+    if (story is None):
         return ("Invalid story index.", None)
 
-    available_stories[story_index].name = name
+    story.name = name
+    stories_and_narrations.invalidate_story_entries(story)
+    journal_story(story)
 
     return ("Story name set.", None)
 
 def handle_set_story_description_command (story_index, description, requester_name, requester_id):
-    global administrators
-    global available_stories
+    global stories_and_narrations
 
-    if not (requester_id in administrators):
-        return ("Denied. You are not registered as an administrator.", None)
+    story = stories_and_narrations.get_story(story_index)
 
-    if ((story_index < 0) or (story_index >= len(available_stories))):
+    if (story is None):
         return ("Invalid story index.", None)
 
-    available_stories[story_index].description = description
+    story.description = description
+    journal_story(story)
 
     return ("Story description set.", None)
 
+async def handle_profile_command (target, index, action, requester_name, requester_id):
+    global stories_and_narrations
+
+    if not (action in ("start", "stop", "show")):
+        return ("Unknown profiling action '" + action + "'.", None)
+
+    if (target == "narration"):
+        narration = stories_and_narrations.get_narration(index)
+
+        if (narration is None):
+            return ("There is no narration with this ID.", None)
+
+        name = "narration " + str(index)
+        result = await narration_actors[narration.get_id()].submit(
+            run_resident,
+            backend.profile_narration,
+            narration,
+            action
+        )
+    elif (target == "story"):
+        story = stories_and_narrations.get_story(index)
+
+        if (story is None):
+            return ("Invalid story index.", None)
+
+        name = "story " + str(index)
+        result = await backend.profile_story(
+            story.filename,
+            list(stories_and_narrations.get_narrations()),
+            action
+        )
+    else:
+        return (get_command_help(), None)
+
+    if (result is None):
+        return ("There is no profiling of " + name + ".", None)
+
+    if (action == "start"):
+        return ("Profiling " + name + ".", None)
+
+    report = "Profile of " + name + ":\n" + result.to_string()
+
+    if (action == "stop"):
+        report += "\nProfiling stopped."
+
+    return (report, None)
+
+def handle_outbox_command (requester_name, requester_id):
+    return (outbox.to_string(), None)
+
+def handle_journal_command (requester_name, requester_id):
+    if (state_journal is None):
+        return ("The bot's state is not kept across restarts.", None)
+
+    return (state_journal.to_string(), None)
+
+async def handle_memory_command (narration_id, requester_name, requester_id):
+    global stories_and_narrations
+
+    if (narration_id is not None):
+        target = stories_and_narrations.get_narration(narration_id)
+
+        if (target is None):
+            return ("There is no narration with this ID.", None)
+
+        stats = await narration_actors[target.get_id()].submit(
+            run_resident,
+            backend.get_allocation_stats,
+            target
+        )
+        usage = target.get_memory_usage()
+
+        if (usage is None):
+            result = "Narration " + str(narration_id) + " was not measured yet."
+        else:
+            result = (
+                "Narration " + str(narration_id) + ": " + usage.to_string() + "."
+            )
+
+        result += (
+            "\nAllocated objects: "
+            + str(stats["live"])
+            + " live, "
+            + str(stats["freed"])
+            + " freed by "
+            + str(stats["collections"])
+            + " collections, "
+            + str(stats["allocated_since_collection"])
+            + " allocated since the last one."
+        )
+
+        return (result, None)
+
+    (total, measured, sizes_by_initiator) = get_memory_sizes()
+
+    result = (
+        "Memory: "
+        + str(total)
+        + " bytes used by "
+        + str(measured)
+        + " measured narrations (out of "
+        + str(stories_and_narrations.get_narration_count())
+        + ")."
+    )
+
+    if (narration.Narration.max_memory is not None):
+        result += (
+            " At most "
+            + str(narration.Narration.max_memory)
+            + " bytes per narration."
+        )
+
+    if (args.max_user_memory is not None):
+        result += (
+            " At most " + str(args.max_user_memory) + " bytes per user."
+        )
+
+    result += "\nLargest narrations:"
+
+    for n in heapq.nlargest(
+        10,
+        stories_and_narrations.get_narrations(),
+        key = get_memory_size
+    ):
+        result += (
+            "\n - "
+            + str(n.get_id())
+            + " ("
+            + n.get_initiator_name()
+            + "): "
+            + str(get_memory_size(n))
+            + " bytes"
+        )
+
+    result += "\nLargest users:"
+
+    for (initiator_id, size) in heapq.nlargest(
+        10,
+        sizes_by_initiator.items(),
+        key = lambda entry: entry[1]
+    ):
+        result += "\n - " + str(initiator_id) + ": " + str(size) + " bytes"
+
+    return (result, None)
+
+def handle_hibernation_command (requester_name, requester_id):
+    if (narration_hibernation is None):
+        return ("All narrations are kept in memory.", None)
+
+    return (narration_hibernation.to_string(), None)
+
 ################################################################################
 ### NARRATION INITIATOR COMMANDS ###############################################
 ################################################################################
+# Registry updates are done without awaiting anything, so that no other
+# message can be handled while they are only partially done.
+def register_narration (narration):
+    global stories_and_narrations
+    global narration_actors
+
+    stories_and_narrations.add_narration(narration)
+    narration_actors[narration.get_id()] = actors.NarrationActor(narration)
+
+# Can be called on a narration that was already deleted while one of its
+# requests was being handled.
 def delete_narration (narration):
-    global active_narrations_by_post
-    global active_narrations_by_id
-    global paused_narrations
-    global available_stories
+    global stories_and_narrations
+    global narration_actors
 
-    del active_narrations_by_id[narration.get_id()]
+    if (narration.has_been_finalized()):
+        return
 
-    if (narration.get_is_paused()):
-        paused_narrations.remove(narration)
-    else:
-        del active_narrations_by_post[narration.get_last_post_id()]
+    stories_and_narrations.remove_narration(narration)
+
+    if (state_journal is not None):
+        state_journal.remove_narration(narration.get_id())
 
-    story_filename = narration.get_story_file().filename
+    if (narration_hibernation is not None):
+        narration_hibernation.forget(narration)
 
-    for story in available_stories:
-        if (story.filename == story_filename):
-            try:
-                story.narrations.remove(narration)
-            except ValueError: # The narration wasn't found.
-                pass # That's not an issue.
+    actor = narration_actors.pop(narration.get_id(), None)
 
+    if (actor is not None):
+        actor.close()
+
+        if ((actor.task is not None) and not actor.task.done()):
+            closing_narration_actors.add(actor)
+            actor.task.add_done_callback(
+                lambda task: closing_narration_actors.discard(actor)
+            )
+
+    backend.release(narration)
     narration.finalize()
 
-def handle_end_narration_command (narration_id, requester_name, requester_id):
+# Returns the narration, or the reason why the requester cannot control it.
+def get_controlled_narration (narration_id, requester_id):
     global administrators
-    global active_narrations_by_id
+    global stories_and_narrations
 
-    if not (narration_id in active_narrations_by_id):
-        return ("There is no narration with this ID.", None)
+    narration = stories_and_narrations.get_narration(narration_id)
 
-    narration = active_narrations_by_id[narration_id]
+    if (narration is None):
+        return "There is no narration with ID " + str(narration_id) + "."
 
     if (
         (requester_id not in administrators)
         and (narration.get_initiator_id() != requester_id)
     ):
         return (
-            "Denied. You are not an administrator or this narration's initiator.",
-            None
+            "Denied. You are not an administrator or the initiator of narration "
+            + str(narration_id)
+            + "."
         )
 
+    return narration
+
+def end_narration (narration_id, requester_id):
+    narration = get_controlled_narration(narration_id, requester_id)
+
+    if (isinstance(narration, str)):
+        return narration
+
     delete_narration(narration)
 
-    return ("Narration " + str(narration_id) + " ended.", None)
+    return "Narration " + str(narration_id) + " ended."
 
-def handle_pause_narration_command (narration_id, requester_name, requester_id):
-    global administrators
-    global active_narrations_by_post
-    global active_narrations_by_id
-    global paused_narrations
+def handle_end_narration_command (narration_ids, requester_name, requester_id):
+    return (
+        "\n".join(
+            [
+                end_narration(narration_id, requester_id)
+                for narration_id in dict.fromkeys(narration_ids)
+            ]
+        ),
+        None
+    )
 
-    if not (narration_id in active_narrations_by_id):
-        return ("There is no narration with this ID.", None)
+def pause_narration (narration_id, requester_id):
+    global stories_and_narrations
 
-    narration = active_narrations_by_id[narration_id]
+    narration = get_controlled_narration(narration_id, requester_id)
 
-    if (
-        (requester_id not in administrators)
-        and (narration.get_initiator_id() != requester_id)
-    ):
-        return (
-            "Denied. You are not an administrator or this narration's initiator.",
-            None
-        )
+    if (isinstance(narration, str)):
+        return narration
 
     if (narration.get_is_paused()):
-        return ("This narration is already paused.", None)
-    else:
-        del active_narrations_by_post[narration.get_last_post_id()]
-        paused_narrations.append(narration)
-        narration.toggle_is_paused()
+        return "Narration " + str(narration_id) + " is already paused."
 
-        return ("Narration paused", None)
+    stories_and_narrations.pause_narration(narration)
+    journal_narration(narration)
 
-def handle_resume_narration_command (narration_id, requester_name, requester_id):
-    global administrators
-    global active_narrations_by_post
-    global active_narrations_by_id
+    return "Narration " + str(narration_id) + " paused."
 
-    if not (narration_id in active_narrations_by_id):
-        return ("There is no narration with this ID.", None)
+def handle_pause_narration_command (narration_ids, requester_name, requester_id):
+    return (
+        "\n".join(
+            [
+                pause_narration(narration_id, requester_id)
+                for narration_id in dict.fromkeys(narration_ids)
+            ]
+        ),
+        None
+    )
 
-    narration = active_narrations_by_id[narration_id]
+def handle_resume_narration_command (narration_id, requester_name, requester_id):
+    global stories_and_narrations
 
-    if (
-        (requester_id not in administrators)
-        and (narration.get_initiator_id() != requester_id)
-    ):
-        return (
-            "Denied. You are not an administrator or this narration's initiator.",
-            None
-        )
+    narration = get_controlled_narration(narration_id, requester_id)
+
+    if (isinstance(narration, str)):
+        return (narration, None)
 
     if (narration.get_is_paused()):
-        paused_narrations.remove(narration)
-        narration.toggle_is_paused()
+        stories_and_narrations.resume_narration(narration)
+        journal_narration(narration)
 
         return (narration.get_previous_output(), narration)
     else:
@@ -448,12 +1180,14 @@ def handle_resume_narration_command (narration_id, requester_name, requester_id)
 ### GLOBAL COMMANDS ############################################################
 ################################################################################
 def handle_get_story_list_command ():
-    global available_stories
+    global stories_and_narrations
 
     result = "Available stories:"
 
-    for i in range(len(available_stories)):
-        story_file = available_stories[i]
+    stories = stories_and_narrations.get_stories()
+
+    for i in range(len(stories)):
+        story_file = stories[i]
         result += "\n"
         result += str(i)
         result += ". "
@@ -466,71 +1200,79 @@ def handle_get_story_list_command ():
 
     return (result, None)
 
-def handle_get_active_narration_list_command ():
-    global active_narrations_by_id
+# Narrations listed per page, so that a page fits in a Discord message.
+NARRATIONS_PER_PAGE = 15
 
-    result = "Active narrations:"
+# 'page' starts at 1.
+def get_narration_list_page (title, narrations, count, page):
+    global stories_and_narrations
 
-    for narration in active_narrations_by_id.values():
-        result += "\n"
-        result += str(narration.get_id())
-        result += ". "
-        result += narration.get_story_file().get_name()
-        result += "("
-        result += narration.get_story_file().get_filename()
-        result += ")\nStarted by: "
-        result += narration.get_initiator_name()
-        result += "("
-        result += str(narration.get_initiator_id())
-        result += ")\n"
-
-        if (narration.get_is_paused()):
-            result += "Paused.\n"
+    page_count = max(1, -(-count // NARRATIONS_PER_PAGE))
 
-    return (result, None)
+    if ((page < 1) or (page > page_count)):
+        return ("Choose a page between 1 and " + str(page_count) + ".", None)
 
-def handle_get_paused_narration_list_command ():
-    global paused_narrations
+    start = (page - 1) * NARRATIONS_PER_PAGE
+    entries = stories_and_narrations.get_narration_entries(
+        narrations,
+        start,
+        (start + NARRATIONS_PER_PAGE)
+    )
 
-    result = "Paused narrations:"
+    return (
+        (
+            title
+            + " ("
+            + str(count)
+            + ", page "
+            + str(page)
+            + " of "
+            + str(page_count)
+            + "):"
+            + "".join(entries)
+        ),
+        None
+    )
 
-    for narration in paused_narrations:
-        result += "\n"
-        result += str(narration.get_id())
-        result += ". "
-        result += narration.get_story_file().get_name()
-        result += "("
-        result += narration.get_story_file().get_filename()
-        result += ")\nStarted by: "
-        result += narration.get_initiator_name()
-        result += "("
-        result += str(narration.get_initiator_id())
-        result += ")\n"
+def handle_get_active_narration_list_command (page):
+    global stories_and_narrations
 
-    return (result, None)
+    return get_narration_list_page(
+        "Active narrations",
+        stories_and_narrations.get_narrations(),
+        stories_and_narrations.get_narration_count(),
+        page
+    )
 
-def handle_get_orphaned_narration_list_command ():
-    global orphaned_narrations
+def handle_get_paused_narration_list_command (page):
+    global stories_and_narrations
 
-    result = "Orphaned narrations:"
+    return get_narration_list_page(
+        "Paused narrations",
+        stories_and_narrations.get_paused_narrations(),
+        stories_and_narrations.get_paused_narration_count(),
+        page
+    )
 
-    for narration in orphaned_narrations:
-        result += "\n"
-        result += str(narration.get_id())
-        result += ". "
-        result += narration.get_story_file().get_name()
-        result += "("
-        result += narration.get_story_file().get_filename()
-        result += ")\nStarted by: "
-        result += narration.get_initiator_name()
-        result += "("
-        result += str(narration.get_initiator_id())
-        result += ")\n"
-
-        if (narration.get_is_paused()):
-            result += "Paused.\n"
+def handle_get_orphaned_narration_list_command (page):
+    global stories_and_narrations
 
-    return (result, None)
+    return get_narration_list_page(
+        "Orphaned narrations",
+        stories_and_narrations.get_orphaned_narrations(),
+        stories_and_narrations.get_orphaned_narration_count(),
+        page
+    )
+
+def handle_narrations_by_command (initiator_id, page):
+    global stories_and_narrations
+
+    return get_narration_list_page(
+        ("Narrations started by " + str(initiator_id)),
+        stories_and_narrations.get_narrations_of_initiator(initiator_id),
+        stories_and_narrations.get_narration_count_of_initiator(initiator_id),
+        page
+    )
 
 def handle_get_administrator_list_command ():
     global administrators
@@ -546,253 +1288,417 @@ def handle_get_administrator_list_command ():
 
     return (result, None)
 
-def handle_narrations_of_command (index):
-    global available_stories
+def handle_narrations_of_command (index, page):
+    global stories_and_narrations
+
+    story = stories_and_narrations.get_story(index)
 
-    if ((index < 0) or (index >= len(available_stories))):
-        if (len(available_stories) == 0):
+    if (story is None):
+        if (stories_and_narrations.get_story_count() == 0):
             return ("No stories available.", None)
         else:
             return (
                 (
                     "Choose a story index between 0 and "
-                    + str(len(available_stories) - 1)
+                    + str(stories_and_narrations.get_story_count() - 1)
                     + "."
                 ),
                 None
             )
 
-    result = "Narrations for this story:"
-
-    for narration in available_stories[index].narrations:
-        result += "\n"
-        result += str(narration.get_id())
-        result += ". "
-        result += narration.get_story_file().get_name()
-        result += "("
-        result += narration.get_story_file().get_filename()
-        result += ")\nStarted by: "
-        result += narration.get_initiator_name()
-        result += "("
-        result += str(narration.get_initiator_id())
-        result += ").\n"
-
-        if (narration.get_is_paused()):
-            result += "Paused.\n"
+    return get_narration_list_page(
+        "Narrations for this story",
+        story.narrations.values(),
+        len(story.narrations),
+        page
+    )
 
-    return (result, None)
+async def handle_start_narration_command (index, requester_name, requester_id):
+    global stories_and_narrations
 
-def handle_start_narration_command (index, requester_name, requester_id):
-    global available_stories
-    global active_narrations_by_id
+    story = stories_and_narrations.get_story(index)
 
-    if ((index < 0) or (index >= len(available_stories))):
-        if (len(available_stories) == 0):
+    if (story is None):
+        if (stories_and_narrations.get_story_count() == 0):
             return ("No stories available.", None)
         else:
             return (
                 (
                     "Choose a story index between 0 and "
-                    + str(len(available_stories) - 1)
+                    + str(stories_and_narrations.get_story_count() - 1)
                     + "."
                 ),
                 None
             )
 
-    new_narration = narration.Narration(
-        available_stories[index],
+    new_narration = backend.create_narration(
+        story,
         requester_name,
         requester_id
     )
-    active_narrations_by_id[new_narration.get_id()] = new_narration
-    new_narration.run(requester_name, requester_id)
+    register_narration(new_narration)
+    journal_narration(new_narration)
+
+    try:
+        output = await narration_actors[new_narration.get_id()].submit(
+            run_and_checkpoint,
+            backend.start,
+            new_narration
+        )
+    except Exception:
+        delete_narration(new_narration)
+
+        raise
+
+    if (new_narration.has_been_finalized()):
+        return ("", None)
+
+    if (new_narration.has_ended()):
+        delete_narration(new_narration)
+
+        return (output + "\n\nThis narration has now ended.", None)
 
-    return (new_narration.pop_output_string(), new_narration)
+    return (output, new_narration)
 
 ################################################################################
-### EVENT HANDLING #############################################################
+### COMMAND TABLE ##############################################################
 ################################################################################
+# Who can use a command. Narration initiator commands are open to everyone:
+# their handlers check who controls each narration.
+EVERYONE = 0
+ADMINISTRATOR = 1
+
+# Takes the rest of the message, spaces included.
+def text (value):
+    return value
+
+class Command:
+    # 'parameters' is a list of (NAME, parser) or (NAME, parser, default):
+    #  - a NAME ending with '+' takes one or more values (last parameter only),
+    #    which the handler gets as a list,
+    #  - a 'text' parameter takes the rest of the message (last parameter only),
+    #  - parameters with a default are optional.
+    # The handler is called with the parsed values, then whatever the
+    # 'context' functions return for the message.
+    def __init__ (self, name, handler, parameters, permission, context):
+        self.name = name
+        self.handler = handler
+        self.parameters = parameters
+        self.permission = permission
+        self.context = context
+        self.required_parameters = len(
+            [parameter for parameter in parameters if (len(parameter) == 2)]
+        )
 
-def handle_possible_command (message):
-    print("Was mentioned.")
+    def get_usage (self):
+        return " ".join([self.name] + [p[0] for p in self.parameters])
 
-    message_content = message.clean_content.split(' ')
+    # Returns the list of handler arguments, or a reason why 'values' do not
+    # fit.
+    def parse (self, values):
+        if (len(values) < self.required_parameters):
+            return "Usage: " + self.get_usage()
 
-    if (len(message_content) < 2):
-        return (get_command_help(), None)
+        result = []
 
-    #### GLOBAL COMMANDS
-    elif (message_content[1] == "available"):
-        return handle_get_story_list_command()
+        for i in range(len(self.parameters)):
+            parameter = self.parameters[i]
 
-    elif (message_content[1] == "active"):
-        return handle_get_active_narration_list_command()
+            if (i >= len(values)):
+                result.append(parameter[2])
 
-    elif (message_content[1] == "paused"):
-        return handle_get_paused_narration_list_command()
+                continue
 
-    elif (message_content[1] == "start"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_start_narration_command(
-                int(message_content[2]),
-                message.author.display_name,
-                message.author.id
-            )
+            if (parameter[1] is text):
+                result.append(" ".join(values[i:]))
 
-    elif (message_content[1] == "administrators"):
-        return handle_get_administrator_list_command()
+                return result
 
-    elif (message_content[1] == "orphaned"):
-        return handle_get_orphaned_narration_list_command()
+            if (parameter[0].endswith("+")):
+                parsed_values = []
 
-    elif (message_content[1] == "narrations_of"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_narrations_of_command(int(message_content[2]))
+                for value in values[i:]:
+                    parsed_value = parse_value(parameter, value)
 
-    #### NARRATION INITIATOR COMMANDS
-    elif (message_content[1] == "end"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_end_narration_command(
-                int(message_content[2]),
-                message.author.display_name,
-                message.author.id
-            )
+                    if (isinstance(parsed_value, str)):
+                        return parsed_value
 
-    elif (message_content[1] == "pause"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_pause_narration_command(
-                int(message_content[2]),
-                message.author.display_name,
-                message.author.id
-            )
+                    parsed_values.append(parsed_value[0])
 
-    elif (message_content[1] == "resume"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_resume_narration_command(
-                int(message_content[2]),
-                message.author.display_name,
-                message.author.id
-            )
+                result.append(parsed_values)
 
-    #### ADMINISTRATOR COMMANDS
-    elif (message_content[1] == "add_admin"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_add_admin_command(
-                message.guild,
-                message_content[2],
-                message.author.display_name,
-                message.author.id
-            )
+                return result
 
-    elif (message_content[1] == "rm_admin"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_rm_admin_command(
-                message.guild,
-                message_content[2],
-                message.author.display_name,
-                message.author.id
-            )
+            parsed_value = parse_value(parameter, values[i])
 
-    elif (message_content[1] == "add_story_file"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_add_story_file_command(
-                " ".join(message_content[2:]),
-                message.author.display_name,
-                message.author.id
-            )
+            if (isinstance(parsed_value, str)):
+                return parsed_value
 
-    elif (message_content[1] == "rm_story_file"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_rm_story_file_command(
-                " ".join(message_content[2:]),
-                message.author.display_name,
-                message.author.id
-            )
+            result.append(parsed_value[0])
 
-    elif (message_content[1] == "disable_story"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_disable_story_command(
-                int(message_content[2]),
-                message.author.display_name,
-                message.author.id
-            )
+        if (len(values) > len(self.parameters)):
+            return "Usage: " + self.get_usage()
 
-    elif (message_content[1] == "disable_story_file"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_disable_story_file_command(
-                " ".join(message_content[2:]),
-                message.author.display_name,
-                message.author.id
-            )
+        return result
 
-    elif (message_content[1] == "set_story_name"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_set_story_name_command(
-                int(message_content[2]),
-                " ".join(message_content[3:]),
-                message.author.display_name,
-                message.author.id
-            )
+# Returns the value as a 1-tuple, or why it is invalid.
+def parse_value (parameter, value):
+    try:
+        return (parameter[1](value),)
+    except ValueError:
+        return "Invalid " + parameter[0].rstrip("+") + " '" + value + "'."
 
-    elif (message_content[1] == "set_story_desc"):
-        if (len(message_content) < 3):
-            return (get_command_help(), None)
-        else:
-            return handle_set_story_description_command(
-                int(message_content[2]),
-                " ".join(message_content[3:]),
-                message.author.display_name,
-                message.author.id
-            )
+def get_server (message):
+    return message.guild
 
-    return (get_command_help(), None)
+def get_requester_name (message):
+    return message.author.display_name
 
-def handle_possible_story_answer (message):
-    global active_narrations_by_post
+def get_requester_id (message):
+    return message.author.id
 
-    msg_id_replied_to = message.reference.message_id
+REQUESTER = (get_requester_name, get_requester_id)
 
-    if msg_id_replied_to in active_narrations_by_post:
-        narration = active_narrations_by_post[msg_id_replied_to]
+# Command name -> Command
+commands = dict()
 
-        result = ""
+def register_command (
+    name,
+    handler,
+    parameters = (),
+    permission = EVERYONE,
+    context = ()
+):
+    commands[name] = Command(name, handler, parameters, permission, context)
 
-        narration.handle_answer(
-            message.clean_content,
-            message.author.display_name,
-            message.author.id
-        )
+#### GLOBAL COMMANDS
+register_command("available", handle_get_story_list_command)
+register_command(
+    "active",
+    handle_get_active_narration_list_command,
+    [("PAGE", int, 1)]
+)
+register_command(
+    "paused",
+    handle_get_paused_narration_list_command,
+    [("PAGE", int, 1)]
+)
+register_command(
+    "start",
+    handle_start_narration_command,
+    [("INDEX", int)],
+    context = REQUESTER
+)
+register_command("administrators", handle_get_administrator_list_command)
+register_command(
+    "orphaned",
+    handle_get_orphaned_narration_list_command,
+    [("PAGE", int, 1)]
+)
+register_command(
+    "narrations_of",
+    handle_narrations_of_command,
+    [("INDEX", int), ("PAGE", int, 1)]
+)
+register_command(
+    "narrations_by",
+    handle_narrations_by_command,
+    [("USER_ID", int), ("PAGE", int, 1)]
+)
 
-#        del active_narrations_by_post[narration.get_last_post_id()]
-#        narration.update_last_post_id(msg_id_replied_to)
-#        active_narrations_by_post[msg_id_replied_to] = narration
+#### NARRATION INITIATOR COMMANDS
+register_command(
+    "end",
+    handle_end_narration_command,
+    [("INDEX+", int)],
+    context = REQUESTER
+)
+register_command(
+    "pause",
+    handle_pause_narration_command,
+    [("INDEX+", int)],
+    context = REQUESTER
+)
+register_command(
+    "resume",
+    handle_resume_narration_command,
+    [("INDEX", int)],
+    context = REQUESTER
+)
 
-        if (narration.has_output()):
-            result += narration.pop_output_string()
+#### ADMINISTRATOR COMMANDS
+register_command(
+    "add_admin",
+    handle_add_admin_command,
+    [("TAG+", str)],
+    ADMINISTRATOR,
+    ((get_server,) + REQUESTER)
+)
+register_command(
+    "rm_admin",
+    handle_rm_admin_command,
+    [("TAG+", str)],
+    ADMINISTRATOR,
+    ((get_server,) + REQUESTER)
+)
+register_command(
+    "add_story_file",
+    handle_add_story_file_command,
+    [("STORY_FILE", text)],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "rm_story_file",
+    handle_rm_story_file_command,
+    [("STORY_FILE", text)],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "disable_story",
+    handle_disable_story_command,
+    [("INDEX+", int)],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "disable_story_file",
+    handle_disable_story_file_command,
+    [("STORY_FILE", text)],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "set_story_name",
+    handle_set_story_name_command,
+    [("INDEX", int), ("NAME", text, "")],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "set_story_desc",
+    handle_set_story_description_command,
+    [("INDEX", int), ("DESC", text, "")],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "profile",
+    handle_profile_command,
+    [("TARGET", str), ("INDEX", int), ("ACTION", str, "show")],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "outbox",
+    handle_outbox_command,
+    [],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "journal",
+    handle_journal_command,
+    [],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "memory",
+    handle_memory_command,
+    [("ID", int, None)],
+    ADMINISTRATOR,
+    REQUESTER
+)
+register_command(
+    "hibernation",
+    handle_hibernation_command,
+    [],
+    ADMINISTRATOR,
+    REQUESTER
+)
+
+################################################################################
+### EVENT HANDLING #############################################################
+################################################################################
+async def handle_possible_command (message):
+    global administrators
+
+    print("Was mentioned.")
+
+    message_content = message.clean_content.rstrip().split(' ')
+
+    if (len(message_content) < 2):
+        return (get_command_help(), None)
+
+    command = commands.get(message_content[1])
+
+    if (command is None):
+        return (get_command_help(), None)
+
+    if (
+        (command.permission == ADMINISTRATOR)
+        and not (message.author.id in administrators)
+    ):
+        return ("Denied. You are not registered as an administrator.", None)
+
+    arguments = command.parse(message_content[2:])
+
+    if (isinstance(arguments, str)):
+        return (arguments, None)
+
+    result = command.handler(
+        *arguments,
+        *[get_context(message) for get_context in command.context]
+    )
+
+    if (asyncio.iscoroutine(result)):
+        result = await result
+
+    return result
+
+async def handle_possible_story_answer (message):
+    global stories_and_narrations
+
+    narration = stories_and_narrations.get_narration_by_post(
+        message.reference.message_id
+    )
+
+    if (narration is not None):
+        # Answers given while the narration is still running wait for their
+        # turn.
+        try:
+            result = await narration_actors[narration.get_id()].submit(
+                run_and_checkpoint,
+                backend.answer,
+                narration,
+                message.clean_content,
+                message.author.display_name,
+                message.author.id
+            )
+        except Exception as e:
+            # Narrations whose state was lost are deleted.
+            if (
+                not (
+                    backend.has_failed(narration)
+                    or narration.has_been_finalized()
+                )
+            ):
+                raise
+
+            print(
+                "[W] Narration "
+                + str(narration.get_id())
+                + " was lost: "
+                + str(e)
+            )
+            delete_narration(narration)
+
+            return ("This narration was lost, as its state is gone.", None)
+
+        if (narration.has_been_finalized()):
+            return ("", None)
 
         if (narration.has_ended()):
             result += "\n\nThis narration has now ended."
@@ -804,60 +1710,40 @@ def handle_possible_story_answer (message):
     return ("", None)
 
 def replace_narration_post_id (narration, new_post_id):
-    global active_narrations_by_post
+    global stories_and_narrations
 
-    if (narration.get_is_paused()):
+    # The narration may have been paused or ended while its post was sent.
+    if (narration.get_is_paused() or narration.has_been_finalized()):
         return
 
-    if (narration.get_last_post_id() is not None):
-        del active_narrations_by_post[narration.get_last_post_id()]
-
-    narration.set_last_post_id(new_post_id)
+    stories_and_narrations.set_narration_post(narration, new_post_id)
+    journal_narration(narration)
 
-    active_narrations_by_post[new_post_id] = narration
 
-
-@client.event
 async def on_message (message):
     print("message: " + message.clean_content)
 
     if message.reference is not None:
-        (output, maybe_narration) = handle_possible_story_answer(message)
+        (output, maybe_narration) = await handle_possible_story_answer(message)
 
         if (len(output) > 0):
             if (maybe_narration is not None):
                 output += "\n\nReply to this message to continue the narration."
 
-            sent_message = await message.channel.send(
-                content = output,
-                reference = message
-            )
-
-            if (maybe_narration is not None):
-                replace_narration_post_id(
-                    maybe_narration,
-                    sent_message.id
-                )
+            # Registers the narration's new post once it is sent.
+            outbox.send(message.channel, output, message, maybe_narration)
 
         return
 
     if i_am_mentioned(message.mentions):
-        (output, maybe_narration) = handle_possible_command(message)
+        (output, maybe_narration) = await handle_possible_command(message)
 
         if (len(output) > 0):
             if (maybe_narration is not None):
                 output += "\n\nReply to this message to continue the narration."
 
-            sent_message = await message.channel.send(
-                content = output,
-                reference = message
-            )
-
-            if (maybe_narration is not None):
-                replace_narration_post_id(
-                    maybe_narration,
-                    sent_message.id
-                )
+            # Registers the narration's new post once it is sent.
+            outbox.send(message.channel, output, message, maybe_narration)
 
         return
 
@@ -868,7 +1754,6 @@ def i_am_mentioned (mentions):
 
     return False
 
-@client.event
 async def on_ready ():
     global args
 
@@ -889,8 +1774,26 @@ async def on_ready ():
             print("Unknown user '" + admin + "' could not be added as admin.")
             continue
 
-        administrators[user.id] = admin
+        set_administrator(user.id, admin)
 
     args.admins = []
 
-client.run(args.token)
+def main ():
+    global client
+
+    configure(parser.parse_args())
+    client = create_client()
+
+    try:
+        client.run(args.token)
+    finally:
+        backend.close()
+
+        if (state_journal is not None):
+            state_journal.close()
+
+        if (narration_hibernation is not None):
+            narration_hibernation.close()
+
+if __name__ == "__main__":
+    main()
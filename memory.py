@@ -0,0 +1,196 @@
+import sys
+
+################################################################################
+## COPY-ON-WRITE CONTAINERS ####################################################
+################################################################################
+# Lists, structures and wild dicts stored in a Tonkadur memory are CowDicts.
+# Assigning one to another location does not copy it: it becomes a SharedDict
+# instead, and is only copied (one level at a time) when something writes
+# through it. Pointers and texts are never modified in place, so they are
+# shared as they are.
+#
+# Being shared is encoded in the class rather than in an attribute so that
+# creating a CowDict does not go through any Python code.
+class CowDict (dict):
+    __slots__ = ()
+
+# Number of copies made by copy_for_write, for profiling.
+copy_count = 0
+
+class SharedDict (CowDict):
+    __slots__ = ()
+
+    def copy_for_write (self):
+        global copy_count
+
+        copy_count += 1
+        result = CowDict(self)
+
+        for value in dict.values(self):
+            if (type(value) is CowDict):
+                value.__class__ = SharedDict
+
+        return result
+
+def share (value):
+    if (type(value) is CowDict):
+        value.__class__ = SharedDict
+
+    return value
+
+def get_writable (parent, key):
+    value = parent[key]
+
+    if (type(value) is SharedDict):
+        value = value.copy_for_write()
+        parent[key] = value
+
+    return value
+
+# Returns the container in which access_full[-1] is to be written, copying the
+# shared containers on the way there.
+def get_writable_parent (memory, access_full):
+    current_val = memory
+
+    for access in access_full[:-1]:
+        current_val = get_writable(current_val, access)
+
+    return current_val
+
+################################################################################
+## ADDRESSES ###################################################################
+################################################################################
+# Addresses are tuples of keys. Allocated objects are stored at the top level of
+# the memory, under an integer handle. The former representation, lists of
+# strings with ".alloc.N" for allocated objects, is converted by to_address.
+ALLOCATION_PREFIX = ".alloc."
+
+def to_key (key):
+    if (
+        (type(key) is str)
+        and key.startswith(ALLOCATION_PREFIX)
+        and key[len(ALLOCATION_PREFIX):].isdigit()
+    ):
+        return int(key[len(ALLOCATION_PREFIX):])
+
+    return key
+
+def to_address (value):
+    if (type(value) is tuple):
+        return value
+    elif (type(value) is list):
+        return tuple(to_key(key) for key in value)
+    else:
+        return (value,)
+
+################################################################################
+## GARBAGE COLLECTION ##########################################################
+################################################################################
+# Allocated objects are only reachable through pointers, which are addresses
+# starting with their handle. Anything else in the memory (the variables) is a
+# root, as are the values held outside of the memory by the caller.
+CONTAINER_TYPES = (CowDict, SharedDict, dict, list)
+REFERENCE_TYPES = (tuple, CowDict, SharedDict, dict, list)
+
+def find_reachable_handles (memory, extra_roots):
+    result = set()
+    visited = set()
+    pending = [v for (k, v) in memory.items() if (type(k) is not int)]
+    pending.extend(extra_roots)
+
+    while (len(pending) > 0):
+        value = pending.pop()
+        value_type = type(value)
+
+        if (value_type is tuple):
+            if ((len(value) > 0) and (type(value[0]) is int)):
+                handle = value[0]
+
+                if ((not (handle in result)) and (handle in memory)):
+                    result.add(handle)
+                    pending.append(memory[handle])
+        elif (value_type in CONTAINER_TYPES):
+            # Shared containers can be found at several places.
+            if (id(value) in visited):
+                continue
+
+            visited.add(id(value))
+
+            if (value_type is list):
+                values = value
+            else:
+                values = dict.values(value)
+
+            for v in values:
+                if (type(v) in REFERENCE_TYPES):
+                    pending.append(v)
+
+    return result
+
+# Removes the allocated objects that cannot be reached anymore, returning their
+# handles.
+def collect_garbage (memory, extra_roots):
+    reachable = find_reachable_handles(memory, extra_roots)
+    result = [
+        k for k in memory if ((type(k) is int) and not (k in reachable))
+    ]
+
+    for handle in result:
+        del memory[handle]
+
+    return result
+
+################################################################################
+## ACCOUNTING ##################################################################
+################################################################################
+class MemoryUsage:
+    def __init__ (self, objects = 0, entries = 0, size = 0):
+        # Allocated objects (the ".alloc." ones).
+        self.objects = objects
+        # Entries of the memory and of every container in it.
+        self.entries = entries
+        # Approximate size, in bytes.
+        self.size = size
+
+    def to_string (self):
+        return (
+            str(self.size)
+            + " bytes, "
+            + str(self.objects)
+            + " objects, "
+            + str(self.entries)
+            + " entries"
+        )
+
+# Everything in the memory counts, unreachable objects included until they are
+# collected. Shared containers are only counted once, but values found at
+# several places (texts, mostly) are counted each time.
+def measure (memory, extra_roots):
+    result = MemoryUsage(
+        sum(1 for k in memory if (type(k) is int)),
+        len(memory),
+        sys.getsizeof(memory)
+    )
+    visited = set()
+    pending = list(memory.values())
+    pending.extend(extra_roots)
+
+    while (len(pending) > 0):
+        value = pending.pop()
+        value_type = type(value)
+
+        if (value_type in CONTAINER_TYPES):
+            if (id(value) in visited):
+                continue
+
+            visited.add(id(value))
+            result.entries += len(value)
+
+            if (value_type is list):
+                pending.extend(value)
+            else:
+                pending.extend(dict.values(value))
+
+        result.size += sys.getsizeof(value)
+
+    return result
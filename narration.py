@@ -1,3 +1,10 @@
+import heapq
+import marshal
+import os
+
+import memory
+import snapshot
+import text_renderer
 import tonkadur
 
 class Narration:
@@ -9,14 +16,28 @@ class Narration:
     HAS_ENDED = 4
 
     id_generator = 0
+    # Min-heap, so that the smallest IDs are handed out again first.
     free_ids = []
 
+    # Instructions a narration runs before giving control back to the bot, and
+    # instructions it can run without asking for any input before being
+    # aborted. None disables the limit.
+    instruction_budget = 10000
+    max_instructions_per_input = 10000000
+    # Bytes of memory (see get_memory_usage) a narration can use before being
+    # aborted. None disables the limit.
+    max_memory = None
+    # Whether stories go through the optimizer. Turning it off helps telling
+    # whether the optimizer is what breaks a story.
+    optimize = True
+
     def __init__ (self, story_file, initiator_name, initiator_id):
         self.status = Narration.NOT_STARTED
         self.state = tonkadur.Tonkadur(
             story_file.filename,
             initiator_name,
-            initiator_id
+            initiator_id,
+            optimize = Narration.optimize
         )
         self.is_paused = False
         self.initiator_name = initiator_name
@@ -25,18 +46,52 @@ class Narration:
         self.next_input_max = 0
         self.text_options = []
         self.event_options = []
-        self.output = ""
+        self.output = []
+        # Characters in 'output', counted as bytes.
+        self.output_size = 0
         self.previous_output = ""
         self.story_file = story_file
         self.last_post_id = None
-
+        self.instructions_since_input = 0
+        self.is_finalized = False
+        # Snapshot of 'state' not restored yet (see restore_checkpoint).
+        self.state_snapshot = None
+        # File holding the snapshot of 'state' while hibernating, 'state' being
+        # None then.
+        self.hibernation_file = None
+        # Memory usage of 'state' when it was hibernated, and the changes to it
+        # not checkpointed yet (see snapshot.SnapshotCache).
+        self.hibernated_memory_usage = None
+        self.hibernated_changes = None
+        # Program of 'state' when it was hibernated: the story file may have
+        # changed since.
+        self.hibernated_program = None
+        self.id = Narration.allocate_id()
+
+    def allocate_id ():
         if (len(Narration.free_ids) > 0):
-            self.id = Narration.free_ids[0]
-            del Narration.free_ids[0]
+            result = heapq.heappop(Narration.free_ids)
         else:
-            self.id = Narration.id_generator
+            result = Narration.id_generator
             Narration.id_generator += 1
 
+        return result
+
+    # After restoring narrations under 'used_ids', so that new ones get other
+    # IDs.
+    def restore_ids (used_ids):
+        used_ids = set(used_ids)
+
+        if (len(used_ids) == 0):
+            Narration.id_generator = 0
+        else:
+            Narration.id_generator = max(used_ids) + 1
+
+        # Sorted, hence a valid heap.
+        Narration.free_ids = [
+            i for i in range(Narration.id_generator) if not (i in used_ids)
+        ]
+
     def get_id (self):
         return self.id
 
@@ -61,6 +116,7 @@ class Narration:
         ):
             self.state.store_integer(user_input, actor_name, actor_id)
             self.status = Narration.IS_RUNNING
+            self.instructions_since_input = 0
             self.run(actor_name, actor_id)
         else:
             self.display_string(
@@ -77,6 +133,7 @@ class Narration:
             and (len(text) <= self.next_input_max)
         ):
             self.status = Narration.IS_RUNNING
+            self.instructions_since_input = 0
             self.state.store_string(text, actor_name, actor_id)
             self.run(actor_name, actor_id)
         else:
@@ -88,8 +145,180 @@ class Narration:
                 + "] range."
             )
 
+    # What is needed to continue the narration in another process, once it
+    # waits for an input. Unless 'is_full', only the changes of the state since
+    # the previous checkpoint are saved, to be applied to it with
+    # apply_checkpoint_changes.
+    def save_checkpoint (self, is_full = True):
+        if (self.state_snapshot is not None):
+            # The state was not even restored yet.
+            state_data = (self.state_snapshot if is_full else None)
+        elif (self.hibernation_file is not None):
+            # Its changes cannot be told apart without rehydrating it.
+            if (
+                is_full
+                or (len(self.hibernated_changes[0]) > 0)
+                or (len(self.hibernated_changes[1]) > 0)
+            ):
+                state_data = self.get_state_snapshot()
+                self.hibernated_changes = (set(), set())
+            else:
+                state_data = None
+        elif (is_full):
+            state_data = self.state.save_snapshot()
+            self.state.snapshot_cache.clear_changes()
+        else:
+            state_data = self.state.save_snapshot_changes()
+
+        return marshal.dumps(
+            (
+                self.status,
+                self.next_input_min,
+                self.next_input_max,
+                self.text_options,
+                self.event_options,
+                self.previous_output,
+                self.instructions_since_input,
+                state_data
+            )
+        )
+
+    # Returns the full checkpoint resulting from applying each of 'changes'
+    # (oldest first) to 'data'. The state in a change is either None (no
+    # change), a whole snapshot, or changes to apply to the previous one.
+    def apply_checkpoint_changes (data, changes):
+        if (len(changes) == 0):
+            return data
+
+        state_data = marshal.loads(data)[7]
+        state_changes = []
+
+        for change in changes:
+            values = list(marshal.loads(change))
+
+            if (values[7] is None):
+                continue
+            elif (values[7][:len(snapshot.MAGIC)] == snapshot.MAGIC):
+                state_data = values[7]
+                state_changes = []
+            else:
+                state_changes.append(values[7])
+
+        values[7] = snapshot.apply_changes(state_data, state_changes)
+
+        return marshal.dumps(tuple(values))
+
+    def get_state_snapshot (self):
+        if (self.hibernation_file is not None):
+            with open(self.hibernation_file, 'rb') as f:
+                return f.read()
+
+        if (self.state_snapshot is not None):
+            return self.state_snapshot
+
+        return self.state.save_snapshot()
+
+    # Restoring 'state' is left to the first answer, so that restoring many
+    # narrations at once stays fast. Its story file is checked right away:
+    # narrations that could never be answered are not restored at all.
+    def restore_checkpoint (self, data):
+        (
+            self.status,
+            self.next_input_min,
+            self.next_input_max,
+            self.text_options,
+            self.event_options,
+            self.previous_output,
+            self.instructions_since_input,
+            self.state_snapshot
+        ) = marshal.loads(data)
+
+        if (
+            snapshot.get_content_hash(self.state_snapshot)
+            != self.state.program.content_hash
+        ):
+            raise ValueError("Checkpoint was taken on a different story file.")
+
+    # Returns True if the narration was hibernating. If its state cannot be
+    # rehydrated, it is lost: the narration cannot be used anymore.
+    def restore_state (self):
+        if (self.hibernation_file is not None):
+            try:
+                with open(self.hibernation_file, 'rb') as f:
+                    data = f.read()
+
+                self.state = tonkadur.Tonkadur(
+                    self.story_file.filename,
+                    self.initiator_name,
+                    self.initiator_id,
+                    optimize = Narration.optimize,
+                    program = self.hibernated_program
+                )
+                self.state.restore_snapshot(data)
+            except Exception:
+                self.state = None
+                self.discard_hibernated_state()
+
+                raise
+
+            self.state.memory_usage = self.hibernated_memory_usage
+            (
+                self.state.snapshot_cache.changed_keys,
+                self.state.snapshot_cache.removed_keys
+            ) = self.hibernated_changes
+            self.discard_hibernated_state()
+
+            return True
+
+        if (self.state_snapshot is not None):
+            self.state.restore_snapshot(self.state_snapshot)
+            self.state_snapshot = None
+
+        return False
+
+    # Only the narration itself stays in memory, its state being written to
+    # 'filename'. Returns False if it was not hibernated: narrations being
+    # profiled stay as they are.
+    def hibernate (self, filename):
+        if (
+            (self.hibernation_file is not None)
+            or (self.state.profiler is not None)
+        ):
+            return False
+
+        data = self.get_state_snapshot()
+
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+        self.hibernation_file = filename
+        self.hibernated_memory_usage = self.state.memory_usage
+        self.hibernated_program = self.state.program
+        self.hibernated_changes = (
+            self.state.snapshot_cache.changed_keys,
+            self.state.snapshot_cache.removed_keys
+        )
+        self.state = None
+        self.state_snapshot = None
+
+        return True
+
+    def discard_hibernated_state (self):
+        if (self.hibernation_file is not None):
+            try:
+                os.remove(self.hibernation_file)
+            except OSError:
+                pass
+
+            self.hibernation_file = None
+            self.hibernated_program = None
+
     def finalize (self):
-        Narration.free_ids.append(self.id)
+        heapq.heappush(Narration.free_ids, self.id)
+        self.is_finalized = True
+
+    def has_been_finalized (self):
+        return self.is_finalized
 
     def handle_option_input (self, text, actor_name, actor_id):
         user_input = int(text)
@@ -103,10 +332,13 @@ class Narration:
             return
 
         self.status = Narration.IS_RUNNING
+        self.instructions_since_input = 0
         self.state.resolve_choice_to(self.text_options[user_input], actor_name, actor_id)
         self.run(actor_name, actor_id)
 
     def handle_answer (self, text, actor_name, actor_id):
+        self.restore_state()
+
         if self.status == Narration.NOT_STARTED:
             self.run(actor_name, actor_id)
         elif self.status == Narration.WANTS_INT:
@@ -139,32 +371,29 @@ class Narration:
         # TODO: Event support.
 
     def text_to_string (text):
-        str_content = ""
-
-        if (not (text['effect'] is None)):
-            str_content += "{(" + str(text['effect']) + ") "
-
-        for c in text['content']:
-            if (isinstance(c, str)):
-                str_content += c
-            else:
-                str_content += Narration.text_to_string(c)
+        return text_renderer.to_string(text)
 
-        if (not (text['effect'] is None)):
-            str_content += "}"
-
-        return str_content
+    # The output is kept as a list of chunks, only joined when it is popped.
+    def display_text (self, text):
+        start = len(self.output)
 
+        text_renderer.render(
+            text,
+            self.output,
+            self.state.program.constant_texts
+        )
 
-    def display_text (self, text):
-        self.display_string(Narration.text_to_string(text))
+        for i in range(start, len(self.output)):
+            self.output_size += len(self.output[i])
 
     def display_string (self, string):
-        self.output += string
+        self.output.append(string)
+        self.output_size += len(string)
 
     def pop_output_string (self):
-        self.previous_output = self.output
-        self.output = ""
+        self.previous_output = "".join(self.output)
+        self.output = []
+        self.output_size = 0
 
         return self.previous_output
 
@@ -195,20 +424,144 @@ class Narration:
     def has_ended (self):
         return (self.status == Narration.HAS_ENDED)
 
+    # True if the narration gave control back before needing any input, in
+    # which case 'resume' has to be called to let it continue.
+    def is_running (self):
+        return (self.status == Narration.IS_RUNNING)
+
+    def resume (self):
+        (actor_name, actor_id) = self.state.last_actor
+
+        self.run(actor_name, actor_id)
+
+    def abort (self, reason):
+        self.display_string("\n" + reason)
+        self.status = Narration.HAS_ENDED
+
+    # Done when the narration stops to wait for an input, as nothing is being
+    # computed then. Only under the same allocation pressure as while running:
+    # collecting walks the whole memory, which a short reply should not pay for.
+    def collect_garbage (self):
+        if (self.state.has_allocation_pressure()):
+            self.state.collect_garbage()
+        else:
+            self.state.update_memory_usage()
+
+    # See Tonkadur.get_allocation_stats. Counted since the state was last
+    # restored.
+    def get_allocation_stats (self):
+        self.restore_state()
+
+        return self.state.get_allocation_stats()
+
+    # Memory of the state as of its last measure (see Tonkadur.measure_memory),
+    # plus the output not popped yet. None if the state was never measured.
+    def get_memory_usage (self):
+        if (self.state is None):
+            usage = self.hibernated_memory_usage
+        else:
+            usage = self.state.memory_usage
+
+        if (usage is None):
+            return None
+
+        return memory.MemoryUsage(
+            usage.objects,
+            usage.entries,
+            (usage.size + self.output_size)
+        )
+
+    # Returns True if the narration was aborted.
+    def enforce_memory_limit (self):
+        if ((Narration.max_memory is None) or self.has_ended()):
+            return False
+
+        size = self.output_size
+
+        if (self.state.memory_usage is not None):
+            size += self.state.memory_usage.size
+
+        if (size <= Narration.max_memory):
+            return False
+
+        self.abort(
+            "This narration was aborted: it used more than "
+            + str(Narration.max_memory)
+            + " bytes of memory."
+        )
+
+        return True
+
+    # Runs until the narration needs an input, has ended, or has used its
+    # instruction budget.
     def run (self, actor_name, actor_id):
-        result = self.state.run(actor_name, actor_id)
-        result_category = result['category']
+        self.restore_state()
 
-        if (self.status == Narration.NOT_STARTED):
-            self.status = Narration.IS_RUNNING
+        while True:
+            result = self.state.run(
+                actor_name,
+                actor_id,
+                Narration.instruction_budget
+            )
+            result_category = result['category']
+
+            if (self.status == Narration.NOT_STARTED):
+                self.status = Narration.IS_RUNNING
+
+            if (result_category == "display"):
+                self.display_text(result['content'])
+
+                if (self.enforce_memory_limit()):
+                    return
+            elif (result_category == "assert"):
+                print(
+                    "Assert failed at line "
+                    + str(result['line'])
+                    + ":"
+                    + str(result['message'])
+                )
+                print(str(self.state.memory))
+                self.display_string(
+                    "\nAssert failed at line "
+                    + str(result['line'])
+                    + ": "
+                )
+                self.display_text(result['message'])
+                self.display_string(
+                    "\nState of memory:\n"
+                    + str(self.state.memory)
+                )
+            else:
+                self.handle_run_result(result)
+                self.enforce_memory_limit()
+
+                return
+
+    def handle_run_result (self, result):
+        result_category = result['category']
 
         if (result_category == "end"):
             self.status = Narration.HAS_ENDED
-        elif (result_category == "display"):
-            self.display_text(result['content'])
-            self.run(actor_name, actor_id)
+        elif (result_category == "yield"):
+            self.instructions_since_input += Narration.instruction_budget
+            # Stories can grow their memory without allocating, so a
+            # collection may never come.
+            self.state.update_memory_usage()
+
+            if (
+                (Narration.max_instructions_per_input is not None)
+                and (
+                    self.instructions_since_input
+                    >= Narration.max_instructions_per_input
+                )
+            ):
+                self.abort(
+                    "This narration was aborted: it ran for too long without"
+                    " requiring any input."
+                )
         elif (result_category == "prompt_integer"):
             self.reset_next_input()
+            self.collect_garbage()
             self.status = Narration.WANTS_INT
             self.next_input_min = result['min']
             self.next_input_max = result['max']
@@ -222,6 +575,7 @@ class Narration:
             )
         elif (result_category == "prompt_string"):
             self.reset_next_input()
+            self.collect_garbage()
             self.status = Narration.WANTS_STR
             self.next_input_min = result['min']
             self.next_input_max = result['max']
@@ -233,27 +587,9 @@ class Narration:
                 + str(result['max'])
                 + " is expected)\n"
             )
-        elif (result_category == "assert"):
-            print(
-                "Assert failed at line "
-                + str(result['line'])
-                + ":"
-                + str(result['message'])
-            )
-            print(str(state.memory))
-            self.display_string(
-                "\nAssert failed at line "
-                + str(result['line'])
-                + ": "
-            )
-            self.display_text(result['message'])
-            self.display_string(
-                "\nState of memory:\n"
-                + str(state.memory)
-            )
-            self.run(actor_name, actor_id)
         elif (result_category == "resolve_choice"):
             self.reset_next_input()
+            self.collect_garbage()
             self.status = Narration.WANTS_USER_CHOICE
             current_choice = 0
 
@@ -269,4 +605,3 @@ class Narration:
                     # TODO: handle events.
                     self.event_options.append(current_choice)
                 current_choice += 1
-
@@ -0,0 +1,313 @@
+import compiler
+
+################################################################################
+## TREE LAYOUT #################################################################
+################################################################################
+# Fields holding a computation, and fields holding a list of computations, for
+# each category. Whatever is not listed here is left untouched.
+COMPUTATION_FIELDS = {
+    "add_text_effect": ([], ['parameters', 'content']),
+    "cast": (['content'], []),
+    "if_else": (['condition', 'if_true', 'if_false'], []),
+    "operation": (['x', 'y'], []),
+    "address": (['address'], []),
+    "relative_address": (['base', 'extra'], []),
+    "text": ([], ['content']),
+    "size": (['reference'], []),
+    "value_of": (['reference'], []),
+}
+
+INSTRUCTION_FIELDS = {
+    "add_text_option": (['label'], []),
+    "add_event_option": ([], ['parameters']),
+    "assert": (['condition', 'message'], []),
+    "display": (['content'], []),
+    "extra_instruction": ([], ['parameters']),
+    "remove": (['reference'], []),
+    "set_pc": (['value'], []),
+    "set_value": (['reference', 'value'], []),
+    "initialize": (['reference'], []),
+    "prompt_integer": (['min', 'max', 'label', 'target'], []),
+    "prompt_string": (['min', 'max', 'label', 'target'], []),
+}
+
+def count_nodes (computation):
+    result = 1
+    (fields, list_fields) = COMPUTATION_FIELDS.get(
+        computation['category'],
+        ([], [])
+    )
+
+    for field in fields:
+        if (field in computation):
+            result += count_nodes(computation[field])
+
+    for field in list_fields:
+        for c in computation[field]:
+            result += count_nodes(c)
+
+    return result
+
+def count_code_nodes (code):
+    result = 0
+
+    for instruction in code:
+        (fields, list_fields) = INSTRUCTION_FIELDS.get(
+            instruction['category'],
+            ([], [])
+        )
+
+        for field in fields:
+            if (field in instruction):
+                result += count_nodes(instruction[field])
+
+        for field in list_fields:
+            for c in instruction[field]:
+                result += count_nodes(c)
+
+    return result
+
+################################################################################
+## CONSTANTS ###################################################################
+################################################################################
+def is_constant (computation):
+    return (computation['category'] == "constant")
+
+def is_string_constant (computation):
+    return (
+        is_constant(computation)
+        and (computation['type']['category'] == "string")
+    )
+
+def make_constant (value):
+    result = dict()
+    result['category'] = "constant"
+
+    # bool first: True and False are also ints.
+    if (type(value) is bool):
+        result['type'] = {'category': "bool"}
+        result['value'] = "true" if value else "false"
+    elif (type(value) is int):
+        result['type'] = {'category': "int"}
+        result['value'] = str(value)
+    elif (type(value) is float):
+        result['type'] = {'category': "float"}
+        result['value'] = repr(value)
+    elif (type(value) is str):
+        result['type'] = {'category': "string"}
+        result['value'] = value
+    else:
+        return None
+
+    return result
+
+def get_constant_value (computation):
+    return compiler.convert_constant(
+        computation['type']['category'],
+        computation['value']
+    )
+
+################################################################################
+## OPTIMIZER ###################################################################
+################################################################################
+class OptimizationReport:
+    def __init__ (self):
+        self.nodes_before = 0
+        self.nodes_after = 0
+        self.folded_constants = 0
+        self.removed_casts = 0
+        self.pruned_branches = 0
+
+    def to_tuple (self):
+        return (
+            self.nodes_before,
+            self.nodes_after,
+            self.folded_constants,
+            self.removed_casts,
+            self.pruned_branches
+        )
+
+    def from_tuple (values):
+        result = OptimizationReport()
+
+        (
+            result.nodes_before,
+            result.nodes_after,
+            result.folded_constants,
+            result.removed_casts,
+            result.pruned_branches
+        ) = values
+
+        return result
+
+    def get_eliminated_nodes (self):
+        return (self.nodes_before - self.nodes_after)
+
+    def to_string (self):
+        return (
+            "eliminated "
+            + str(self.get_eliminated_nodes())
+            + " of "
+            + str(self.nodes_before)
+            + " nodes (folded "
+            + str(self.folded_constants)
+            + " constants, removed "
+            + str(self.removed_casts)
+            + " casts, pruned "
+            + str(self.pruned_branches)
+            + " branches)"
+        )
+
+class Optimizer:
+    def __init__ (self):
+        self.report = OptimizationReport()
+
+    # Evaluates a computation whose operands are all constants. The compiled
+    # version is used so that folding cannot differ from what would have been
+    # computed at runtime. Anything that fails (division by zero, invalid
+    # casts...) is left for the runtime to report.
+    def fold (self, computation):
+        try:
+            value = compiler.compile_computation(computation)(None)
+        except Exception:
+            return computation
+
+        result = make_constant(value)
+
+        if (result is None):
+            return computation
+
+        self.report.folded_constants += 1
+
+        return result
+
+    def optimize_fields (self, node, fields, list_fields):
+        result = dict(node)
+
+        for field in fields:
+            if (field in node):
+                result[field] = self.optimize_computation(node[field])
+
+        for field in list_fields:
+            result[field] = [self.optimize_computation(c) for c in node[field]]
+
+        return result
+
+    def optimize_cast (self, computation):
+        content = self.optimize_computation(computation['content'])
+
+        if (computation['from']['category'] == computation['to']['category']):
+            self.report.removed_casts += 1
+
+            return content
+
+        result = dict(computation)
+        result['content'] = content
+
+        if (is_constant(content)):
+            return self.fold(result)
+
+        return result
+
+    def optimize_operation (self, computation):
+        result = self.optimize_fields(computation, ['x', 'y'], [])
+
+        if (
+            (result['operator'] != "rand")
+            and is_constant(result['x'])
+            and ((not ('y' in result)) or is_constant(result['y']))
+        ):
+            return self.fold(result)
+
+        return result
+
+    def optimize_if_else (self, computation):
+        condition = self.optimize_computation(computation['condition'])
+
+        if (is_constant(condition)):
+            try:
+                condition_value = get_constant_value(condition)
+            except ValueError:
+                condition_value = None
+
+            if (condition_value is not None):
+                self.report.pruned_branches += 1
+
+                if (condition_value):
+                    return self.optimize_computation(computation['if_true'])
+                else:
+                    return self.optimize_computation(computation['if_false'])
+
+        result = self.optimize_fields(computation, ['if_true', 'if_false'], [])
+        result['condition'] = condition
+
+        return result
+
+    def optimize_text (self, computation):
+        content = []
+
+        for c in computation['content']:
+            cc = self.optimize_computation(c)
+
+            # Texts without effect are flattened into their parent at runtime.
+            if (cc['category'] == "text"):
+                parts = cc['content']
+            elif (cc['category'] == "newline"):
+                parts = [make_constant("\n")]
+            else:
+                parts = [cc]
+
+            for part in parts:
+                if (
+                    is_string_constant(part)
+                    and (len(content) > 0)
+                    and is_string_constant(content[-1])
+                ):
+                    content[-1] = make_constant(
+                        content[-1]['value'] + part['value']
+                    )
+                    self.report.folded_constants += 1
+                else:
+                    content.append(part)
+
+        result = dict(computation)
+        result['content'] = content
+
+        return result
+
+    def optimize_computation (self, computation):
+        category = computation['category']
+
+        if (category == "cast"):
+            return self.optimize_cast(computation)
+        elif (category == "operation"):
+            return self.optimize_operation(computation)
+        elif (category == "if_else"):
+            return self.optimize_if_else(computation)
+        elif (category == "text"):
+            return self.optimize_text(computation)
+        elif (category in COMPUTATION_FIELDS):
+            (fields, list_fields) = COMPUTATION_FIELDS[category]
+
+            return self.optimize_fields(computation, fields, list_fields)
+
+        return computation
+
+    def optimize_instruction (self, instruction):
+        category = instruction['category']
+
+        if (category in INSTRUCTION_FIELDS):
+            (fields, list_fields) = INSTRUCTION_FIELDS[category]
+
+            return self.optimize_fields(instruction, fields, list_fields)
+
+        return instruction
+
+def optimize_code (code):
+    optimizer = Optimizer()
+    result = [optimizer.optimize_instruction(i) for i in code]
+
+    optimizer.report.nodes_before = count_code_nodes(code)
+    optimizer.report.nodes_after = count_code_nodes(result)
+
+    return (result, optimizer.report)
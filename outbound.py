@@ -0,0 +1,222 @@
+import asyncio
+import collections
+import time
+
+################################################################################
+## MESSAGE SPLITTING ###########################################################
+################################################################################
+# Discord refuses messages over this many characters.
+MESSAGE_LIMIT = 2000
+
+# Cuts at the last paragraph break that fits, or line break, or space, and only
+# in the middle of a line or word if there is none.
+def split_message (content, limit = MESSAGE_LIMIT):
+    result = []
+
+    while (len(content) > limit):
+        for separator in ("\n\n", "\n", " "):
+            cut = content.rfind(separator, 0, (limit + 1))
+
+            if (cut > 0):
+                result.append(content[:cut])
+                content = content[(cut + len(separator)):]
+
+                break
+        else:
+            result.append(content[:limit])
+            content = content[limit:]
+
+    if ((len(content) > 0) or (len(result) == 0)):
+        result.append(content)
+
+    return result
+
+################################################################################
+## OUTBOX ######################################################################
+################################################################################
+# Messages waiting to be sent to a channel. A task sends them in order while
+# there are some, then stops.
+class ChannelOutbox:
+    def __init__ (self, channel):
+        self.channel = channel
+        self.pending = collections.deque()
+        # When the last messages were sent, for rate limiting.
+        self.send_times = collections.deque()
+        self.task = None
+
+class OutboxStatistics:
+    def __init__ (self):
+        self.queued = 0
+        self.sent_messages = 0
+        self.split_messages = 0
+        self.failures = 0
+        self.max_depth = 0
+        # Time between queuing and sending the last part, in seconds.
+        self.latencies = collections.deque(maxlen = 1000)
+
+# Sends replies without holding up the handling of the next messages. Each
+# channel gets at most 'limit' messages per 'window' seconds, Discord's own
+# limit being 5 per 5 seconds. 'on_sent(narration, message)' is called with
+# the last message sent for a narration's output.
+class Outbox:
+    def __init__ (self, limit = 5, window = 5.0, on_sent = None):
+        self.limit = limit
+        self.window = window
+        self.on_sent = on_sent
+        self.channels = dict()
+        self.depth = 0
+        self.statistics = OutboxStatistics()
+
+    # Returns a future for the list of messages that were sent (None if
+    # sending failed).
+    def send (self, channel, content, reference = None, narration = None):
+        result = asyncio.get_running_loop().create_future()
+
+        if ((self.statistics.queued % 1000) == 999):
+            self.remove_idle_channels()
+
+        channel_outbox = self.channels.get(channel.id)
+
+        if (channel_outbox is None):
+            channel_outbox = ChannelOutbox(channel)
+            self.channels[channel.id] = channel_outbox
+
+        channel_outbox.pending.append(
+            (content, reference, narration, time.perf_counter(), result)
+        )
+
+        self.depth += 1
+        self.statistics.queued += 1
+        self.statistics.max_depth = max(self.statistics.max_depth, self.depth)
+
+        if (channel_outbox.task is None):
+            channel_outbox.task = asyncio.get_running_loop().create_task(
+                self.run(channel_outbox)
+            )
+
+        return result
+
+    async def wait_for_rate_limit (self, channel_outbox):
+        send_times = channel_outbox.send_times
+
+        while True:
+            now = time.monotonic()
+
+            while (
+                (len(send_times) > 0)
+                and ((send_times[0] + self.window) <= now)
+            ):
+                send_times.popleft()
+
+            if (len(send_times) < self.limit):
+                send_times.append(now)
+
+                return
+
+            await asyncio.sleep(send_times[0] + self.window - now)
+
+    # Only the last part replies to 'reference': it is the one players have to
+    # reply to in order to continue a narration.
+    async def send_now (self, channel_outbox, content, reference):
+        parts = split_message(content)
+        result = []
+
+        if (len(parts) > 1):
+            self.statistics.split_messages += 1
+
+        for i in range(len(parts)):
+            await self.wait_for_rate_limit(channel_outbox)
+
+            result.append(
+                await channel_outbox.channel.send(
+                    content = parts[i],
+                    reference = (reference if (i == (len(parts) - 1)) else None)
+                )
+            )
+            self.statistics.sent_messages += 1
+
+        return result
+
+    async def run (self, channel_outbox):
+        while (len(channel_outbox.pending) > 0):
+            (content, reference, narration, queued_at, result) = (
+                channel_outbox.pending.popleft()
+            )
+            self.depth -= 1
+
+            try:
+                messages = await self.send_now(
+                    channel_outbox,
+                    content,
+                    reference
+                )
+            except Exception as e:
+                self.statistics.failures += 1
+                print(
+                    "[E] Could not send a message to channel "
+                    + str(channel_outbox.channel.id)
+                    + ": "
+                    + str(e)
+                )
+                result.set_result(None)
+
+                continue
+
+            self.statistics.latencies.append(time.perf_counter() - queued_at)
+
+            if ((narration is not None) and (self.on_sent is not None)):
+                self.on_sent(narration, messages[-1])
+
+            result.set_result(messages)
+
+        channel_outbox.task = None
+
+    # Idle channels are kept until their send times no longer matter.
+    def remove_idle_channels (self):
+        now = time.monotonic()
+
+        for (channel_id, channel_outbox) in list(self.channels.items()):
+            if (
+                (channel_outbox.task is None)
+                and (
+                    (len(channel_outbox.send_times) == 0)
+                    or (channel_outbox.send_times[-1] + self.window <= now)
+                )
+            ):
+                del self.channels[channel_id]
+
+    def get_depth (self):
+        return self.depth
+
+    def to_string (self):
+        latencies = sorted(self.statistics.latencies)
+        result = (
+            "Outbox: "
+            + str(self.depth)
+            + " queued (at most "
+            + str(self.statistics.max_depth)
+            + "), "
+            + str(self.statistics.queued)
+            + " replies sent as "
+            + str(self.statistics.sent_messages)
+            + " messages ("
+            + str(self.statistics.split_messages)
+            + " split), "
+            + str(self.statistics.failures)
+            + " failures."
+        )
+
+        if (len(latencies) > 0):
+            result += (
+                "\nSend latency: p50 "
+                + ("%.1f" % (latencies[len(latencies) // 2] * 1000))
+                + "ms, p99 "
+                + ("%.1f" % (latencies[(len(latencies) * 99) // 100] * 1000))
+                + "ms, max "
+                + ("%.1f" % (latencies[-1] * 1000))
+                + "ms (last "
+                + str(len(latencies))
+                + ")."
+            )
+
+        return result
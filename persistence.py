@@ -0,0 +1,488 @@
+import marshal
+import os
+import struct
+import zlib
+
+################################################################################
+## FORMAT ######################################################################
+################################################################################
+# The bot's state is kept in a directory holding two files:
+#  - STATE_FILENAME: MAGIC, a version byte, then the state as of the last
+#    compaction, written as the changes that would create it,
+#  - LOG_FILENAME: every change since.
+# Both hold records: a change's length and CRC32 (RECORD_HEADER), then the
+# marshal'd (change, key, value).
+#
+# Changes replace whatever the state held for their key (an administrator, a
+# story, a narration, or a narration's checkpoint), so replaying a change that
+# is already in the state file does nothing. This is what makes compaction
+# safe: the new state file replaces the old one, then the log is replaced by
+# the changes logged since the compaction started, and a crash in between only
+# means replaying the old log again. Checkpoint
+# changes (UPDATE_CHECKPOINT) only set values as well, so applying those that
+# were already folded into the state file again gives the same checkpoint.
+#
+# A crash while appending leaves a truncated record at the end of the log: it
+# and anything after it are dropped when the log is replayed.
+MAGIC = b"TKJ"
+VERSION = 2
+STATE_FILENAME = "state.tkj"
+LOG_FILENAME = "journal.log"
+RECORD_HEADER = struct.Struct("<II")
+
+# Changes, as logged.
+SET_ADMINISTRATOR = 0 # (user ID, user tag, or None if removed)
+SET_STORY = 1 # (story ID, (filename, name, description, is listed))
+SET_NARRATION = 2 # (narration ID, (story ID, initiator name, initiator ID,
+                  #  is paused, is orphaned, last post ID))
+SET_CHECKPOINT = 3 # (narration ID, Narration.save_checkpoint() data)
+REMOVE_NARRATION = 4 # (narration ID, None)
+UPDATE_CHECKPOINT = 5 # (narration ID, Narration.save_checkpoint(False) data)
+
+# Where records are, as (file, offset of the change, length of the change).
+STATE_FILE = 0
+LOG_FILE = 1
+FILENAMES = (STATE_FILENAME, LOG_FILENAME)
+
+def encode_record (change, key, value):
+    payload = marshal.dumps((change, key, value))
+
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+################################################################################
+## JOURNAL #####################################################################
+################################################################################
+# Writes each change with a single unbuffered append, so that it survives the
+# bot crashing right after. Nothing is synced to the disk: a crash of the
+# machine itself can still lose the last changes.
+#
+# The journal keeps the state in memory, but for checkpoints: only where their
+# records are is kept, they are read back when needed (restoring narrations,
+# compacting). After the first checkpoint of a narration, only the changes to
+# it are logged, 'apply_checkpoint_changes(data, changes)' folding them back
+# into a whole checkpoint.
+#
+# Compaction is needed once the log is larger than both 'compaction_threshold'
+# bytes and the state file, so that its cost stays proportional to the changes
+# it gets rid of. It writes one checkpoint at a time. Writing the new state
+# file (write_compaction) touches nothing else of the journal, so that it can
+# be done in another thread while changes keep being logged.
+class Journal:
+    def __init__ (
+        self,
+        directory,
+        apply_checkpoint_changes,
+        compaction_threshold = (8 * 1024 * 1024)
+    ):
+        self.directory = directory
+        self.apply_checkpoint_changes = apply_checkpoint_changes
+        self.compaction_threshold = compaction_threshold
+        self.administrators = dict()
+        self.stories = dict()
+        self.narrations = dict()
+        # Narration ID -> locations of its checkpoint, then of its changes.
+        self.checkpoints = dict()
+        self.state_size = 0
+        self.log_size = 0
+        self.records = 0
+        self.compactions = 0
+        self.log = None
+        # Files being read, by STATE_FILE and LOG_FILE.
+        self.readers = [None, None]
+        # The compaction being written, see start_compaction.
+        self.compaction = None
+
+        os.makedirs(directory, exist_ok = True)
+
+        self.load_state()
+        self.replay_log()
+
+        self.log = open(self.get_path(LOG_FILENAME), 'ab', buffering = 0)
+
+    def get_path (self, filename):
+        return os.path.join(self.directory, filename)
+
+    #### LOADING ###############################################################
+    # Applies the records of 'f', from its current position on, stopping at
+    # the first one that is truncated or corrupted. Returns (position after the
+    # last valid record, records applied).
+    def replay (self, f, file_index):
+        offset = f.tell()
+        records = 0
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+
+            if (len(header) < RECORD_HEADER.size):
+                break
+
+            (length, checksum) = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+
+            if ((len(payload) < length) or (zlib.crc32(payload) != checksum)):
+                break
+
+            (change, key, value) = marshal.loads(payload)
+            self.apply(
+                change,
+                key,
+                value,
+                (file_index, (offset + RECORD_HEADER.size), length)
+            )
+            records += 1
+            offset += RECORD_HEADER.size + length
+
+        return (offset, records)
+
+    def load_state (self):
+        try:
+            f = open(self.get_path(STATE_FILENAME), 'rb')
+        except FileNotFoundError:
+            return
+
+        with f:
+            header = f.read(len(MAGIC) + 1)
+
+            if (
+                (header[:len(MAGIC)] != MAGIC)
+                or (len(header) <= len(MAGIC))
+                or (header[len(MAGIC)] != VERSION)
+            ):
+                raise ValueError(
+                    "Unsupported state file in " + self.directory + "."
+                )
+
+            (self.state_size, _) = self.replay(f, STATE_FILE)
+
+            if (self.state_size != f.seek(0, os.SEEK_END)):
+                raise ValueError(
+                    "Corrupted state file in " + self.directory + "."
+                )
+
+    def replay_log (self):
+        path = self.get_path(LOG_FILENAME)
+
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with f:
+            (offset, self.records) = self.replay(f, LOG_FILE)
+            size = f.seek(0, os.SEEK_END)
+
+        if (offset < size):
+            print(
+                "[W] Dropped "
+                + str(size - offset)
+                + " bytes of incomplete changes at the end of "
+                + path
+                + "."
+            )
+
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+
+        self.log_size = offset
+
+    # 'location' is where the record of the change is.
+    def apply (self, change, key, value, location):
+        if (change == SET_ADMINISTRATOR):
+            if (value is None):
+                self.administrators.pop(key, None)
+            else:
+                self.administrators[key] = value
+        elif (change == SET_STORY):
+            self.stories[key] = value
+        elif (change == SET_NARRATION):
+            self.narrations[key] = value
+        elif (change == SET_CHECKPOINT):
+            # The narration may have been removed while it was checkpointed.
+            if (key in self.narrations):
+                self.checkpoints[key] = [location]
+        elif (change == UPDATE_CHECKPOINT):
+            if (key in self.checkpoints):
+                self.checkpoints[key].append(location)
+        elif (change == REMOVE_NARRATION):
+            self.narrations.pop(key, None)
+            self.checkpoints.pop(key, None)
+
+    #### CHANGES ###############################################################
+    def write (self, change, key, value):
+        record = encode_record(change, key, value)
+
+        self.apply(
+            change,
+            key,
+            value,
+            (
+                LOG_FILE,
+                (self.log_size + RECORD_HEADER.size),
+                (len(record) - RECORD_HEADER.size)
+            )
+        )
+
+        self.log.write(record)
+        self.log_size += len(record)
+        self.records += 1
+
+    def set_administrator (self, user_id, user_tag):
+        self.write(SET_ADMINISTRATOR, user_id, user_tag)
+
+    def set_story (self, story_id, filename, name, description, is_listed):
+        self.write(
+            SET_STORY,
+            story_id,
+            (filename, name, description, is_listed)
+        )
+
+    def set_narration (
+        self,
+        narration_id,
+        story_id,
+        initiator_name,
+        initiator_id,
+        is_paused,
+        is_orphaned,
+        last_post_id
+    ):
+        self.write(
+            SET_NARRATION,
+            narration_id,
+            (
+                story_id,
+                initiator_name,
+                initiator_id,
+                is_paused,
+                is_orphaned,
+                last_post_id
+            )
+        )
+
+    def set_checkpoint (self, narration_id, data):
+        if (narration_id in self.narrations):
+            self.write(SET_CHECKPOINT, narration_id, data)
+
+    # Only for narrations that already have a checkpoint.
+    def update_checkpoint (self, narration_id, changes):
+        if (narration_id in self.checkpoints):
+            self.write(UPDATE_CHECKPOINT, narration_id, changes)
+
+    def remove_narration (self, narration_id):
+        if (narration_id in self.narrations):
+            self.write(REMOVE_NARRATION, narration_id, None)
+
+    #### STATE #################################################################
+    # Returns (
+    #   {user ID: user tag},
+    #   {story ID: (filename, name, description, is listed)},
+    #   {narration ID: (story ID, initiator name, initiator ID, is paused,
+    #       is orphaned, last post ID)}
+    # )
+    def get_state (self):
+        return (self.administrators, self.stories, self.narrations)
+
+    def has_checkpoint (self, narration_id):
+        return (narration_id in self.checkpoints)
+
+    # 'readers' are the files being read, by STATE_FILE and LOG_FILE.
+    def read_value (self, location, readers):
+        (file_index, offset, length) = location
+        reader = readers[file_index]
+
+        if (reader is None):
+            reader = open(self.get_path(FILENAMES[file_index]), 'rb')
+            readers[file_index] = reader
+
+        reader.seek(offset)
+
+        return marshal.loads(reader.read(length))[2]
+
+    def read_checkpoint (self, locations, readers):
+        return self.apply_checkpoint_changes(
+            self.read_value(locations[0], readers),
+            [self.read_value(location, readers) for location in locations[1:]]
+        )
+
+    # Returns None if the narration has no checkpoint.
+    def get_checkpoint (self, narration_id):
+        locations = self.checkpoints.get(narration_id)
+
+        if (locations is None):
+            return None
+
+        return self.read_checkpoint(locations, self.readers)
+
+    def close_readers (self, readers = None):
+        if (readers is None):
+            readers = self.readers
+
+        for i in range(len(readers)):
+            if (readers[i] is not None):
+                readers[i].close()
+                readers[i] = None
+
+    #### COMPACTION ############################################################
+    def needs_compaction (self):
+        return (
+            (self.compaction is None)
+            and (
+                self.log_size
+                >= max(self.compaction_threshold, self.state_size)
+            )
+        )
+
+    # Takes what the new state file will hold, as of now. Unlisted stories are
+    # only kept while narrations still use them. Returns the compaction, to be
+    # given to write_compaction, then to end_compaction (or cancel_compaction
+    # if writing it failed).
+    def start_compaction (self):
+        used_stories = set(value[0] for value in self.narrations.values())
+
+        for story_id in list(self.stories):
+            if (not (self.stories[story_id][3] or (story_id in used_stories))):
+                del self.stories[story_id]
+
+        records = []
+
+        for (change, values) in (
+            (SET_ADMINISTRATOR, self.administrators),
+            (SET_STORY, self.stories),
+            (SET_NARRATION, self.narrations)
+        ):
+            for (key, value) in values.items():
+                records.append(encode_record(change, key, value))
+
+        self.compaction = (
+            records,
+            {
+                narration_id: list(locations)
+                for (narration_id, locations) in self.checkpoints.items()
+            },
+            self.log_size
+        )
+
+        return self.compaction
+
+    # Each narration's checkpoint changes are folded into its checkpoint.
+    # Returns (the new state file's temporary path, the new locations of the
+    # checkpoints, its size).
+    def write_compaction (self, compaction):
+        (records, checkpoints, log_size) = compaction
+        temporary_path = (
+            self.get_path(STATE_FILENAME) + "." + str(os.getpid())
+        )
+        locations = dict()
+        readers = [None, None]
+
+        try:
+            with open(temporary_path, 'wb') as f:
+                f.write(MAGIC + bytes([VERSION]))
+
+                for record in records:
+                    f.write(record)
+
+                for (narration_id, checkpoint) in checkpoints.items():
+                    record = encode_record(
+                        SET_CHECKPOINT,
+                        narration_id,
+                        self.read_checkpoint(checkpoint, readers)
+                    )
+                    locations[narration_id] = [
+                        (
+                            STATE_FILE,
+                            (f.tell() + RECORD_HEADER.size),
+                            (len(record) - RECORD_HEADER.size)
+                        )
+                    ]
+                    f.write(record)
+
+                state_size = f.tell()
+        finally:
+            self.close_readers(readers)
+
+        return (temporary_path, locations, state_size)
+
+    # The changes logged while the compaction was being written are kept, as
+    # the start of the new log.
+    def end_compaction (self, compaction, result):
+        (records, checkpoints, log_size) = compaction
+        (temporary_path, locations, state_size) = result
+        log_path = self.get_path(LOG_FILENAME)
+        temporary_log_path = log_path + "." + str(os.getpid())
+
+        with open(log_path, 'rb') as f:
+            f.seek(log_size)
+            remaining_changes = f.read(self.log_size - log_size)
+
+        with open(temporary_log_path, 'wb') as f:
+            f.write(remaining_changes)
+
+        os.replace(temporary_path, self.get_path(STATE_FILENAME))
+
+        self.close_readers()
+        self.log.close()
+        os.replace(temporary_log_path, log_path)
+        self.log = open(log_path, 'ab', buffering = 0)
+
+        for (narration_id, current) in self.checkpoints.items():
+            remaining = [
+                (LOG_FILE, (offset - log_size), length)
+                for (file_index, offset, length) in current
+                if ((file_index == LOG_FILE) and (offset >= log_size))
+            ]
+
+            # Otherwise, it was set again since the compaction started.
+            if (len(remaining) < len(current)):
+                remaining = locations[narration_id] + remaining
+
+            self.checkpoints[narration_id] = remaining
+
+        self.state_size = state_size
+        self.log_size = len(remaining_changes)
+        self.compaction = None
+        self.compactions += 1
+
+    def cancel_compaction (self, compaction):
+        try:
+            os.remove(self.get_path(STATE_FILENAME) + "." + str(os.getpid()))
+        except OSError:
+            pass
+
+        self.compaction = None
+
+    def compact (self):
+        compaction = self.start_compaction()
+
+        try:
+            result = self.write_compaction(compaction)
+        except Exception:
+            self.cancel_compaction(compaction)
+
+            raise
+
+        self.end_compaction(compaction, result)
+
+    def close (self):
+        self.close_readers()
+
+        if (self.log is not None):
+            self.log.close()
+            self.log = None
+
+    def to_string (self):
+        return (
+            "Journal: "
+            + str(len(self.narrations))
+            + " narrations, "
+            + str(len(self.stories))
+            + " stories, "
+            + str(self.records)
+            + " changes logged, log at "
+            + str(self.log_size)
+            + " bytes (state file: "
+            + str(self.state_size)
+            + " bytes, "
+            + str(self.compactions)
+            + " compactions)."
+        )
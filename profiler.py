@@ -0,0 +1,127 @@
+################################################################################
+## PROFILER ####################################################################
+################################################################################
+# Filled by the profiled version of the compiled code (see compiler.py) while
+# it is attached to a Tonkadur instance. Times are in seconds and include the
+# time spent in the nested computations.
+class Profiler:
+    def __init__ (self):
+        # Category -> [count, cumulative time]
+        self.instructions = dict()
+        self.computations = dict()
+        # Program counter -> [count, cumulative time]
+        self.lines = dict()
+        self.allocations = 0
+        self.copies = 0
+
+    def add_instruction (self, line, category, duration):
+        entry = self.instructions.get(category)
+
+        if (entry is None):
+            self.instructions[category] = [1, duration]
+        else:
+            entry[0] += 1
+            entry[1] += duration
+
+        entry = self.lines.get(line)
+
+        if (entry is None):
+            self.lines[line] = [1, duration]
+        else:
+            entry[0] += 1
+            entry[1] += duration
+
+    def add_computation (self, category, duration):
+        entry = self.computations.get(category)
+
+        if (entry is None):
+            self.computations[category] = [1, duration]
+        else:
+            entry[0] += 1
+            entry[1] += duration
+
+    def get_instruction_count (self):
+        return sum(entry[0] for entry in self.instructions.values())
+
+    # Adds the measures of 'other' (from another process, for example) to this
+    # one.
+    def merge (self, other):
+        for (own, others) in (
+            (self.instructions, other.instructions),
+            (self.computations, other.computations),
+            (self.lines, other.lines)
+        ):
+            for (key, entry) in others.items():
+                own_entry = own.get(key)
+
+                if (own_entry is None):
+                    own[key] = list(entry)
+                else:
+                    own_entry[0] += entry[0]
+                    own_entry[1] += entry[1]
+
+        self.allocations += other.allocations
+        self.copies += other.copies
+
+    # (key, count, cumulative time) for the 'count' entries of 'table' with the
+    # most cumulative time.
+    def get_top_entries (table, count):
+        result = [(key, entry[0], entry[1]) for (key, entry) in table.items()]
+        result.sort(key = lambda e: e[2], reverse = True)
+
+        return result[:count]
+
+    def to_string (self, count = 10):
+        result = (
+            "Instructions: "
+            + str(self.get_instruction_count())
+            + ", allocations: "
+            + str(self.allocations)
+            + ", copies: "
+            + str(self.copies)
+            + "."
+        )
+
+        for (title, table) in (
+            ("Instructions", self.instructions),
+            ("Computations", self.computations),
+            ("Lines", self.lines)
+        ):
+            result += "\n" + title + " (count, total ms, mean us):"
+
+            for (key, hits, duration) in Profiler.get_top_entries(table, count):
+                result += (
+                    "\n - "
+                    + str(key)
+                    + ": "
+                    + str(hits)
+                    + ", "
+                    + ("%.2f" % (duration * 1000))
+                    + ", "
+                    + ("%.2f" % ((duration * 1000000) / hits))
+                )
+
+        return result
+
+################################################################################
+## STORY PROFILERS #############################################################
+################################################################################
+# Profilers shared by all the narrations of a story file, including the ones
+# created after profiling was enabled.
+# Absolute path of the story file -> Profiler
+story_profilers = dict()
+
+def get_story_profiler (filename):
+    return story_profilers.get(filename)
+
+def enable_story_profiler (filename):
+    result = story_profilers.get(filename)
+
+    if (result is None):
+        result = Profiler()
+        story_profilers[filename] = result
+
+    return result
+
+def disable_story_profiler (filename):
+    return story_profilers.pop(filename, None)
@@ -0,0 +1,242 @@
+import itertools
+
+################################################################################
+## REGISTRY ####################################################################
+################################################################################
+# The stories and narrations known to the bot, indexed for each way the
+# commands look them up. Stories are listed by index (the order they were
+# added in, as shown to users) and filename. Narrations are indexed by ID, by
+# the post players reply to, by story (in their story's 'narrations'), by
+# initiator, and by whether they are paused or orphaned.
+#
+# Everything but removing a story is O(1). Stories are few, so removing one
+# from the list is not worth indexing.
+#
+# The listing commands show narrations one page at a time. Each narration's
+# entry is rendered once, then kept until the narration is paused, resumed,
+# orphaned, deleted, or its story is renamed.
+class Registry:
+    def __init__ (self):
+        self.stories = []
+        # Stories get an ID that, unlike their index, never changes.
+        self.next_story_id = 0
+        # Filename -> list of stories (one file can be added more than once).
+        self.stories_by_filename = dict()
+        self.narrations_by_id = dict()
+        self.narrations_by_post = dict()
+        # Initiator ID -> (Narration ID -> narration)
+        self.narrations_by_initiator = dict()
+        # Narration ID -> narration, for each of them.
+        self.paused_narrations = dict()
+        self.orphaned_narrations = dict()
+        # Narration ID -> text of its entry in listings.
+        self.narration_entries = dict()
+
+    #### STORIES ###############################################################
+    # Returns the story's index. Stories that already have an ID (restored
+    # ones) keep it.
+    def add_story (self, story):
+        if (story.id is None):
+            story.id = self.next_story_id
+
+        self.next_story_id = max(self.next_story_id, (story.id + 1))
+        self.stories.append(story)
+        self.stories_by_filename.setdefault(story.filename, []).append(story)
+
+        return (len(self.stories) - 1)
+
+    # Returns None if there is no story at this index.
+    def get_story (self, index):
+        if ((index < 0) or (index >= len(self.stories))):
+            return None
+
+        return self.stories[index]
+
+    def get_stories (self):
+        return self.stories
+
+    def get_story_count (self):
+        return len(self.stories)
+
+    def get_stories_of_file (self, filename):
+        return self.stories_by_filename.get(filename, [])
+
+    # The story's narrations keep running, but are now orphaned. The stories
+    # after it move up one index.
+    def remove_story (self, story):
+        self.stories.remove(story)
+
+        same_file_stories = self.stories_by_filename[story.filename]
+        same_file_stories.remove(story)
+
+        if (len(same_file_stories) == 0):
+            del self.stories_by_filename[story.filename]
+
+        self.orphaned_narrations.update(story.narrations)
+        self.invalidate_story_entries(story)
+
+    #### NARRATIONS ############################################################
+    def add_narration (self, narration):
+        narration_id = narration.get_id()
+
+        # IDs are recycled.
+        self.narration_entries.pop(narration_id, None)
+        self.narrations_by_id[narration_id] = narration
+        narration.get_story_file().narrations[narration_id] = narration
+        self.narrations_by_initiator.setdefault(
+            narration.get_initiator_id(),
+            dict()
+        )[narration_id] = narration
+
+        if (narration.get_is_paused()):
+            self.paused_narrations[narration_id] = narration
+        elif (narration.get_last_post_id() is not None):
+            self.narrations_by_post[narration.get_last_post_id()] = narration
+
+    # Returns False if the narration was not registered.
+    def remove_narration (self, narration):
+        narration_id = narration.get_id()
+
+        if (self.narrations_by_id.get(narration_id) is not narration):
+            return False
+
+        del self.narrations_by_id[narration_id]
+        narration.get_story_file().narrations.pop(narration_id, None)
+
+        initiator_narrations = (
+            self.narrations_by_initiator[narration.get_initiator_id()]
+        )
+        del initiator_narrations[narration_id]
+
+        if (len(initiator_narrations) == 0):
+            del self.narrations_by_initiator[narration.get_initiator_id()]
+
+        self.paused_narrations.pop(narration_id, None)
+        self.orphaned_narrations.pop(narration_id, None)
+        self.narration_entries.pop(narration_id, None)
+
+        if (narration.get_last_post_id() is not None):
+            self.narrations_by_post.pop(narration.get_last_post_id(), None)
+
+        return True
+
+    # Returns None if there is no narration with this ID.
+    def get_narration (self, narration_id):
+        return self.narrations_by_id.get(narration_id)
+
+    # Returns None if no narration waits for replies to this post.
+    def get_narration_by_post (self, post_id):
+        return self.narrations_by_post.get(post_id)
+
+    def get_narrations (self):
+        return self.narrations_by_id.values()
+
+    def get_narration_count (self):
+        return len(self.narrations_by_id)
+
+    def get_narrations_of_initiator (self, initiator_id):
+        return self.narrations_by_initiator.get(initiator_id, dict()).values()
+
+    def get_narration_count_of_initiator (self, initiator_id):
+        return len(self.narrations_by_initiator.get(initiator_id, ()))
+
+    def get_paused_narrations (self):
+        return self.paused_narrations.values()
+
+    def get_paused_narration_count (self):
+        return len(self.paused_narrations)
+
+    def get_orphaned_narrations (self):
+        return self.orphaned_narrations.values()
+
+    def get_orphaned_narration_count (self):
+        return len(self.orphaned_narrations)
+
+    def is_orphaned (self, narration):
+        return (narration.get_id() in self.orphaned_narrations)
+
+    # For restored narrations, whose story was removed.
+    def orphan_narration (self, narration):
+        self.orphaned_narrations[narration.get_id()] = narration
+        self.narration_entries.pop(narration.get_id(), None)
+
+    # Narrations no longer listed as orphaned are still active.
+    def forget_orphaned_narrations_of_file (self, filename):
+        result = [
+            narration
+            for narration in self.orphaned_narrations.values()
+            if (narration.get_story_file().get_filename() == filename)
+        ]
+
+        for narration in result:
+            del self.orphaned_narrations[narration.get_id()]
+            self.narration_entries.pop(narration.get_id(), None)
+
+        return result
+
+    # Players now have to reply to 'post_id' to continue the narration.
+    def set_narration_post (self, narration, post_id):
+        if (narration.get_last_post_id() is not None):
+            self.narrations_by_post.pop(narration.get_last_post_id(), None)
+
+        narration.set_last_post_id(post_id)
+
+        self.narrations_by_post[post_id] = narration
+
+    def pause_narration (self, narration):
+        if (narration.get_last_post_id() is not None):
+            self.narrations_by_post.pop(narration.get_last_post_id(), None)
+
+        narration.toggle_is_paused()
+
+        self.paused_narrations[narration.get_id()] = narration
+        self.narration_entries.pop(narration.get_id(), None)
+
+    def resume_narration (self, narration):
+        del self.paused_narrations[narration.get_id()]
+        self.narration_entries.pop(narration.get_id(), None)
+
+        narration.toggle_is_paused()
+
+    #### LISTINGS ##############################################################
+    def get_narration_entry (self, narration):
+        result = self.narration_entries.get(narration.get_id())
+
+        if (result is None):
+            parts = [
+                "\n",
+                str(narration.get_id()),
+                ". ",
+                narration.get_story_file().get_name(),
+                "(",
+                narration.get_story_file().get_filename(),
+                ")\nStarted by: ",
+                narration.get_initiator_name(),
+                "(",
+                str(narration.get_initiator_id()),
+                ")\n"
+            ]
+
+            if (narration.get_is_paused()):
+                parts.append("Paused.\n")
+
+            if (self.is_orphaned(narration)):
+                parts.append("Orphaned.\n")
+
+            result = "".join(parts)
+            self.narration_entries[narration.get_id()] = result
+
+        return result
+
+    # Entries of 'narrations' (any of the collections above) from index 'start'
+    # to 'end' (excluded).
+    def get_narration_entries (self, narrations, start, end):
+        return [
+            self.get_narration_entry(narration)
+            for narration in itertools.islice(narrations, start, end)
+        ]
+
+    # To call when the story's name changes.
+    def invalidate_story_entries (self, story):
+        for narration_id in story.narrations:
+            self.narration_entries.pop(narration_id, None)
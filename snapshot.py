@@ -0,0 +1,234 @@
+import marshal
+
+import memory
+
+################################################################################
+## FORMAT ######################################################################
+################################################################################
+# A snapshot is MAGIC, a version byte, then a marshal'd tuple:
+# (
+#   story content hash,
+#   program counter,
+#   allocated data,
+#   free handles,
+#   last choice index,
+#   memorized target,
+#   available options,
+#   last actor,
+#   {memory key: marshal'd memory value}
+# )
+#
+# Only plain data is written, never the code, which comes from the story file
+# identified by its content hash. Memory values are encoded as follows:
+# lists, structures and wild dicts (CowDicts) become dicts, texts and text
+# effects (plain dicts) become 1-tuples holding a dict, pointers stay tuples
+# (they never hold dicts), text contents stay lists, everything else is written
+# as is.
+#
+# Version 2: allocated objects are under integer handles, pointers are tuples.
+# Version 3: handles freed by the garbage collector are saved.
+#
+# The changes since the previous call to save_changes are a marshal'd tuple:
+# (
+#   program counter,
+#   allocated data,
+#   free handles,
+#   last choice index,
+#   memorized target,
+#   available options,
+#   last actor,
+#   {memory key: marshal'd memory value} for the entries that changed,
+#   [memory key] for the entries that were removed
+# )
+# apply_changes brings a snapshot up to date with them.
+MAGIC = b"TKS"
+VERSION = 3
+
+SCALAR_TYPES = (bool, int, float, str, type(None))
+
+def encode (value):
+    value_type = type(value)
+
+    if (value_type in SCALAR_TYPES):
+        return value
+    elif ((value_type is memory.CowDict) or (value_type is memory.SharedDict)):
+        return {k: encode(v) for (k, v) in value.items()}
+    elif (value_type is dict):
+        return ({k: encode(v) for (k, v) in value.items()},)
+    elif (value_type is list):
+        return [encode(v) for v in value]
+    elif (value_type is tuple):
+        return tuple(encode(v) for v in value)
+
+    raise TypeError("Cannot snapshot values of type " + str(value_type))
+
+def decode (value):
+    value_type = type(value)
+
+    if (value_type is dict):
+        return memory.CowDict({k: decode(v) for (k, v) in value.items()})
+    elif (value_type is tuple):
+        if ((len(value) == 1) and (type(value[0]) is dict)):
+            return {k: decode(v) for (k, v) in value[0].items()}
+        else:
+            return tuple(decode(v) for v in value)
+    elif (value_type is list):
+        return [decode(v) for v in value]
+
+    return value
+
+################################################################################
+## SAVE/RESTORE ################################################################
+################################################################################
+# Encoding the memory is what costs the most, so the last object seen and its
+# encoding are kept for each top level memory entry (see SnapshotCache).
+# Once encoded, containers are flagged as shared: anything writing through
+# them afterwards has to replace them with a copy, so finding the very same
+# object at the same place in the next snapshot means that it did not change.
+#
+# The keys of the entries that changed are kept until clear_changes, for
+# save_changes.
+class SnapshotCache:
+    def __init__ (self):
+        self.values = dict()
+        self.entries = dict()
+        self.changed_keys = set()
+        self.removed_keys = set()
+
+    def update (self, vm_memory):
+        values = self.values
+        entries = self.entries
+
+        for (key, value) in vm_memory.items():
+            if (not (values.get(key) is value)):
+                entries[key] = marshal.dumps(encode(value))
+                values[key] = memory.share(value)
+                self.changed_keys.add(key)
+
+        if (len(values) != len(vm_memory)):
+            for key in (values.keys() - vm_memory.keys()):
+                del values[key]
+                del entries[key]
+                self.changed_keys.discard(key)
+                self.removed_keys.add(key)
+
+        return entries
+
+    def clear_changes (self):
+        self.changed_keys = set()
+        self.removed_keys = set()
+
+def save (vm):
+    return (
+        MAGIC
+        + bytes([VERSION])
+        + marshal.dumps(
+            (
+                vm.program.content_hash,
+                vm.program_counter,
+                vm.allocated_data,
+                vm.free_handles,
+                vm.last_choice_index,
+                encode(vm.memorized_target),
+                encode(vm.available_options),
+                encode(vm.last_actor),
+                vm.snapshot_cache.update(vm.memory)
+            )
+        )
+    )
+
+def save_changes (vm):
+    cache = vm.snapshot_cache
+    entries = cache.update(vm.memory)
+    result = marshal.dumps(
+        (
+            vm.program_counter,
+            vm.allocated_data,
+            vm.free_handles,
+            vm.last_choice_index,
+            encode(vm.memorized_target),
+            encode(vm.available_options),
+            encode(vm.last_actor),
+            {key: entries[key] for key in cache.changed_keys},
+            [key for key in cache.removed_keys if not (key in entries)]
+        )
+    )
+
+    cache.clear_changes()
+
+    return result
+
+# Applies each of 'changes' (from save_changes, oldest first) to the snapshot
+# 'data'. Memory values are not decoded.
+def apply_changes (data, changes):
+    if (
+        (data[:len(MAGIC)] != MAGIC)
+        or (len(data) <= len(MAGIC))
+        or (data[len(MAGIC)] != VERSION)
+    ):
+        raise ValueError("Not a Tonkadur snapshot of version " + str(VERSION))
+
+    values = list(marshal.loads(data[(len(MAGIC) + 1):]))
+    entries = values[8]
+
+    for change in changes:
+        change_values = marshal.loads(change)
+        values[1:8] = change_values[:7]
+
+        for key in change_values[8]:
+            entries.pop(key, None)
+
+        entries.update(change_values[7])
+
+    return MAGIC + bytes([VERSION]) + marshal.dumps(tuple(values))
+
+def load_values (data):
+    if (data[:len(MAGIC)] != MAGIC):
+        raise ValueError("Not a Tonkadur snapshot.")
+
+    version = data[len(MAGIC)]
+
+    if (version != VERSION):
+        raise ValueError("Unsupported snapshot version " + str(version) + ".")
+
+    return marshal.loads(data[(len(MAGIC) + 1):])
+
+# Hash of the story file the snapshot was taken on.
+def get_content_hash (data):
+    return load_values(data)[0]
+
+def restore (vm, data):
+    (
+        content_hash,
+        program_counter,
+        allocated_data,
+        free_handles,
+        last_choice_index,
+        memorized_target,
+        available_options,
+        last_actor,
+        entries
+    ) = load_values(data)
+
+    if (content_hash != vm.program.content_hash):
+        raise ValueError("Snapshot was taken on a different story file.")
+
+    cache = SnapshotCache()
+    vm.memory = dict()
+
+    for (key, entry) in entries.items():
+        value = memory.share(decode(marshal.loads(entry)))
+        vm.memory[key] = value
+        cache.values[key] = value
+        cache.entries[key] = entry
+
+    vm.snapshot_cache = cache
+    vm.program_counter = program_counter
+    vm.allocated_data = allocated_data
+    vm.free_handles = free_handles
+    vm.allocations_since_collection = 0
+    vm.live_objects = sum(1 for k in vm.memory if (type(k) is int))
+    vm.last_choice_index = last_choice_index
+    vm.memorized_target = decode(memorized_target)
+    vm.available_options = decode(available_options)
+    vm.last_actor = last_actor
@@ -0,0 +1,283 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks")
+)
+
+import text_renderer
+import tonkadur
+
+from wyrd import *
+
+################################################################################
+## STORIES #####################################################################
+################################################################################
+NODE = type_of("structure", "node")
+NODE_TYPES = [
+    structure_type(
+        "node",
+        [("hp", type_of("int")), ("next", type_of("pointer"))]
+    )
+]
+
+def field (reference, name):
+    return relative_address(reference, constant(name))
+
+# Copies structures through a variable and through a pointer, then writes in
+# the copies and through an alias of the pointer.
+def generate_copy_story ():
+    return story(
+        [
+            initialize(address("a"), NODE),
+            set_value(field(address("a"), "hp"), constant(1)),
+            set_value(address("b"), variable("a")),
+            set_value(field(address("b"), "hp"), constant(2)),
+            set_value(address("p"), new(NODE)),
+            set_value(field(variable("p"), "hp"), constant(3)),
+            set_value(address("q"), variable("p")),
+            set_value(address("c"), value_of(variable("p"))),
+            set_value(field(variable("q"), "hp"), constant(4)),
+            set_value(field(address("c"), "hp"), constant(5)),
+            end()
+        ],
+        NODE_TYPES
+    )
+
+# 'root' -> node -> node -> node (hp 7), plus a node no longer pointed to.
+def generate_chain_story ():
+    second = value_of(field(variable("root"), "next"))
+    third = value_of(field(second, "next"))
+
+    return story(
+        [
+            set_value(address("root"), new(NODE)),
+            set_value(field(variable("root"), "next"), new(NODE)),
+            set_value(field(second, "next"), new(NODE)),
+            set_value(field(third, "hp"), constant(7)),
+            set_value(address("lost"), new(NODE)),
+            set_value(address("lost"), constant(0)),
+            end()
+        ],
+        NODE_TYPES
+    )
+
+# Asks for a name and a count, allocates that many nodes in a list, sums them
+# up through their pointers, then offers to start again.
+def generate_sample_story ():
+    def item (index):
+        return value_of(
+            relative_address(
+                address("items"),
+                cast(variable(index), "int", "string")
+            )
+        )
+
+    code = []
+
+    code.append(
+        prompt_string(address("name"), 1, 20, text(constant("Name?")))
+    )
+    start = len(code)
+    code.append(
+        prompt_integer(address("n"), 1, 10, text(constant("How many?")))
+    )
+    code.append(initialize(address("items"), type_of("list")))
+    add_loop(
+        code,
+        "i",
+        variable("n"),
+        [
+            set_value(
+                relative_address(
+                    address("items"),
+                    cast(variable("i"), "int", "string")
+                ),
+                new(NODE)
+            ),
+            set_value(
+                field(item("i"), "hp"),
+                operation("times", variable("i"), variable("i"))
+            )
+        ]
+    )
+    code.append(set_value(address("sum"), constant(0)))
+    add_loop(
+        code,
+        "j",
+        variable("n"),
+        [
+            set_value(
+                address("sum"),
+                operation(
+                    "plus",
+                    variable("sum"),
+                    value_of(field(item("j"), "hp"))
+                )
+            )
+        ]
+    )
+    code.append(
+        display(
+            text(
+                text_effect("emph", variable("name")),
+                constant(": "),
+                cast(variable("sum"), "int", "string"),
+                newline()
+            )
+        )
+    )
+    code.append(add_text_option(text(constant("Again"))))
+    code.append(add_text_option(text(constant("Stop"))))
+    code.append(resolve_choice())
+    code.append(
+        set_pc(
+            if_else(
+                operation("equals", last_choice_index(), constant(0)),
+                constant(start),
+                constant(len(code) + 1)
+            )
+        )
+    )
+    code.append(display(text(constant("Bye."))))
+    code.append(end())
+
+    return story(code, NODE_TYPES)
+
+SAMPLE_ANSWERS = ["Alice", "3", "0", "10", "0", "1", "1"]
+
+################################################################################
+## RUNNING #####################################################################
+################################################################################
+# Results, with their texts rendered, until an answer is needed.
+def run_until_input_is_required (vm):
+    result = []
+
+    while True:
+        step = vm.run("test", 0)
+        category = step["category"]
+        description = [category]
+
+        if (category == "display"):
+            description.append(text_renderer.to_string(step["content"]))
+        elif (category in ("prompt_integer", "prompt_string")):
+            description.append(step["min"])
+            description.append(step["max"])
+            description.append(text_renderer.to_string(step["label"]))
+        elif (category == "resolve_choice"):
+            description.extend(
+                text_renderer.to_string(option["label"])
+                for option in step["options"]
+            )
+
+        result.append(description)
+
+        if (category != "display"):
+            return result
+
+def run_with_answers (vm, answers):
+    result = run_until_input_is_required(vm)
+
+    for reply in answers:
+        category = result[-1][0]
+
+        if (category == "end"):
+            break
+        elif (category == "prompt_integer"):
+            vm.store_integer(int(reply), "test", 0)
+        elif (category == "prompt_string"):
+            vm.store_string(reply, "test", 0)
+        elif (category == "resolve_choice"):
+            vm.resolve_choice_to(int(reply), "test", 0)
+
+        result.extend(run_until_input_is_required(vm))
+
+    return result
+
+# What narrations need of main.StoryFile.
+class StoryFile:
+    def __init__ (self, filename):
+        self.filename = filename
+
+    def get_filename (self):
+        return self.filename
+
+# What the registry needs of main.StoryFile and narration.Narration.
+class RegisteredStory:
+    def __init__ (self, filename, name = "Story"):
+        self.id = None
+        self.name = name
+        self.filename = filename
+        self.narrations = dict()
+
+    def get_name (self):
+        return self.name
+
+    def get_filename (self):
+        return self.filename
+
+class RegisteredNarration:
+    def __init__ (self, narration_id, story, initiator_id, post_id = None):
+        self.id = narration_id
+        self.story = story
+        self.initiator_id = initiator_id
+        self.last_post_id = post_id
+        self.is_paused = False
+
+    def get_id (self):
+        return self.id
+
+    def get_story_file (self):
+        return self.story
+
+    def get_initiator_id (self):
+        return self.initiator_id
+
+    def get_initiator_name (self):
+        return "user" + str(self.initiator_id)
+
+    def get_is_paused (self):
+        return self.is_paused
+
+    def toggle_is_paused (self):
+        self.is_paused = not self.is_paused
+
+    def get_last_post_id (self):
+        return self.last_post_id
+
+    def set_last_post_id (self, post_id):
+        self.last_post_id = post_id
+
+################################################################################
+## TEST CASES ##################################################################
+################################################################################
+# Writes the stories of its tests in a temporary directory.
+class StoryTestCase (unittest.TestCase):
+    @classmethod
+    def setUpClass (cls):
+        cls.directory = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass (cls):
+        shutil.rmtree(cls.directory)
+
+    def write_story (self, name, content):
+        filename = os.path.join(self.directory, name + ".json")
+        write_story(filename, content)
+
+        return filename
+
+    # Each test is run with both the compiled code and the JSON interpreter.
+    def create_vms (self, filename):
+        return [
+            (
+                use_compiled_code,
+                tonkadur.Tonkadur(filename, "test", 0, use_compiled_code)
+            )
+            for use_compiled_code in (True, False)
+        ]
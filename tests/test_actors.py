@@ -0,0 +1,112 @@
+import asyncio
+import unittest
+
+from stories import *
+
+import actors
+
+# What actors need of narration.Narration.
+class ActorNarration:
+    def __init__ (self):
+        self.is_finalized = False
+
+    def has_been_finalized (self):
+        return self.is_finalized
+
+class TestNarrationActor (unittest.TestCase):
+    def test_requests_run_one_at_a_time_in_order (self):
+        events = []
+
+        async def request (index):
+            events.append(("start", index))
+            await asyncio.sleep(0.001 * (3 - index))
+            events.append(("end", index))
+
+            return index
+
+        async def run ():
+            actor = actors.NarrationActor(ActorNarration())
+            results = [actor.submit(request, i) for i in range(3)]
+
+            self.assertEqual(actor.get_pending_requests(), 3)
+
+            values = await asyncio.gather(*results)
+            await actor.join()
+
+            return values
+
+        self.assertEqual(asyncio.run(run()), [0, 1, 2])
+        self.assertEqual(
+            events,
+            [(e, i) for i in range(3) for e in ("start", "end")]
+        )
+
+    def test_errors_are_given_to_their_requester (self):
+        async def fail ():
+            raise ValueError("failed")
+
+        async def succeed ():
+            return 1
+
+        async def run ():
+            actor = actors.NarrationActor(ActorNarration())
+            results = [actor.submit(fail), actor.submit(succeed)]
+            # Not assertRaises, which would clear the frames of the actor's
+            # task along with those of the error.
+            values = await asyncio.gather(*results, return_exceptions = True)
+            await actor.join()
+
+            return values
+
+        (error, value) = asyncio.run(run())
+
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(value, 1)
+
+    def test_finalized_narrations_drop_requests (self):
+        async def finalize (narration):
+            narration.is_finalized = True
+
+            return True
+
+        async def succeed ():
+            return 1
+
+        async def run ():
+            actor = actors.NarrationActor(ActorNarration())
+            results = [
+                actor.submit(finalize, actor.narration),
+                actor.submit(succeed)
+            ]
+            values = await asyncio.gather(*results)
+            await actor.join()
+
+            return values
+
+        self.assertEqual(asyncio.run(run()), [True, None])
+
+    def test_closed_actors_drop_requests (self):
+        async def succeed ():
+            return 1
+
+        async def run ():
+            # Closed while idle, and while handling requests.
+            idle = actors.NarrationActor(ActorNarration())
+            idle.close()
+            busy = actors.NarrationActor(ActorNarration())
+            pending = busy.submit(succeed)
+            busy.close()
+            results = [idle.submit(succeed), pending, busy.submit(succeed)]
+
+            values = await asyncio.wait_for(asyncio.gather(*results), 1)
+            await idle.join()
+            await busy.join()
+
+            self.assertTrue(busy.task.done())
+
+            return values
+
+        self.assertEqual(asyncio.run(run()), [None, 1, None])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import marshal
+import os
+import unittest
+
+from stories import *
+
+import artifact
+
+STORY_CONTENT = ([], [], [set_pc(constant(0))], (1, 1, 0, 0, 0))
+
+class TestArtifacts (StoryTestCase):
+    def setUp (self):
+        self.saved_directory = artifact.directory
+        artifact.directory = os.path.join(self.directory, "artifacts")
+        os.makedirs(artifact.directory, exist_ok = True)
+
+    def tearDown (self):
+        artifact.directory = self.saved_directory
+
+    def test_paths_are_not_confused (self):
+        filenames = [
+            artifact.get_filename(os.path.join(self.directory, path))
+            for path in ("a_b/c.json", "a/b_c.json", "a/b/c.json")
+        ]
+
+        self.assertEqual(len(set(filenames)), 3)
+        self.assertTrue(
+            all(
+                os.path.basename(filename).startswith("c.json.")
+                for filename in filenames[::2]
+            )
+        )
+        self.assertEqual(
+            artifact.get_filename("x.json"),
+            artifact.get_filename(os.path.abspath("x.json"))
+        )
+
+    def test_artifacts_are_next_to_their_story_by_default (self):
+        artifact.directory = None
+
+        self.assertEqual(artifact.get_filename("a/b.json"), "a/b.json.tkc")
+
+    def test_artifacts_are_loaded_for_the_same_content (self):
+        filename = os.path.join(self.directory, "story.json")
+        artifact.save(filename, "hash", *STORY_CONTENT)
+
+        self.assertEqual(artifact.load(filename, "hash"), STORY_CONTENT)
+        self.assertIsNone(artifact.load(filename, "other hash"))
+        self.assertIsNone(
+            artifact.load(os.path.join(self.directory, "other.json"), "hash")
+        )
+
+    def test_malformed_artifacts_are_ignored (self):
+        filename = os.path.join(self.directory, "story.json")
+        header = artifact.MAGIC + bytes([artifact.VERSION])
+        valid = header + marshal.dumps(("hash",) + STORY_CONTENT)
+
+        for data in (
+            b"",
+            b"XYZ" + valid[3:],
+            artifact.MAGIC + bytes([artifact.VERSION + 1]) + valid[4:],
+            valid[:-10],
+            header + marshal.dumps("hash"),
+            header + marshal.dumps(("hash", [], [])),
+            header + b"\xff"
+        ):
+            with self.subTest(data = data[:8]):
+                with open(artifact.get_filename(filename), 'wb') as f:
+                    f.write(data)
+
+                self.assertIsNone(artifact.load(filename, "hash"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import unittest
+
+from stories import *
+
+import backends
+
+class TestProcessBackend (StoryTestCase):
+    def setUp (self):
+        self.filename = self.write_story("sample", generate_sample_story())
+        self.backend = backends.ProcessBackend(1)
+
+    def tearDown (self):
+        self.backend.close()
+
+    def start (self):
+        new_narration = self.backend.create_narration(
+            StoryFile(self.filename),
+            "test",
+            0
+        )
+        output = asyncio.run(self.backend.start(new_narration))
+
+        return (new_narration, output)
+
+    def test_narrations_run_in_workers (self):
+        async def run (started_narration):
+            output = await self.backend.answer(
+                started_narration,
+                SAMPLE_ANSWERS[0],
+                "test",
+                0
+            )
+            self.backend.release(started_narration)
+
+            self.assertEqual(len(self.backend.releases), 1)
+
+            await self.backend.wait_for_releases()
+
+            return output
+
+        (started_narration, output) = self.start()
+
+        self.assertNotEqual(output, "")
+        self.assertNotEqual(asyncio.run(run(started_narration)), "")
+        self.assertEqual(len(self.backend.releases), 0)
+        self.assertEqual(self.backend.workers[0].narrations, 0)
+
+    def test_stopped_workers_lose_their_narrations (self):
+        (started_narration, output) = self.start()
+        worker = self.backend.workers[0]
+        worker.process.kill()
+        worker.process.join()
+
+        self.assertFalse(self.backend.has_failed(started_narration))
+
+        for i in range(2):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(
+                    self.backend.answer(
+                        started_narration,
+                        SAMPLE_ANSWERS[0],
+                        "test",
+                        0
+                    )
+                )
+
+        self.assertTrue(self.backend.has_failed(started_narration))
+
+        # Nothing is sent to the stopped worker.
+        self.backend.release(started_narration)
+
+        self.assertEqual(len(self.backend.releases), 0)
+
+        with self.assertRaises(RuntimeError):
+            self.backend.create_narration(StoryFile(self.filename), "test", 0)
+
+if __name__ == '__main__':
+    unittest.main()
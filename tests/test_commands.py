@@ -0,0 +1,54 @@
+import unittest
+
+from stories import *
+
+try:
+    import main
+except ImportError:
+    # The bot needs discord.py.
+    main = None
+
+@unittest.skipIf(main is None, "discord.py is not installed")
+class TestCommandParsing (unittest.TestCase):
+    def create_command (self, parameters):
+        return main.Command("test", None, parameters, main.EVERYONE, ())
+
+    def test_values_are_parsed (self):
+        command = self.create_command(
+            [("INDEX", int), ("NAME", str), ("PAGE", int, 1)]
+        )
+
+        self.assertEqual(command.parse(["3", "a"]), [3, "a", 1])
+        self.assertEqual(command.parse(["3", "a", "2"]), [3, "a", 2])
+        self.assertEqual(command.parse(["x", "a"]), "Invalid INDEX 'x'.")
+        self.assertEqual(command.parse(["3"]), "Usage: test INDEX NAME PAGE")
+        self.assertEqual(
+            command.parse(["3", "a", "2", "4"]),
+            "Usage: test INDEX NAME PAGE"
+        )
+
+    def test_batch_parameters_take_every_value (self):
+        command = self.create_command([("ID", int), ("INDEX+", int)])
+
+        self.assertEqual(command.parse(["1", "3", "5", "8"]), [1, [3, 5, 8]])
+        self.assertEqual(command.parse(["1", "3"]), [1, [3]])
+        self.assertEqual(command.parse(["1", "3", "x"]), "Invalid INDEX 'x'.")
+        self.assertEqual(command.parse(["1"]), "Usage: test ID INDEX+")
+
+    def test_text_parameters_take_the_rest (self):
+        command = self.create_command([("INDEX", int), ("NAME", main.text, "")])
+
+        self.assertEqual(command.parse(["3", "a", "b"]), [3, "a b"])
+        self.assertEqual(command.parse(["3"]), [3, ""])
+
+    def test_registered_batch_commands (self):
+        for (name, values, expected) in (
+            ("end", ["3", "5", "8"], [[3, 5, 8]]),
+            ("add_admin", ["a#1", "b#2"], [["a#1", "b#2"]]),
+            ("add_story_file", ["my", "story.json"], ["my story.json"])
+        ):
+            with self.subTest(command = name):
+                self.assertEqual(main.commands[name].parse(values), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,18 @@
+import unittest
+
+from stories import *
+
+class TestCompiledCode (StoryTestCase):
+    def test_output_matches_the_interpreter (self):
+        filename = self.write_story("sample", generate_sample_story())
+        outputs = [
+            run_with_answers(vm, SAMPLE_ANSWERS)
+            for (_, vm) in self.create_vms(filename)
+        ]
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0][-1], ["end"])
+        self.assertIn(["display", "*Alice*: 5\n"], outputs[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+import tonkadur
+
+from stories import *
+
+class TestGarbageCollection (StoryTestCase):
+    def test_nested_pointers_are_kept (self):
+        filename = self.write_story("chain", generate_chain_story())
+
+        for (use_compiled_code, vm) in self.create_vms(filename):
+            with self.subTest(compiled = use_compiled_code):
+                self.assertEqual(vm.run("test", 0)["category"], "end")
+
+                vm.collect_garbage()
+
+                self.assertEqual(
+                    sorted(k for k in vm.memory if (type(k) is int)),
+                    [0, 1, 2]
+                )
+                self.assertEqual(vm.free_handles, [3])
+
+                target = vm.memory["root"]
+
+                for i in range(2):
+                    target = vm.memory[target[0]]["next"]
+
+                self.assertEqual(vm.memory[target[0]]["hp"], 7)
+
+    def test_freed_handles_are_reused (self):
+        filename = self.write_story("chain", generate_chain_story())
+        vm = tonkadur.Tonkadur(filename, "test", 0)
+        vm.run("test", 0)
+
+        self.assertEqual(
+            vm.get_allocation_stats(),
+            {
+                "live": 4,
+                "freed": 0,
+                "collections": 0,
+                "allocated_since_collection": 4
+            }
+        )
+
+        vm.collect_garbage()
+
+        self.assertEqual(
+            vm.get_allocation_stats(),
+            {
+                "live": 3,
+                "freed": 1,
+                "collections": 1,
+                "allocated_since_collection": 0
+            }
+        )
+        self.assertEqual(vm.allocate(dict()), (3,))
+        self.assertEqual(vm.free_handles, [])
+
+    def test_collections_wait_for_allocation_pressure (self):
+        filename = self.write_story("chain", generate_chain_story())
+        vm = tonkadur.Tonkadur(filename, "test", 0)
+        vm.run("test", 0)
+        threshold = tonkadur.Tonkadur.collection_threshold
+
+        try:
+            tonkadur.Tonkadur.collection_threshold = 5
+            self.assertFalse(vm.has_allocation_pressure())
+
+            tonkadur.Tonkadur.collection_threshold = 4
+            self.assertTrue(vm.has_allocation_pressure())
+
+            tonkadur.Tonkadur.collection_threshold = None
+            self.assertFalse(vm.has_allocation_pressure())
+        finally:
+            tonkadur.Tonkadur.collection_threshold = threshold
+
+if __name__ == '__main__':
+    unittest.main()
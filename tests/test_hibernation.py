@@ -0,0 +1,195 @@
+import asyncio
+import marshal
+import os
+import unittest
+
+from stories import *
+
+import backends
+import hibernation
+import narration
+
+class TestLeastRecentlyUsed (unittest.TestCase):
+    def setUp (self):
+        self.hibernation = hibernation.Hibernation(2)
+        self.narrations = [RegisteredNarration(i, None, 0) for i in range(4)]
+
+    def tearDown (self):
+        self.hibernation.close()
+
+    def test_least_recently_used_narrations_are_hibernated (self):
+        (a, b, c, d) = self.narrations
+
+        self.assertEqual(self.hibernation.use(a), [])
+        self.assertEqual(self.hibernation.use(b), [])
+        self.assertEqual(self.hibernation.use(a), [])
+        self.assertEqual(self.hibernation.use(c), [b])
+        self.assertTrue(self.hibernation.is_hibernated(b))
+
+        # Rehydrating a narration hibernates another one.
+        self.assertEqual(self.hibernation.use(b), [a])
+        self.assertFalse(self.hibernation.is_hibernated(b))
+        self.assertEqual(list(self.hibernation.resident_narrations), [2, 1])
+
+        self.hibernation.cancel_hibernation(a)
+
+        self.assertFalse(self.hibernation.is_hibernated(a))
+        self.assertEqual(self.hibernation.use(d), [c, b])
+
+        self.hibernation.forget(a)
+
+        self.assertFalse(self.hibernation.is_hibernated(a))
+        self.assertEqual(list(self.hibernation.resident_narrations), [3])
+
+    def test_restored_narrations_are_only_hibernated_once_used (self):
+        for n in self.narrations:
+            self.hibernation.add_resident(n)
+
+        self.assertEqual(
+            self.hibernation.use(self.narrations[0]),
+            self.narrations[1:3]
+        )
+
+    def test_files_are_removed (self):
+        directory = self.hibernation.directory
+        filename = self.hibernation.get_filename(self.narrations[0])
+
+        with open(filename, 'wb') as f:
+            f.write(b"")
+
+        # Left by a previous run.
+        hibernation.Hibernation(2, directory)
+
+        self.assertFalse(os.path.exists(filename))
+
+        self.hibernation.close()
+
+        self.assertFalse(os.path.exists(directory))
+
+        self.hibernation = hibernation.Hibernation(2)
+
+class TestHibernatedNarrations (StoryTestCase):
+    def setUp (self):
+        self.filename = self.write_story("sample", generate_sample_story())
+        self.hibernation_file = os.path.join(self.directory, "narration.tks")
+
+    # Returns (a narration, and the same narration, never hibernated).
+    def start (self):
+        result = []
+
+        for i in range(2):
+            started_narration = narration.Narration(
+                StoryFile(self.filename),
+                "test",
+                0
+            )
+            started_narration.run("test", 0)
+            backends.run_until_input_is_required(started_narration)
+            started_narration.save_checkpoint()
+
+            for answer in SAMPLE_ANSWERS[:2]:
+                self.answer(started_narration, answer)
+
+            result.append(started_narration)
+
+        return result
+
+    def answer (self, started_narration, answer):
+        started_narration.handle_answer(answer, "test", 0)
+
+        return backends.run_until_input_is_required(started_narration)[0]
+
+    def test_rehydrated_narrations_are_identical (self):
+        (hibernated, resident) = self.start()
+        data = hibernated.get_state_snapshot()
+
+        self.assertTrue(hibernated.hibernate(self.hibernation_file))
+        self.assertIsNone(hibernated.state)
+        self.assertFalse(hibernated.hibernate(self.hibernation_file))
+        self.assertEqual(hibernated.get_state_snapshot(), data)
+
+        self.assertTrue(hibernated.restore_state())
+        self.assertFalse(os.path.exists(self.hibernation_file))
+        self.assertEqual(hibernated.state.save_snapshot(), data)
+        self.assertFalse(hibernated.restore_state())
+
+        for answer in SAMPLE_ANSWERS[2:]:
+            self.assertEqual(
+                self.answer(hibernated, answer),
+                self.answer(resident, answer)
+            )
+
+    def test_changes_not_checkpointed_are_kept (self):
+        (hibernated, resident) = self.start()
+
+        hibernated.hibernate(self.hibernation_file)
+        hibernated.restore_state()
+
+        self.assertEqual(
+            hibernated.save_checkpoint(False),
+            resident.save_checkpoint(False)
+        )
+
+        # Once checkpointed, there are none left.
+        hibernated.hibernate(self.hibernation_file)
+
+        self.assertEqual(
+            marshal.loads(hibernated.save_checkpoint(False))[7],
+            None
+        )
+
+    def test_story_files_can_change_while_hibernating (self):
+        (hibernated, resident) = self.start()
+        hibernated.hibernate(self.hibernation_file)
+        self.write_story("sample", generate_copy_story())
+
+        try:
+            hibernated.restore_state()
+
+            self.assertEqual(
+                self.answer(hibernated, SAMPLE_ANSWERS[2]),
+                self.answer(resident, SAMPLE_ANSWERS[2])
+            )
+        finally:
+            self.write_story("sample", generate_sample_story())
+
+    def test_lost_states_cannot_be_rehydrated (self):
+        (hibernated, resident) = self.start()
+        hibernated.hibernate(self.hibernation_file)
+
+        with open(self.hibernation_file, 'wb') as f:
+            f.write(b"XYZ")
+
+        with self.assertRaises(ValueError):
+            hibernated.restore_state()
+
+        self.assertIsNone(hibernated.hibernation_file)
+        self.assertIsNone(hibernated.hibernated_program)
+        self.assertFalse(os.path.exists(self.hibernation_file))
+
+    def test_released_narrations_remove_their_file (self):
+        async def run (backend):
+            hibernated = backend.create_narration(
+                StoryFile(self.filename),
+                "test",
+                0
+            )
+            await backend.start(hibernated)
+            await backend.hibernate(hibernated, self.hibernation_file)
+
+            self.assertTrue(os.path.exists(self.hibernation_file))
+
+            backend.release(hibernated)
+            await backend.wait_for_releases()
+
+        for backend in (backends.LocalBackend(), backends.ProcessBackend(1)):
+            with self.subTest(backend = type(backend).__name__):
+                try:
+                    asyncio.run(run(backend))
+                finally:
+                    backend.close()
+
+                self.assertFalse(os.path.exists(self.hibernation_file))
+
+if __name__ == '__main__':
+    unittest.main()
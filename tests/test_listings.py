@@ -0,0 +1,90 @@
+import unittest
+
+from stories import *
+
+import registry
+
+try:
+    import main
+except ImportError:
+    # The bot needs discord.py.
+    main = None
+
+@unittest.skipIf(main is None, "discord.py is not installed")
+class TestPagination (unittest.TestCase):
+    def setUp (self):
+        self.saved_registry = main.stories_and_narrations
+        main.stories_and_narrations = registry.Registry()
+        self.story = RegisteredStory("a.json")
+        main.stories_and_narrations.add_story(self.story)
+
+        for i in range(31):
+            main.stories_and_narrations.add_narration(
+                RegisteredNarration(i, self.story, (i % 2))
+            )
+
+    def tearDown (self):
+        main.stories_and_narrations = self.saved_registry
+
+    def get_ids (self, listing):
+        return [
+            int(line.split(".")[0])
+            for line in listing.split("\n")[1:]
+            if (". " in line)
+        ]
+
+    def test_pages_hold_fifteen_narrations (self):
+        for (page, ids) in (
+            (1, list(range(0, 15))),
+            (2, list(range(15, 30))),
+            (3, [30])
+        ):
+            with self.subTest(page = page):
+                (listing, _) = main.handle_get_active_narration_list_command(
+                    page
+                )
+
+                self.assertTrue(
+                    listing.startswith(
+                        "Active narrations (31, page "
+                        + str(page)
+                        + " of 3):"
+                    )
+                )
+                self.assertEqual(self.get_ids(listing), ids)
+
+    def test_pages_out_of_range_are_refused (self):
+        for page in (0, 4):
+            with self.subTest(page = page):
+                self.assertEqual(
+                    main.handle_get_active_narration_list_command(page)[0],
+                    "Choose a page between 1 and 3."
+                )
+
+        self.assertEqual(
+            main.handle_get_paused_narration_list_command(1)[0],
+            "Paused narrations (0, page 1 of 1):"
+        )
+
+    def test_listings_follow_changes (self):
+        main.stories_and_narrations.pause_narration(
+            main.stories_and_narrations.get_narration(3)
+        )
+        (listing, _) = main.handle_get_paused_narration_list_command(1)
+
+        self.assertEqual(self.get_ids(listing), [3])
+        self.assertTrue(listing.endswith("Paused.\n"))
+
+        (listing, _) = main.handle_narrations_by_command(1, 1)
+
+        self.assertTrue(
+            listing.startswith("Narrations started by 1 (15, page 1 of 1):")
+        )
+        self.assertEqual(self.get_ids(listing), list(range(1, 31, 2)))
+        self.assertEqual(
+            main.handle_narrations_by_command(1, 2)[0],
+            "Choose a page between 1 and 1."
+        )
+
+if __name__ == '__main__':
+    unittest.main()
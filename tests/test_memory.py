@@ -0,0 +1,22 @@
+import unittest
+
+from stories import *
+
+class TestCopySemantics (StoryTestCase):
+    def test_writes_do_not_go_through_copies (self):
+        filename = self.write_story("copy", generate_copy_story())
+
+        for (use_compiled_code, vm) in self.create_vms(filename):
+            with self.subTest(compiled = use_compiled_code):
+                self.assertEqual(vm.run("test", 0)["category"], "end")
+
+                (handle,) = vm.memory["p"]
+
+                self.assertEqual(vm.memory["a"]["hp"], 1)
+                self.assertEqual(vm.memory["b"]["hp"], 2)
+                self.assertEqual(vm.memory["q"], vm.memory["p"])
+                self.assertEqual(vm.memory[handle]["hp"], 4)
+                self.assertEqual(vm.memory["c"]["hp"], 5)
+
+if __name__ == '__main__':
+    unittest.main()
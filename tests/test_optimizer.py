@@ -0,0 +1,121 @@
+import unittest
+
+import narration
+import optimizer
+
+from stories import *
+
+def optimize_value (computation):
+    (code, report) = optimizer.optimize_code(
+        [set_value(address("x"), computation)]
+    )
+
+    return (code[0]['value'], report)
+
+class TestFolding (unittest.TestCase):
+    def test_constant_operations_are_folded (self):
+        (value, report) = optimize_value(
+            operation(
+                "plus",
+                constant(2),
+                operation("times", constant(3), constant(4))
+            )
+        )
+
+        self.assertEqual(value, constant(14))
+        self.assertEqual(report.folded_constants, 2)
+        self.assertEqual(report.get_eliminated_nodes(), 4)
+
+    def test_variables_and_random_values_are_kept (self):
+        for computation in (
+            operation("plus", variable("a"), constant(1)),
+            operation("rand", constant(0), constant(10))
+        ):
+            with self.subTest(operator = computation['operator']):
+                (value, report) = optimize_value(computation)
+
+                self.assertEqual(value, computation)
+                self.assertEqual(report.folded_constants, 0)
+
+    def test_runtime_errors_are_not_folded (self):
+        computation = operation("divide", constant(1), constant(0))
+        (value, report) = optimize_value(computation)
+
+        self.assertEqual(value, computation)
+
+    def test_casts_are_removed_or_folded (self):
+        (value, report) = optimize_value(cast(variable("a"), "int", "int"))
+
+        self.assertEqual(value, variable("a"))
+        self.assertEqual(report.removed_casts, 1)
+
+        (value, report) = optimize_value(cast(constant(3), "int", "string"))
+
+        self.assertEqual(value, constant("3"))
+        self.assertEqual(report.folded_constants, 1)
+
+    def test_texts_are_merged (self):
+        (value, report) = optimize_value(
+            text(constant("a"), newline(), text(constant("b")), variable("c"))
+        )
+
+        self.assertEqual(value, text(constant("a\nb"), variable("c")))
+
+class TestPruning (unittest.TestCase):
+    def test_constant_conditions_keep_a_single_branch (self):
+        for (condition, expected) in ((True, "yes"), (False, "no")):
+            with self.subTest(condition = condition):
+                (value, report) = optimize_value(
+                    if_else(
+                        operation("not", constant(not condition)),
+                        constant("yes"),
+                        constant("no")
+                    )
+                )
+
+                self.assertEqual(value, constant(expected))
+                self.assertEqual(report.pruned_branches, 1)
+
+    def test_other_conditions_keep_both_branches (self):
+        computation = if_else(
+            variable("a"),
+            operation("plus", constant(1), constant(1)),
+            constant(0)
+        )
+        (value, report) = optimize_value(computation)
+
+        self.assertEqual(
+            value,
+            if_else(variable("a"), constant(2), constant(0))
+        )
+        self.assertEqual(report.pruned_branches, 0)
+
+class TestOptimizedStories (StoryTestCase):
+    def test_output_does_not_change (self):
+        filename = self.write_story("sample", generate_sample_story())
+        outputs = [
+            run_with_answers(
+                tonkadur.Tonkadur(filename, "test", 0, optimize = optimize),
+                SAMPLE_ANSWERS
+            )
+            for optimize in (True, False)
+        ]
+
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_narrations_can_skip_the_optimizer (self):
+        filename = self.write_story("sample", generate_sample_story())
+
+        try:
+            narration.Narration.optimize = False
+            unoptimized = narration.Narration(StoryFile(filename), "test", 0)
+        finally:
+            narration.Narration.optimize = True
+
+        optimized = narration.Narration(StoryFile(filename), "test", 0)
+
+        self.assertIsNone(unoptimized.state.program.optimization_report)
+        self.assertIsNotNone(optimized.state.program.optimization_report)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import asyncio
+import unittest
+
+from stories import *
+
+import fake_discord
+import outbound
+
+class TestSplitMessage (unittest.TestCase):
+    def test_short_messages_are_kept (self):
+        self.assertEqual(outbound.split_message("abc", 3), ["abc"])
+        self.assertEqual(outbound.split_message("", 3), [""])
+
+    def test_cuts_at_the_best_separator (self):
+        for (content, expected) in (
+            ("aa\n\nbb\ncc dd", ["aa", "bb\ncc dd"]),
+            ("aa bb\ncc dd", ["aa bb", "cc dd"]),
+            ("aa bb cc dd", ["aa bb cc", "dd"]),
+            ("aaaaaabbbb", ["aaaaaabb", "bb"])
+        ):
+            with self.subTest(content = content):
+                self.assertEqual(outbound.split_message(content, 8), expected)
+
+    def test_parts_fit_and_keep_the_words (self):
+        content = " ".join(str(i) * (i % 7 + 1) for i in range(1000))
+        parts = outbound.split_message(content, 100)
+
+        self.assertTrue(all((len(part) <= 100) for part in parts))
+        self.assertEqual(" ".join(parts), content)
+
+class TestOutbox (unittest.TestCase):
+    def test_only_the_last_part_replies (self):
+        async def run ():
+            client = fake_discord.FakeClient(None)
+            channel = client.create_channel("test")
+            outbox = outbound.Outbox(limit = 100)
+            reference = fake_discord.FakeMessage(
+                client.generate_message_id(),
+                channel,
+                fake_discord.FakeUser(1, "user"),
+                ""
+            )
+
+            return await outbox.send(
+                channel,
+                ("a" * 1500) + "\n" + ("b" * 1500),
+                reference
+            )
+
+        messages = asyncio.run(run())
+
+        self.assertEqual(
+            [m.content for m in messages],
+            ["a" * 1500, "b" * 1500]
+        )
+        self.assertIsNone(messages[0].reference)
+        self.assertIsNotNone(messages[1].reference)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,300 @@
+import json
+import marshal
+import os
+import shutil
+import unittest
+
+from stories import *
+
+import backends
+import narration
+import persistence
+import snapshot
+
+# Checkpoints hold dicts, whose order does not matter.
+def checkpoint_values (data):
+    values = list(marshal.loads(data))
+    values[7] = snapshot.load_values(values[7])
+
+    return values
+
+class TestRestoredNarrations (StoryTestCase):
+    def setUp (self):
+        self.filename = self.write_story("sample", generate_sample_story())
+        started_narration = narration.Narration(
+            StoryFile(self.filename),
+            "test",
+            0
+        )
+        started_narration.run("test", 0)
+        backends.run_until_input_is_required(started_narration)
+        started_narration.handle_answer(SAMPLE_ANSWERS[0], "test", 0)
+        self.output = backends.run_until_input_is_required(started_narration)[0]
+        self.checkpoint = started_narration.save_checkpoint()
+        started_narration.finalize()
+
+    def restore (self, backend):
+        return backend.restore_narrations(
+            [(0, StoryFile(self.filename), "test", 0, self.checkpoint)]
+        )[0]
+
+    def test_narrations_continue_where_they_were (self):
+        for backend in (backends.LocalBackend(), backends.ProcessBackend(1)):
+            with self.subTest(backend = type(backend).__name__):
+                try:
+                    restored_narration = self.restore(backend)
+                finally:
+                    backend.close()
+
+                self.assertEqual(
+                    restored_narration.get_previous_output(),
+                    self.output
+                )
+                restored_narration.finalize()
+
+    def test_modified_story_files_are_not_restored (self):
+        # Same story, written differently.
+        with open(self.filename, 'r') as f:
+            content = json.load(f)
+
+        with open(self.filename, 'w') as f:
+            json.dump(content, f, indent = 1)
+
+        for backend in (backends.LocalBackend(), backends.ProcessBackend(1)):
+            with self.subTest(backend = type(backend).__name__):
+                try:
+                    restored_narration = self.restore(backend)
+                finally:
+                    backend.close()
+
+                self.assertIsInstance(restored_narration, Exception)
+
+class TestJournal (StoryTestCase):
+    def setUp (self):
+        self.filename = self.write_story("sample", generate_sample_story())
+        self.state_directory = os.path.join(self.directory, "state")
+        self.journal = None
+
+    def tearDown (self):
+        self.journal.close()
+        shutil.rmtree(self.state_directory)
+
+    def open_journal (self, compaction_threshold = (1 << 30)):
+        if (self.journal is not None):
+            self.journal.close()
+
+        self.journal = persistence.Journal(
+            self.state_directory,
+            narration.Narration.apply_checkpoint_changes,
+            compaction_threshold
+        )
+
+        return self.journal
+
+    # Journals a narration of the sample story, a full checkpoint followed by
+    # the changes to it after each answer. Returns its last full checkpoint.
+    def journal_narration (self, journal, narration_id, answers):
+        started_narration = narration.Narration(
+            StoryFile(self.filename),
+            "test",
+            0
+        )
+        started_narration.run("test", 0)
+        backends.run_until_input_is_required(started_narration)
+        journal.set_narration(narration_id, 0, "test", 0, False, False, None)
+        journal.set_checkpoint(
+            narration_id,
+            started_narration.save_checkpoint()
+        )
+
+        for answer in answers:
+            started_narration.handle_answer(answer, "test", 0)
+            backends.run_until_input_is_required(started_narration)
+            journal.update_checkpoint(
+                narration_id,
+                started_narration.save_checkpoint(False)
+            )
+
+        started_narration.finalize()
+
+        return started_narration.save_checkpoint()
+
+    def assertCheckpointsEqual (self, journal, expected):
+        self.assertEqual(
+            {
+                narration_id: checkpoint_values(
+                    journal.get_checkpoint(narration_id)
+                )
+                for narration_id in journal.narrations
+            },
+            {
+                narration_id: checkpoint_values(data)
+                for (narration_id, data) in expected.items()
+            }
+        )
+
+    def test_changes_are_replayed (self):
+        journal = self.open_journal()
+        journal.set_administrator(1, "a#1")
+        journal.set_administrator(2, "b#2")
+        journal.set_administrator(1, None)
+        journal.set_story(0, "a.json", "A", "", True)
+        journal.set_story(1, "b.json", "B", "", False)
+        journal.set_narration(0, 0, "a", 1, False, False, 10)
+        journal.set_narration(1, 1, "b", 2, True, True, None)
+        journal.set_narration(0, 0, "a", 1, False, False, 11)
+        journal.set_checkpoint(0, b"0")
+        journal.set_checkpoint(1, b"1")
+        journal.remove_narration(1)
+        # Not journaled: narration 1 is gone, narration 2 never was.
+        journal.set_checkpoint(1, b"1")
+        journal.update_checkpoint(2, b"2")
+        state = journal.get_state()
+
+        reopened = self.open_journal()
+
+        self.assertEqual(reopened.get_state(), state)
+        self.assertEqual(
+            state,
+            (
+                {2: "b#2"},
+                {0: ("a.json", "A", "", True), 1: ("b.json", "B", "", False)},
+                {0: (0, "a", 1, False, False, 11)}
+            )
+        )
+        self.assertEqual(reopened.records, 11)
+        self.assertEqual(reopened.get_checkpoint(0), b"0")
+        self.assertFalse(reopened.has_checkpoint(1))
+        self.assertIsNone(reopened.get_checkpoint(2))
+
+    def test_truncated_changes_are_dropped (self):
+        journal = self.open_journal()
+        journal.set_administrator(1, "a#1")
+        log_size = journal.log_size
+        journal.set_administrator(2, "b#2")
+        journal.close()
+
+        path = os.path.join(self.state_directory, persistence.LOG_FILENAME)
+
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        reopened = self.open_journal()
+
+        self.assertEqual(reopened.get_state()[0], {1: "a#1"})
+        self.assertEqual(os.path.getsize(path), log_size)
+
+        # Later changes are not lost behind the truncated one.
+        reopened.set_administrator(3, "c#3")
+
+        self.assertEqual(
+            self.open_journal().get_state()[0],
+            {1: "a#1", 3: "c#3"}
+        )
+
+    def test_checkpoint_changes_are_folded (self):
+        journal = self.open_journal()
+        expected = {
+            narration_id: self.journal_narration(
+                journal,
+                narration_id,
+                SAMPLE_ANSWERS[:(narration_id + 2)]
+            )
+            for narration_id in range(3)
+        }
+
+        self.assertCheckpointsEqual(journal, expected)
+        self.assertEqual(len(journal.checkpoints[2]), 5)
+
+        journal.compact()
+
+        self.assertCheckpointsEqual(journal, expected)
+        self.assertEqual(journal.log_size, 0)
+        self.assertEqual(
+            [len(locations) for locations in journal.checkpoints.values()],
+            [1, 1, 1]
+        )
+        self.assertCheckpointsEqual(self.open_journal(), expected)
+
+    def test_compaction_is_triggered_by_the_log_size (self):
+        journal = self.open_journal(compaction_threshold = 1)
+
+        self.assertFalse(journal.needs_compaction())
+
+        self.journal_narration(journal, 0, [])
+
+        self.assertTrue(journal.needs_compaction())
+
+        compaction = journal.start_compaction()
+
+        self.assertFalse(journal.needs_compaction())
+
+        journal.cancel_compaction(compaction)
+
+        self.assertTrue(journal.needs_compaction())
+        self.assertEqual(
+            os.listdir(self.state_directory),
+            [persistence.LOG_FILENAME]
+        )
+
+    def test_changes_made_while_compacting_are_kept (self):
+        journal = self.open_journal()
+        expected = {
+            narration_id: self.journal_narration(
+                journal,
+                narration_id,
+                SAMPLE_ANSWERS[:2]
+            )
+            for narration_id in range(3)
+        }
+        compaction = journal.start_compaction()
+        result = journal.write_compaction(compaction)
+
+        # One narration updated, one removed, one replacing a removed one.
+        journal.update_checkpoint(
+            0,
+            marshal.dumps(marshal.loads(expected[0])[:7] + (None,))
+        )
+        del expected[1]
+        journal.remove_narration(1)
+        journal.remove_narration(2)
+        expected[2] = self.journal_narration(journal, 2, SAMPLE_ANSWERS[:3])
+        journal.end_compaction(compaction, result)
+
+        self.assertCheckpointsEqual(journal, expected)
+        self.assertEqual(
+            [location[0] for location in journal.checkpoints[0]],
+            [persistence.STATE_FILE, persistence.LOG_FILE]
+        )
+        self.assertEqual(
+            set(location[0] for location in journal.checkpoints[2]),
+            {persistence.LOG_FILE}
+        )
+        self.assertCheckpointsEqual(self.open_journal(), expected)
+
+    def test_interrupted_compactions_are_replayed (self):
+        journal = self.open_journal()
+        expected = {
+            narration_id: self.journal_narration(
+                journal,
+                narration_id,
+                SAMPLE_ANSWERS[:3]
+            )
+            for narration_id in range(2)
+        }
+        path = os.path.join(self.state_directory, persistence.LOG_FILENAME)
+
+        with open(path, 'rb') as f:
+            log = f.read()
+
+        journal.compact()
+        journal.close()
+
+        # As if the bot stopped before the log was replaced.
+        with open(path, 'wb') as f:
+            f.write(log)
+
+        self.assertCheckpointsEqual(self.open_journal(), expected)
+
+if __name__ == '__main__':
+    unittest.main()
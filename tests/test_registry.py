@@ -0,0 +1,147 @@
+import unittest
+
+from stories import *
+
+import registry
+
+class TestStories (unittest.TestCase):
+    def test_stories_are_indexed_by_filename (self):
+        stories = registry.Registry()
+        a = RegisteredStory("a.json")
+        b = RegisteredStory("b.json")
+        a2 = RegisteredStory("a.json")
+
+        self.assertEqual(
+            [stories.add_story(s) for s in (a, b, a2)],
+            [0, 1, 2]
+        )
+        self.assertEqual([s.id for s in (a, b, a2)], [0, 1, 2])
+        self.assertEqual(stories.get_stories_of_file("a.json"), [a, a2])
+
+        stories.remove_story(b)
+
+        self.assertEqual(stories.get_story(1), a2)
+        self.assertIsNone(stories.get_story(2))
+        self.assertEqual(stories.get_stories_of_file("b.json"), [])
+        self.assertFalse("b.json" in stories.stories_by_filename)
+
+        # IDs are never reused, even by restored stories.
+        c = RegisteredStory("c.json")
+        stories.add_story(c)
+
+        self.assertEqual(c.id, 3)
+
+    def test_removed_stories_orphan_their_narrations (self):
+        stories = registry.Registry()
+        a = RegisteredStory("a.json")
+        stories.add_story(a)
+        n = RegisteredNarration(0, a, 10)
+        stories.add_narration(n)
+
+        stories.remove_story(a)
+
+        self.assertTrue(stories.is_orphaned(n))
+        self.assertEqual(list(stories.get_orphaned_narrations()), [n])
+        self.assertEqual(stories.get_narration(0), n)
+
+        self.assertEqual(
+            stories.forget_orphaned_narrations_of_file("a.json"),
+            [n]
+        )
+        self.assertEqual(stories.get_orphaned_narration_count(), 0)
+
+class TestNarrations (unittest.TestCase):
+    def setUp (self):
+        self.stories = registry.Registry()
+        self.story = RegisteredStory("a.json")
+        self.stories.add_story(self.story)
+
+    def test_narrations_are_indexed (self):
+        n0 = RegisteredNarration(0, self.story, 10, 100)
+        n1 = RegisteredNarration(1, self.story, 10)
+        n2 = RegisteredNarration(2, self.story, 11, 102)
+
+        for n in (n0, n1, n2):
+            self.stories.add_narration(n)
+
+        self.assertEqual(self.stories.get_narration(1), n1)
+        self.assertEqual(self.stories.get_narration_by_post(102), n2)
+        self.assertEqual(
+            list(self.stories.get_narrations_of_initiator(10)),
+            [n0, n1]
+        )
+        self.assertEqual(self.stories.get_narration_count_of_initiator(12), 0)
+        self.assertEqual(list(self.story.narrations), [0, 1, 2])
+
+        self.stories.set_narration_post(n0, 103)
+
+        self.assertIsNone(self.stories.get_narration_by_post(100))
+        self.assertEqual(self.stories.get_narration_by_post(103), n0)
+
+    def test_paused_narrations_do_not_get_replies (self):
+        n = RegisteredNarration(0, self.story, 10, 100)
+        self.stories.add_narration(n)
+
+        self.stories.pause_narration(n)
+
+        self.assertTrue(n.get_is_paused())
+        self.assertIsNone(self.stories.get_narration_by_post(100))
+        self.assertEqual(list(self.stories.get_paused_narrations()), [n])
+
+        self.stories.resume_narration(n)
+        self.stories.set_narration_post(n, 101)
+
+        self.assertEqual(self.stories.get_paused_narration_count(), 0)
+        self.assertEqual(self.stories.get_narration_by_post(101), n)
+
+    def test_removed_narrations_leave_no_trace (self):
+        n = RegisteredNarration(0, self.story, 10, 100)
+        self.stories.add_narration(n)
+        self.stories.pause_narration(n)
+        self.stories.orphan_narration(n)
+        self.stories.get_narration_entry(n)
+
+        # Same ID, other narration: IDs are recycled.
+        self.assertFalse(
+            self.stories.remove_narration(
+                RegisteredNarration(0, self.story, 10)
+            )
+        )
+        self.assertTrue(self.stories.remove_narration(n))
+        self.assertFalse(self.stories.remove_narration(n))
+
+        for index in (
+            self.stories.narrations_by_id,
+            self.stories.narrations_by_post,
+            self.stories.narrations_by_initiator,
+            self.stories.paused_narrations,
+            self.stories.orphaned_narrations,
+            self.stories.narration_entries,
+            self.story.narrations
+        ):
+            self.assertEqual(len(index), 0)
+
+    def test_entries_are_updated (self):
+        n = RegisteredNarration(0, self.story, 10)
+        self.stories.add_narration(n)
+
+        self.assertEqual(
+            self.stories.get_narration_entry(n),
+            "\n0. Story(a.json)\nStarted by: user10(10)\n"
+        )
+
+        self.stories.pause_narration(n)
+
+        self.assertTrue(
+            self.stories.get_narration_entry(n).endswith("Paused.\n")
+        )
+
+        self.story.name = "Renamed"
+        self.stories.invalidate_story_entries(self.story)
+
+        self.assertTrue(
+            self.stories.get_narration_entry(n).startswith("\n0. Renamed(")
+        )
+
+if __name__ == '__main__':
+    unittest.main()
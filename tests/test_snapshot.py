@@ -0,0 +1,49 @@
+import unittest
+
+import tonkadur
+
+from stories import *
+
+class TestSnapshot (StoryTestCase):
+    def test_restored_state_is_identical (self):
+        filename = self.write_story("sample", generate_sample_story())
+        vm = tonkadur.Tonkadur(filename, "test", 0)
+        run_with_answers(vm, SAMPLE_ANSWERS[:3])
+        data = vm.save_snapshot()
+
+        restored = tonkadur.Tonkadur(filename, "test", 0)
+        restored.restore_snapshot(data)
+
+        self.assertEqual(restored.memory, vm.memory)
+        self.assertEqual(restored.program_counter, vm.program_counter)
+        self.assertEqual(restored.allocated_data, vm.allocated_data)
+        self.assertEqual(restored.free_handles, vm.free_handles)
+        self.assertEqual(restored.memorized_target, vm.memorized_target)
+        self.assertEqual(restored.save_snapshot(), data)
+        self.assertEqual(
+            run_with_answers(restored, SAMPLE_ANSWERS[3:]),
+            run_with_answers(vm, SAMPLE_ANSWERS[3:])
+        )
+
+    def test_snapshots_of_other_stories_are_rejected (self):
+        vm = tonkadur.Tonkadur(
+            self.write_story("sample", generate_sample_story()),
+            "test",
+            0
+        )
+        run_with_answers(vm, SAMPLE_ANSWERS[:1])
+        data = vm.save_snapshot()
+        other = tonkadur.Tonkadur(
+            self.write_story("copy", generate_copy_story()),
+            "test",
+            0
+        )
+
+        with self.assertRaises(ValueError):
+            other.restore_snapshot(data)
+
+        with self.assertRaises(ValueError):
+            vm.restore_snapshot(b"XYZ" + data[3:])
+
+if __name__ == '__main__':
+    unittest.main()
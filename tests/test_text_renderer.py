@@ -0,0 +1,105 @@
+import unittest
+
+import text_renderer
+
+from stories import *
+
+def rich_text (effect, *content):
+    if (effect is None):
+        return {'content': list(content), 'effect': None}
+
+    return {'content': list(content), 'effect': {'name': effect}}
+
+class TestMarkdown (unittest.TestCase):
+    def test_effects_become_markdown (self):
+        for (effect, expected) in (
+            ("bold", "**a**"),
+            ("emph", "*a*"),
+            ("underline", "__a__"),
+            ("strike", "~~a~~"),
+            ("spoiler", "||a||"),
+            ("code", "`a`"),
+            ("code_block", "```\na\n```"),
+            ("unknown", "a"),
+            (None, "a")
+        ):
+            with self.subTest(effect = effect):
+                self.assertEqual(
+                    text_renderer.to_string(rich_text(effect, "a")),
+                    expected
+                )
+
+    def test_nested_texts_are_written_in_order (self):
+        self.assertEqual(
+            text_renderer.to_string(
+                rich_text(
+                    "bold",
+                    "a ",
+                    rich_text("italic", "b", rich_text(None, 1, 2.5)),
+                    " c",
+                    rich_text("code")
+                )
+            ),
+            "**a *b12.5* c**"
+        )
+
+    def test_deep_texts_do_not_recurse (self):
+        text = "a"
+
+        for i in range(10000):
+            text = rich_text("bold" if ((i % 2) == 0) else None, text)
+
+        self.assertEqual(
+            text_renderer.to_string(text),
+            ("**" * 5000) + "a" + ("**" * 5000)
+        )
+
+class TestConstantTexts (unittest.TestCase):
+    def test_renderings_are_cached (self):
+        constant_texts = dict()
+        constant = text_renderer.register_constant(
+            constant_texts,
+            rich_text("bold", "a")
+        )
+        text = rich_text(None, constant, "b", constant)
+
+        self.assertEqual(
+            text_renderer.to_string(text, constant_texts),
+            "**a**b**a**"
+        )
+        self.assertEqual(constant_texts[id(constant)][1], "**a**")
+
+        # Only the rendering is used from then on.
+        constant['content'] = ["changed"]
+
+        self.assertEqual(
+            text_renderer.to_string(constant, constant_texts),
+            "**a**"
+        )
+        self.assertEqual(text_renderer.to_string(constant), "**changed**")
+
+class TestStoryTexts (StoryTestCase):
+    def test_constant_texts_are_kept_with_their_program (self):
+        filename = self.write_story(
+            "texts",
+            story(
+                [
+                    display(text_effect("bold", constant("a"))),
+                    display(text_effect("bold", constant("a"))),
+                    end()
+                ]
+            )
+        )
+        vm = tonkadur.Tonkadur(filename, "test", 0)
+        constant_texts = vm.program.constant_texts
+        texts = [vm.run("test", 0)["content"] for i in range(2)]
+
+        self.assertIn(id(texts[0]), constant_texts)
+        self.assertEqual(
+            [text_renderer.to_string(t, constant_texts) for t in texts],
+            ["**a**", "**a**"]
+        )
+        self.assertEqual(constant_texts[id(texts[0])][1], "**a**")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+################################################################################
+## EFFECTS #####################################################################
+################################################################################
+# Discord markdown written before and after the content of a text with the
+# given effect. Texts with any other effect are written without markup.
+EFFECT_MARKDOWN = {
+    "bold": ("**", "**"),
+    "strong": ("**", "**"),
+    "italic": ("*", "*"),
+    "italics": ("*", "*"),
+    "emph": ("*", "*"),
+    "emphasis": ("*", "*"),
+    "underline": ("__", "__"),
+    "strike": ("~~", "~~"),
+    "strikethrough": ("~~", "~~"),
+    "spoiler": ("||", "||"),
+    "code": ("`", "`"),
+    "code_block": ("```\n", "\n```"),
+}
+
+NO_MARKDOWN = ("", "")
+
+def get_markdown (effect):
+    if (effect is None):
+        return NO_MARKDOWN
+
+    return EFFECT_MARKDOWN.get(effect['name'], NO_MARKDOWN)
+
+################################################################################
+## CONSTANT TEXTS ##############################################################
+################################################################################
+# Texts that are constant in the compiled story are built once, and the very
+# same object is returned every time they are computed. Their rendering is
+# kept in their program's 'constant_texts', along with the text itself so that
+# its id cannot be reused while the program exists.
+# id(text) -> [text, rendered string or None]
+def register_constant (constant_texts, text):
+    constant_texts[id(text)] = [text, None]
+
+    return text
+
+NO_CONSTANT_TEXTS = dict()
+
+################################################################################
+## RENDERING ###################################################################
+################################################################################
+# Walks the text tree without recursion, writing its parts to 'chunks'. Only
+# the constant texts found within 'text' are looked up, not 'text' itself.
+def write (text, chunks, constant_texts = NO_CONSTANT_TEXTS):
+    pending = [text]
+
+    while (len(pending) > 0):
+        item = pending.pop()
+
+        if (type(item) is not dict):
+            chunks.append(item if (type(item) is str) else str(item))
+
+            continue
+
+        if (not (item is text)):
+            entry = constant_texts.get(id(item))
+
+            if (entry is not None):
+                if (entry[1] is None):
+                    entry[1] = render_uncached(item, constant_texts)
+
+                chunks.append(entry[1])
+
+                continue
+
+        content = item['content']
+
+        if (len(content) == 0):
+            continue
+
+        (opening, closing) = get_markdown(item['effect'])
+
+        if (len(opening) > 0):
+            chunks.append(opening)
+            pending.append(closing)
+
+        pending.extend(reversed(content))
+
+def render_uncached (text, constant_texts = NO_CONSTANT_TEXTS):
+    chunks = []
+
+    write(text, chunks, constant_texts)
+
+    return "".join(chunks)
+
+# 'constant_texts' is the one of the program 'text' comes from.
+def render (text, chunks, constant_texts = NO_CONSTANT_TEXTS):
+    entry = constant_texts.get(id(text))
+
+    if (entry is None):
+        write(text, chunks, constant_texts)
+    else:
+        if (entry[1] is None):
+            entry[1] = render_uncached(text, constant_texts)
+
+        chunks.append(entry[1])
+
+def to_string (text, constant_texts = NO_CONSTANT_TEXTS):
+    chunks = []
+
+    render(text, chunks, constant_texts)
+
+    return "".join(chunks)
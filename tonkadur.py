@@ -1,64 +1,299 @@
-import copy
+import gc
+import hashlib
 import json
 import math
+import os
 import random
+import time
+
+import artifact
+import compiler
+import memory
+import optimizer
+import profiler
+import snapshot
+
+################################################################################
+## PROGRAMS ####################################################################
+################################################################################
+# Everything that comes from the story file and never changes while it is being
+# narrated. A single Program is shared by all the Tonkadur instances using the
+# same story file, so it must be treated as read-only.
+class Program:
+    def __init__ (self, json_file, optimize = True):
+        self.filename = json_file
+        self.content_hash = None
+        self.optimization_report = None
+        self.types = dict()
+        self.constructors = dict()
+        self.sequences = dict()
+        self.code = []
+        self.compiled_code = []
+        self.profiled_code = None
+        # See text_renderer.
+        self.constant_texts = dict()
+
+        with open(json_file, 'rb') as f:
+            raw_content = f.read()
+
+        self.content_hash = hashlib.sha1(raw_content).hexdigest()
+        precompiled = None
+
+        # Precompiled stories hold optimized code: programs that are not
+        # optimized are for debugging, and are always read from the story
+        # file itself.
+        if (optimize):
+            precompiled = artifact.load(json_file, self.content_hash)
+
+        if (precompiled is None):
+            json_content = json.loads(raw_content)
+            structure_types = json_content['structure_types']
+            sequences = json_content['sequences']
+            self.code = json_content['code']
 
+            if (optimize):
+                (self.code, self.optimization_report) = (
+                    optimizer.optimize_code(self.code)
+                )
+                artifact.save(
+                    json_file,
+                    self.content_hash,
+                    structure_types,
+                    sequences,
+                    self.code,
+                    self.optimization_report.to_tuple()
+                )
+        else:
+            (structure_types, sequences, self.code, report) = precompiled
+            self.optimization_report = (
+                optimizer.OptimizationReport.from_tuple(report)
+            )
+
+        if (optimize):
+            print(
+                "[I] Optimizer "
+                + self.optimization_report.to_string()
+                + " in "
+                + json_file
+                + ("." if (precompiled is None) else " (precompiled).")
+            )
+
+        #### INITIALIZE TYPES ##################################################
+        for typedef in structure_types:
+            self.types[typedef['name']] = typedef
+            self.constructors[typedef['name']] = (
+                compiler.compile_structure(typedef, self.constructors)
+            )
+
+        #### INITIALIZE SEQUENCES ##############################################
+        for seqdef in sequences:
+            self.sequences[seqdef['name']] = seqdef['line']
+
+        #### INITIALIZE CODE ###################################################
+        self.compiled_code = compiler.compile_code(
+            self.code,
+            self.constant_texts
+        )
+
+    # Only compiled once something gets profiled.
+    def get_profiled_code (self):
+        if (self.profiled_code is None):
+            self.profiled_code = compiler.compile_code(
+                self.code,
+                self.constant_texts,
+                True
+            )
+
+        return self.profiled_code
+
+# (Story file path, optimize) -> (modification time and size, Program)
+program_cache = dict()
+
+def get_file_key (json_file):
+    file_stats = os.stat(json_file)
+
+    return (file_stats.st_mtime_ns, file_stats.st_size)
+
+def get_program (json_file, optimize = True):
+    global program_cache
+
+    path = os.path.abspath(json_file)
+    file_key = get_file_key(path)
+    cached = program_cache.get((path, optimize))
+
+    if ((cached is not None) and (cached[0] == file_key)):
+        return cached[1]
+
+    # Loading creates a very large number of containers, none of them garbage:
+    # Python's cycle collector would keep scanning them for nothing.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        program = Program(path, optimize)
+    finally:
+        if (gc_was_enabled):
+            gc.enable()
+
+    program_cache[(path, optimize)] = (file_key, program)
+
+    return program
+
+def invalidate_program (json_file):
+    global program_cache
+
+    path = os.path.abspath(json_file)
+
+    program_cache.pop((path, True), None)
+    program_cache.pop((path, False), None)
+
+################################################################################
+## VIRTUAL MACHINE #############################################################
+################################################################################
 class Tonkadur:
-    def generate_instance_of (self, typedef):
-        if (typedef['category'] == "bool"):
-            return False
-        elif (typedef['category'] == "float"):
-            return 0.0
-        elif (typedef['category'] == "int"):
-            return 0
-        elif (typedef['category'] == "text"):
-            result = dict()
-            result['content'] = []
-            result['effect'] = None
-            return result
-        elif (typedef['category'] == "string"):
-            return ""
-        elif (typedef['category'] == "list"):
-            return dict()
-        elif (typedef['category'] == "pointer"):
-            return []
-        elif (typedef['category'] == "structure"):
-            if (typedef['name'] == "wild dict"):
-                return dict()
-            else:
-                return copy.deepcopy(self.types[typedef['name']])
+    # Allocations after which unreachable allocated objects are collected. The
+    # actual threshold grows with the number of objects still alive, so that
+    # collecting stays proportional to allocating. None disables collection.
+    collection_threshold = 10000
 
-    def __init__ (self, json_file, actor_name, actor_id):
+    def generate_instance_of (self, typedef):
+        return compiler.compile_type(typedef, self.constructors)()
+
+    # 'program' is the Program of 'json_file', if it is already loaded.
+    def __init__ (
+        self,
+        json_file,
+        actor_name,
+        actor_id,
+        use_compiled_code = True,
+        optimize = True,
+        program = None
+    ):
+        if (program is None):
+            program = get_program(json_file, optimize)
+
+        self.program = program
+        self.types = self.program.types
+        self.constructors = self.program.constructors
+        self.sequences = self.program.sequences
+        self.code = self.program.code
+        # The JSON interpreter (compute/execute) is kept as the reference.
+        self.compiled_code = (
+            self.program.compiled_code if use_compiled_code else None
+        )
         self.memory = dict()
-        self.types = dict()
-        self.sequences = dict()
-        self.code = []
         self.program_counter = 0
         self.allocated_data = 0
+        self.free_handles = []
+        self.allocations_since_collection = 0
+        self.live_objects = 0
+        self.freed_objects = 0
+        self.collections = 0
+        # memory.MemoryUsage as of the last measure_memory, None before it.
+        self.memory_usage = None
+        self.measure_duration = 0.0
+        self.run_duration_since_measure = 0.0
         self.last_choice_index = -1
         self.available_options = []
         self.memorized_target = []
         self.last_actor = (actor_name, actor_id)
+        self.snapshot_cache = snapshot.SnapshotCache()
+        self.profiler = profiler.get_story_profiler(self.program.filename)
 
-        with open(json_file, 'r') as f:
-            json_content = json.load(f)
-
-            #### INITIALIZE TYPES ##############################################
-            for typedef in json_content['structure_types']:
-                new_type = dict()
-
-                for field in typedef['fields']:
-                    new_type[field['name']] = self.generate_instance_of(field['type'])
-
-                self.types[typedef['name']] = new_type
-
-            #### INITIALIZE SEQUENCES ##########################################
-            for seqdef in json_content['sequences']:
-                self.sequences[seqdef['name']] = seqdef['line']
-
-            #### INITIALIZE CODE ###############################################
-            self.code = json_content['code']
+    def allocate (self, value):
+        if (len(self.free_handles) > 0):
+            handle = self.free_handles.pop()
+        else:
+            handle = self.allocated_data
+            self.allocated_data += 1
 
+        self.memory[handle] = value
+        self.allocations_since_collection += 1
+
+        return (handle,)
+
+    # Only to be called between instructions: values being computed are not
+    # roots.
+    def collect_garbage (self):
+        freed = memory.collect_garbage(
+            self.memory,
+            [self.memorized_target, self.available_options]
+        )
+
+        # Handles removed by the story itself are not reused: dangling pointers
+        # to them could remain.
+        self.free_handles.extend(freed)
+        self.freed_objects += len(freed)
+        self.collections += 1
+        self.allocations_since_collection = 0
+        self.live_objects = sum(1 for k in self.memory if (type(k) is int))
+        self.update_memory_usage()
+
+    # Walks the whole memory.
+    def measure_memory (self):
+        start = time.perf_counter()
+        self.memory_usage = memory.measure(
+            self.memory,
+            [self.memorized_target, self.available_options]
+        )
+        self.measure_duration = time.perf_counter() - start
+        self.run_duration_since_measure = 0.0
+
+    # Measures the memory again once the story ran for as long as the last
+    # measure took, so that measuring stays proportional to running. Called
+    # after collections and when the narration waits for an input.
+    def update_memory_usage (self):
+        if (
+            (self.memory_usage is None)
+            or (self.run_duration_since_measure >= self.measure_duration)
+        ):
+            self.measure_memory()
+
+    def has_allocation_pressure (self):
+        return (
+            (Tonkadur.collection_threshold is not None)
+            and (
+                self.allocations_since_collection
+                >= max(Tonkadur.collection_threshold, self.live_objects)
+            )
+        )
+
+    def get_allocation_stats (self):
+        result = dict()
+        result["live"] = sum(1 for k in self.memory if (type(k) is int))
+        result["freed"] = self.freed_objects
+        result["collections"] = self.collections
+        result["allocated_since_collection"] = self.allocations_since_collection
+
+        return result
+
+    # Profiling always uses the compiled code. 'target' can be shared with
+    # other instances.
+    def enable_profiling (self, target = None):
+        if (target is None):
+            target = profiler.Profiler()
+
+        self.profiler = target
+
+        return target
+
+    def disable_profiling (self):
+        result = self.profiler
+        self.profiler = None
+
+        return result
+
+    # See snapshot.py for the format.
+    def save_snapshot (self):
+        return snapshot.save(self)
+
+    # Changes since the last call, or since the snapshot was restored (see
+    # snapshot.apply_changes).
+    def save_snapshot_changes (self):
+        return snapshot.save_changes(self)
+
+    def restore_snapshot (self, data):
+        snapshot.restore(self, data)
 
     def compute (self, computation):
         computation_category = computation['category']
@@ -125,12 +360,9 @@ class Tonkadur:
             else:
                 return self.compute(computation['if_false'])
         elif (computation_category == "new"):
-            address = ".alloc." + str(self.allocated_data)
-            self.allocated_data += 1
-            self.memory[address] = self.generate_instance_of(computation['target'])
-            #print("Allocated " + str(address) + " = " + str(self.memory[address]))
-
-            return [address]
+            return self.allocate(
+                self.generate_instance_of(computation['target'])
+            )
         elif (computation_category == "operation"):
             operator = computation['operator']
             x = self.compute(computation['x'])
@@ -164,15 +396,10 @@ class Tonkadur:
                 print("unknown operator " + operator)
 
         elif (computation_category == "address"):
-            result = self.compute(computation['address'])
-            if (isinstance(result, list)):
-                return result
-            else:
-                return [result]
+            return memory.to_address(self.compute(computation['address']))
         elif (computation_category == "relative_address"):
-            base = self.compute(computation['base']).copy()
-            base.append(self.compute(computation['extra']))
-            return base
+            base = memory.to_address(self.compute(computation['base']))
+            return base + (self.compute(computation['extra']),)
         elif (computation_category == "text"):
             result = dict()
             result['effect'] = None
@@ -214,13 +441,10 @@ class Tonkadur:
         elif (computation_category == "value_of"):
             target = self.memory
             access = self.compute(computation['reference'])
-            #print("(value_of " + str(access) + ")")
+
             for addr in access:
-                #print("Reading " + str(addr) + " of " + str(target))
-                #print("addr = " + str(addr))
                 target = target[addr]
-               # if (isinstance(target, list)):
-               #     print("That's a list.")
+
             return target
         elif (computation_category == "last_choice_index"):
             return self.last_choice_index
@@ -236,11 +460,11 @@ class Tonkadur:
         current_val = self.memory
         self.last_actor = (actor_name, actor_id)
 
-        for access in self.memorized_target:
+        for access in memory.to_address(self.memorized_target):
             pre_val = current_val
             last_access = access
             if (access in current_val):
-                current_val = current_val[access]
+                current_val = memory.get_writable(current_val, access)
 
         pre_val[last_access] = value
 
@@ -248,155 +472,205 @@ class Tonkadur:
         current_val = self.memory
         self.last_actor = (actor_name, actor_id)
 
-        for access in self.memorized_target:
+        for access in memory.to_address(self.memorized_target):
             pre_val = current_val
             last_access = access
             if (access in current_val):
-                current_val = current_val[access]
+                current_val = memory.get_writable(current_val, access)
 
         pre_val[last_access] = value
 
-    def run (self, actor_name, actor_id):
-        while True:
-            #print("\nmemory: " + str(self.memory))
-            #print("\nline: " + str(self.program_counter))
-            instruction = self.code[self.program_counter]
-            instruction_category = instruction['category']
-            #print("instruction:" + str(instruction))
+    def execute (self, instruction):
+        instruction_category = instruction['category']
 
-            if (instruction_category == "add_text_option"):
-                result = dict()
-                result["category"] = "text_option"
-                result["label"] = self.compute(instruction['label'])
-                self.available_options.append(result)
-                self.program_counter += 1
-            elif (instruction_category == "add_event_option"):
-                result = dict()
-                result["category"] = "event_option"
-                result["name"] = instruction["event"]
-                params = []
+        if (instruction_category == "add_text_option"):
+            result = dict()
+            result["category"] = "text_option"
+            result["label"] = self.compute(instruction['label'])
+            self.available_options.append(result)
+            self.program_counter += 1
+        elif (instruction_category == "add_event_option"):
+            result = dict()
+            result["category"] = "event_option"
+            result["name"] = instruction["event"]
+            params = []
 
-                for param in instruction['parameters']:
-                    params.append(self.compute(param))
+            for param in instruction['parameters']:
+                params.append(self.compute(param))
 
-                result["parameters"] = params
-                self.available_options.append(result)
-                self.program_counter += 1
-            elif (instruction_category == "assert"):
-                condition = self.compute(instruction['condition'])
-
-                if (not condition):
-                    result = dict()
-                    result["category"] = "assert"
-                    result["line"] = self.program_counter
-                    result["message"] = self.compute(instruction['message'])
-                    self.program_counter += 1
-                    return result
+            result["parameters"] = params
+            self.available_options.append(result)
+            self.program_counter += 1
+        elif (instruction_category == "assert"):
+            condition = self.compute(instruction['condition'])
 
-                self.program_counter += 1
-            elif (instruction_category == "display"):
+            if (not condition):
                 result = dict()
-                result["category"] = "display"
-                result["content"] = self.compute(instruction['content'])
+                result["category"] = "assert"
+                result["line"] = self.program_counter
+                result["message"] = self.compute(instruction['message'])
                 self.program_counter += 1
-
                 return result
-            elif (instruction_category == "end"):
-                result = dict()
-                result["category"] = "end"
 
-                return result
-            elif (instruction_category == "extra_instruction"):
-                result = dict()
-                result["category"] = "extra_instruction"
-                result["name"] = instruction["name"]
-                params = []
+            self.program_counter += 1
+        elif (instruction_category == "display"):
+            result = dict()
+            result["category"] = "display"
+            result["content"] = self.compute(instruction['content'])
+            self.program_counter += 1
 
-                for param in instruction['parameters']:
-                    params.append(self.compute(param))
+            return result
+        elif (instruction_category == "end"):
+            result = dict()
+            result["category"] = "end"
 
-                result["parameters"] = params
+            return result
+        elif (instruction_category == "extra_instruction"):
+            result = dict()
+            result["category"] = "extra_instruction"
+            result["name"] = instruction["name"]
+            params = []
 
-                self.program_counter += 1
+            for param in instruction['parameters']:
+                params.append(self.compute(param))
 
-                print("[E] Unhandled extra instruction " + str(result))
+            result["parameters"] = params
 
-                return result
-            elif (instruction_category == "remove"):
-                pre_val = self.memory
-                current_val = pre_val
-                last_access = ""
+            self.program_counter += 1
 
-                for access in self.compute(instruction["reference"]):
-                    pre_val = current_val
-                    last_access = access
-                    current_val = current_val[access]
+            print("[E] Unhandled extra instruction " + str(result))
 
-                #print("Removing " + str(last_access) + " of " + str(pre_val))
-                del pre_val[last_access]
+            return result
+        elif (instruction_category == "remove"):
+            access_full = self.compute(instruction["reference"])
+            pre_val = memory.get_writable_parent(self.memory, access_full)
 
-                self.program_counter += 1
-            elif (instruction_category == "resolve_choice"):
-                result = dict()
-                result["category"] = "resolve_choice"
-                result["options"] = self.available_options
-                self.program_counter += 1
+            del pre_val[access_full[-1]]
 
-                return result
-            elif (instruction_category == "set_pc"):
-                self.program_counter = self.compute(instruction["value"])
-            elif (instruction_category == "set_value"):
-                current_val = self.memory
-                #print("Reference:" + str(instruction["reference"]))
-                access_full = self.compute(instruction["reference"])
-                #print("Writing: " + str(access_full))
+            self.program_counter += 1
+        elif (instruction_category == "resolve_choice"):
+            result = dict()
+            result["category"] = "resolve_choice"
+            result["options"] = self.available_options
+            self.program_counter += 1
 
-                for access in access_full[:-1]:
-                    current_val = current_val[access]
+            return result
+        elif (instruction_category == "set_pc"):
+            self.program_counter = self.compute(instruction["value"])
+        elif (instruction_category == "set_value"):
+            access_full = self.compute(instruction["reference"])
+            # Computed before walking the path, so that assigning a container
+            # within itself stores what it was before the assignment.
+            result = memory.share(self.compute(instruction["value"]))
+            current_val = memory.get_writable_parent(self.memory, access_full)
+
+            current_val[access_full[-1]] = result
+
+            self.program_counter += 1
+        elif (instruction_category == "initialize"):
+            access_full = self.compute(instruction["reference"])
+            current_val = memory.get_writable_parent(self.memory, access_full)
+
+            current_val[access_full[-1]] = self.generate_instance_of(instruction["type"])
+
+            self.program_counter += 1
+        elif (instruction_category == "prompt_integer"):
+            result = dict()
+            result["category"] = "prompt_integer"
+            result["min"] = self.compute(instruction['min'])
+            result["max"] = self.compute(instruction['max'])
+            result["label"] = self.compute(instruction['label'])
 
-                result = self.compute(instruction["value"])
+            self.memorized_target = self.compute(instruction['target'])
 
-                if (isinstance(result, list) or isinstance(result, dict)):
-                    result = copy.deepcopy(result)
+            self.program_counter += 1
 
-                current_val[access_full[-1]] = result
+            return result
 
-                self.program_counter += 1
-            elif (instruction_category == "initialize"):
-                current_val = self.memory
-                access_full = self.compute(instruction["reference"])
+        elif (instruction_category == "prompt_string"):
+            result = dict()
+            result["category"] = "prompt_string"
+            result["min"] = self.compute(instruction['min'])
+            result["max"] = self.compute(instruction['max'])
+            result["label"] = self.compute(instruction['label'])
 
-                for access in access_full[:-1]:
-                    current_val = current_val[access]
+            self.memorized_target = self.compute(instruction['target'])
 
-                current_val[access_full[-1]] = self.generate_instance_of(instruction["type"])
+            self.program_counter += 1
 
-                self.program_counter += 1
-            elif (instruction_category == "prompt_integer"):
-                result = dict()
-                result["category"] = "prompt_integer"
-                result["min"] = self.compute(instruction['min'])
-                result["max"] = self.compute(instruction['max'])
-                result["label"] = self.compute(instruction['label'])
+            return result
+        else:
+            print("Unknown Wyrd instruction: \"" + instruction_category + "\"")
 
-                self.memorized_target = self.compute(instruction['target'])
+        return None
 
-                self.program_counter += 1
+    def run_interpreter (self, budget):
+        if (budget is None):
+            while True:
+                result = self.execute(self.code[self.program_counter])
+
+                if (result is not None):
+                    return result
 
+        for i in range(budget):
+            result = self.execute(self.code[self.program_counter])
+
+            if (result is not None):
                 return result
 
-            elif (instruction_category == "prompt_string"):
-                result = dict()
-                result["category"] = "prompt_string"
-                result["min"] = self.compute(instruction['min'])
-                result["max"] = self.compute(instruction['max'])
-                result["label"] = self.compute(instruction['label'])
+        result = dict()
+        result["category"] = "yield"
 
-                self.memorized_target = self.compute(instruction['target'])
+        return result
 
-                self.program_counter += 1
+    def run_code (self, code, budget):
+        if (budget is None):
+            while True:
+                result = code[self.program_counter](self)
+
+                if (result is not None):
+                    return result
 
+        for i in range(budget):
+            result = code[self.program_counter](self)
+
+            if (result is not None):
                 return result
-            else:
-                print("Unknown Wyrd instruction: \"" + instruction_category + "\"")
 
+        result = dict()
+        result["category"] = "yield"
+
+        return result
+
+    def run_profiled (self, budget):
+        copies = memory.copy_count
+        allocations = self.allocations_since_collection
+        current_profiler = self.profiler
+
+        try:
+            return self.run_code(self.program.get_profiled_code(), budget)
+        finally:
+            current_profiler.copies += memory.copy_count - copies
+            current_profiler.allocations += (
+                self.allocations_since_collection - allocations
+            )
+
+    # Runs until the story needs something from the narration, or until
+    # 'budget' instructions have been executed, in which case a "yield" result
+    # is returned and calling run again continues from there.
+    def run (self, actor_name, actor_id, budget = None):
+        if (self.has_allocation_pressure()):
+            self.collect_garbage()
+
+        start = time.perf_counter()
+
+        try:
+            if (self.profiler is not None):
+                return self.run_profiled(budget)
+
+            if (self.compiled_code is None):
+                return self.run_interpreter(budget)
+
+            return self.run_code(self.compiled_code, budget)
+        finally:
+            self.run_duration_since_measure += time.perf_counter() - start